@@ -5,25 +5,210 @@
 """
 import numpy as np
 import cutils
+import waypoint_index
+import control_kernel
+
+# Controller gains. Any subset can be overridden per controller instance.
+DEFAULT_GAINS = {
+    # Lateral: weights of the heading errors to the lookahead points
+    'k_1':             0.0022,
+    'k_2':             0.038,
+    'k_3':             0.24,
+    'k_4':             0.57,
+    # Lateral: damping of the change in heading error
+    'k_steer_damping': 3,
+    # Longitudinal: throttle weights
+    'kp_speed':        3.1,     # speed error
+    'kd_speed':        6,       # change in speed
+    'kff_speed':       12,      # change in desired speed
+    'k_distance':      0.08,    # distance to the tracked waypoint
+    'k_accel':         12000,   # path acceleration feedforward
+    'k_jerk':          301000,  # change in path acceleration
+    'kff_accel':       0.1,     # reference acceleration (speed profile)
+}
+
+# Persistent controller variables and their defaults, created once per
+# controller (see the create_var usage notes in update_controls)
+CONTROLLER_VARS = [
+    ('v_previous',            0.0),
+    ('x_previous',            0.0),
+    ('y_previous',            0.0),
+    ('distance',              0.0),
+    ('x_difference',          0.0),
+    ('y_difference',          0.0),
+    ('required_angle',        0.0),
+    ('i',                     0),
+    ('j',                     0),
+    ('k',                     0),
+    ('fanglea',               0.0),
+    ('fangleb',               0.0),
+    ('fanglec',               0.0),
+    ('fangled',               0.0),
+    ('diff_1',                0.0),
+    ('diff_2',                0.0),
+    ('diff_3',                0.0),
+    ('diff_4',                0.0),
+    ('k_1',                   0),
+    ('k_2',                   0),
+    ('k_3',                   0),
+    ('k_4',                   0),
+    ('fangle',                0.0),
+    ('diffangle',             0.0),
+    ('prev_diffangle',        0.0),
+    ('v_req_previous',        0.0),
+    ('steer_previous',        0.0),
+    ('steer_put',             0.0),
+    ('acceleration',          0.0),
+    ('acceleration_previous', 0.0),
+]
+
+def classic_lookahead(gains=DEFAULT_GAINS):
+    """Lookahead points of the default lateral law, as a lookahead list.
+
+    The car is steered towards waypoints i+2 (k_1) and i+4 (k_2) and along
+    the path headings from i+4 to i+5 (k_3) and from i to i+1 (k_4).
+    """
+    return [(2, gains['k_1']),
+            (4, gains['k_2']),
+            (4, 5, gains['k_3']),
+            (0, 1, gains['k_4'])]
+
+def as_waypoint_array(waypoints):
+    """Returns waypoints as an (N, 3) float64 array, copying only lists.
+    """
+    return np.asarray(waypoints, dtype=np.float64)
 
 class Controller2D(object):
-    def __init__(self, waypoints):
-        self.vars                = cutils.CUtils()
+    def __init__(self, waypoints, gains=None, lookahead=None, mpc=None,
+                 kernel=None):
+        """
+        Args:
+            waypoints: Waypoints to track, [[x0, y0, v0], ...] or an array
+            gains: Gains overriding DEFAULT_GAINS
+            lookahead: Lookahead points of the vectorized lateral mode.
+                       Each entry is either (offset, weight), the bearing
+                       from the car to waypoint i+offset, or
+                       (from_offset, to_offset, weight), the path heading
+                       from waypoint i+from_offset to i+to_offset. The
+                       steering is the weighted sum of the heading errors
+                       to all points. None uses the default lateral law
+                       (equivalent to classic_lookahead(gains)).
+            mpc: Optional mpc.MPCSolver. The commands of every tick are
+                 then optimized by the solver, and the geometric law
+                 above is the fallback when the solver runs out of its
+                 time budget without a solution.
+        """
+        self.vars                = cutils.make_vars(CONTROLLER_VARS)
         self._current_x          = 0
         self._current_y          = 0
         self._current_yaw        = 0
         self._current_speed      = 0
         self._desired_speed      = 0
+        self._desired_accel      = 0.0
+        self._reference_accel    = None
         self._current_frame      = 0
         self._current_timestamp  = 0
         self._start_control_loop = False
         self._set_throttle       = 0
         self._set_brake          = 0
         self._set_steer          = 0
-        self._waypoints          = waypoints
+        self._waypoints          = as_waypoint_array(waypoints)
         self._conv_rad_to_steer  = 180.0 / 70.0 / np.pi
         self._pi                 = np.pi
         self._2pi                = 2.0 * np.pi
+        self._gains              = dict(DEFAULT_GAINS)
+        if gains:
+            unknown = set(gains) - set(DEFAULT_GAINS)
+            if unknown:
+                raise ValueError('unknown controller gains: %s' %
+                                 ', '.join(sorted(unknown)))
+            self._gains.update(gains)
+        self._lookahead          = None
+        if lookahead is not None:
+            self.set_lookahead(lookahead)
+        self._mpc                = mpc
+        self._kernel             = None
+        if kernel is not None:
+            self.set_kernel(kernel)
+
+    def set_lookahead(self, lookahead):
+        """Switches the lateral controller to the vectorized lookahead mode.
+
+        See __init__ for the format of lookahead.
+        """
+        from_offsets = []
+        to_offsets   = []
+        weights      = []
+        for entry in lookahead:
+            if len(entry) == 2:
+                from_offsets.append(None)
+                to_offsets.append(int(entry[0]))
+            else:
+                from_offsets.append(int(entry[0]))
+                to_offsets.append(int(entry[1]))
+            weights.append(float(entry[-1]))
+        # Rows gathered per tick: the lookahead points, then the points
+        # their headings start from (the car rows are overwritten by x, y)
+        offsets = to_offsets + [0 if offset is None else offset
+                                for offset in from_offsets]
+        car_rows = [len(to_offsets) + row
+                    for row, offset in enumerate(from_offsets)
+                    if offset is None]
+        self._lookahead = (np.array(offsets), np.array(car_rows),
+                           np.array(weights))
+
+    def set_kernel(self, backend):
+        """Computes the default law with control_kernel.py.
+
+        The commands match the NumPy implementation within
+        control_kernel.KERNEL_TOLERANCE. The vectorized lookahead mode keeps
+        the NumPy implementation, and in kernel mode only the persistent
+        variables of control_kernel.KERNEL_STATE are kept in self.vars.
+
+        Args:
+            backend: 'python', 'numba', 'auto' (numba when installed) or
+                     None to go back to the NumPy implementation
+        """
+        if backend is None:
+            self._kernel = None
+            return
+        kernel, compiled = control_kernel.get_kernel(backend)
+        self._kernel = (kernel, compiled,
+                        control_kernel.pack_gains(self._gains, compiled))
+
+    def _kernel_controls(self, x, y, v, v_desired):
+        kernel, compiled, gains = self._kernel
+        state = [getattr(self.vars, name)
+                 for name in control_kernel.KERNEL_STATE]
+        if compiled:
+            state = np.array(state, dtype=np.float64)
+        commands = kernel(self._waypoints, state, float(x), float(y),
+                          float(v), float(v_desired),
+                          float(self._desired_accel), gains)
+        if compiled:
+            state = state.tolist()
+        for name, value in zip(control_kernel.KERNEL_STATE, state):
+            setattr(self.vars, name, value)
+        self.vars.i = int(self.vars.i)
+        return commands
+
+    def set_mpc(self, mpc):
+        """Switches the model predictive mode on (an mpc.MPCSolver) or off
+        (None).
+        """
+        self._mpc = mpc
+
+    def _mpc_controls(self, x, y, yaw, v, t, throttle, steer, brake):
+        # The geometric law is a candidate of the solver and the commands
+        # used when the solver has no solution within its budget
+        mpc      = self._mpc
+        fallback = (mpc.acceleration(throttle, brake, v), steer)
+        solution = mpc.solve(x, y, yaw, v, self._waypoints, t, fallback)
+        if solution is None:
+            return throttle, steer, brake
+        acceleration, steer = solution
+        throttle, brake = mpc.pedals(acceleration, v)
+        return throttle, steer, brake
 
     def update_values(self, x, y, yaw, speed, timestamp, frame):
         self._current_x         = x
@@ -36,24 +221,34 @@ class Controller2D(object):
             self._start_control_loop = True
 
     def update_desired_speed(self):
-        min_idx       = 0
-        min_dist      = float("inf")
         desired_speed = 0
-        for i in range(len(self._waypoints)):
-            dist = np.linalg.norm(np.array([
-                    self._waypoints[i][0] - self._current_x,
-                    self._waypoints[i][1] - self._current_y]))
-            if dist < min_dist:
-                min_dist = dist
-                min_idx = i
+        min_idx       = max(waypoint_index.nearest_waypoint(
+                self._waypoints, self._current_x, self._current_y), 0)
         if min_idx < len(self._waypoints)-1:
-            desired_speed = self._waypoints[min_idx][2]
+            desired_speed = self._waypoints[min_idx, 2]
         else:
-            desired_speed = self._waypoints[-1][2]
+            desired_speed = self._waypoints[-1, 2]
         self._desired_speed = desired_speed
-
-    def update_waypoints(self, new_waypoints):
-        self._waypoints = new_waypoints
+        if self._reference_accel is not None:
+            self._desired_accel = self._reference_accel[
+                    min(min_idx, len(self._reference_accel)-1)]
+
+    def update_waypoints(self, new_waypoints, reference_accel=None):
+        """Sets the waypoints to track.
+
+        Args:
+            new_waypoints: (N, 3) float64 array of [x, y, v], used as is
+                           (read-only views such as
+                           InterpolatedPath.window_view are not copied), or
+                           a [[x0, y0, v0], ...] list, converted once
+            reference_accel: Optional (N,) reference acceleration of the
+                             waypoints (see speed_profile.py), fed forward
+                             to the throttle with the kff_accel gain
+        """
+        self._waypoints       = as_waypoint_array(new_waypoints)
+        self._reference_accel = reference_accel
+        if reference_accel is None:
+            self._desired_accel = 0.0
 
     def get_commands(self):
         return self._set_throttle, self._set_steer, self._set_brake
@@ -76,6 +271,27 @@ class Controller2D(object):
         brake           = np.fmax(np.fmin(input_brake, 1.0), 0.0)
         self._set_brake = brake
 
+    def _lookahead_steer(self, x, y, waypoints):
+        # Heading of the car motion and of every lookahead point in one
+        # arctan2 call, mapped to the [-pi/2, 3pi/2) range of the default
+        # law, then all heading errors wrapped to [-pi, pi) at once.
+        offsets, car_rows, weights = self._lookahead
+        num_points = weights.shape[0]
+        points = waypoints[self.vars.i + offsets, :2]
+        points[car_rows] = (x, y)
+
+        # Row 0 is the car motion since the previous tick
+        delta = np.empty((num_points + 1, 2))
+        delta[0] = (x - self.vars.x_previous, y - self.vars.y_previous)
+        np.subtract(points[:num_points], points[num_points:], out=delta[1:])
+        angles = np.arctan2(delta[:, 0], delta[:, 1])
+        angles = np.remainder(angles + self._pi/2, self._2pi) - self._pi/2
+
+        fangle = angles[0]
+        diff = np.remainder(fangle - angles[1:] + self._pi, self._2pi) -\
+               self._pi
+        return fangle, np.dot(weights, diff)
+
     def update_controls(self):
         ######################################################
         # RETRIEVE SIMULATOR FEEDBACK
@@ -88,6 +304,7 @@ class Controller2D(object):
         v_desired = self._desired_speed
         t = self._current_timestamp
         waypoints = self._waypoints
+        gains = self._gains
         throttle_output = 0
         steer_output = 0
         brake_output = 0
@@ -112,40 +329,25 @@ class Controller2D(object):
             Example: Accessing the value from 'v_previous' to be used
             throttle_output = 0.5 * self.vars.v_previous
         """
-        self.vars.create_var('v_previous', 0.0)
-        self.vars.create_var('x_previous', 0.0)
-        self.vars.create_var('y_previous', 0.0)
-        self.vars.create_var('distance',0.0)
-        self.vars.create_var('x_difference',0.0)
-        self.vars.create_var('y_difference',0.0)
-        self.vars.create_var('required_angle',0.0)
-        self.vars.create_var('i',0)
-        self.vars.create_var('j',0)
-        self.vars.create_var('k',0)
-        self.vars.create_var('fanglea',0.0)
-        self.vars.create_var('fangleb',0.0)
-        self.vars.create_var('fanglec',0.0)
-        self.vars.create_var('fangled',0.0)
-        self.vars.create_var('diff_1',0.0)
-        self.vars.create_var('diff_2',0.0)
-        self.vars.create_var('diff_3',0.0)
-        self.vars.create_var('diff_4',0.0)
-        self.vars.create_var('k_1',0)
-        self.vars.create_var('k_2',0)
-        self.vars.create_var('k_3',0)
-        self.vars.create_var('k_4',0)
-        self.vars.create_var('fangle',0.0)
-        self.vars.create_var('diffangle',0.0)
-        self.vars.create_var('prev_diffangle',0.0)
-        self.vars.create_var('v_req_previous', 0.0)
-        self.vars.create_var('steer_previous',0.0)
-        self.vars.create_var('steer_put',0.0)
-        self.vars.create_var('acceleration',0.0)
-        self.vars.create_var('acceleration_previous',0.0)
+        # The variables used below are declared once in CONTROLLER_VARS,
+        # which gives self.vars a fixed (slotted) layout without per
+        # iteration create_var calls. Variables added with create_var
+        # here are still supported.
 
 
         # Skip the first frame to store previous values properly
-        if self._start_control_loop:
+        if self._start_control_loop and self._kernel is not None and\
+           self._lookahead is None:
+            throttle_output, steer_output, brake_output = \
+                    self._kernel_controls(x, y, v, v_desired)
+            if self._mpc is not None:
+                throttle_output, steer_output, brake_output = \
+                        self._mpc_controls(x, y, yaw, v, t, throttle_output,
+                                           steer_output, brake_output)
+            self.set_throttle(throttle_output)
+            self.set_steer(steer_output)
+            self.set_brake(brake_output)
+        elif self._start_control_loop:
             """
                 Controller iteration code block.
 
@@ -161,12 +363,13 @@ class Controller2D(object):
                     waypoints       : Current waypoints to track
                                       (Includes speed to track at each x,y
                                       location.)
-                                      Format: [[x0, y0, v0],
+                                      Format: (n+1, 3) array of rows
+                                              [[x0, y0, v0],
                                                [x1, y1, v1],
                                                ...
                                                [xn, yn, vn]]
                                       Example:
-                                          waypoints[2][1]:
+                                          waypoints[2, 1]:
                                           Returns the 3rd waypoint's y position
 
                                           waypoints[5]:
@@ -181,12 +384,12 @@ class Controller2D(object):
             ######################################################
             ######################################################
             # MODULE 7: IMPLEMENTATION OF LONGITUDINAL CONTROLLER HERE
-            self.vars.x_difference = x-waypoints[self.vars.i][0]
-            self.vars.y_difference = y-waypoints[self.vars.i][1]
+            self.vars.x_difference = x-waypoints[self.vars.i, 0]
+            self.vars.y_difference = y-waypoints[self.vars.i, 1]
             self.vars.distance = np.sqrt(np.square(self.vars.x_difference)+np.square(self.vars.y_difference))
-            self.vars.acceleration = (np.sqrt(np.square(waypoints[self.vars.i+3][0]-waypoints[self.vars.i+2][0])+np.square(waypoints[self.vars.i+3][1]-waypoints[self.vars.i+2][1]))*(waypoints[self.vars.i+3][2]-waypoints[self.vars.i+3][2])/(waypoints[self.vars.i+3][2]+waypoints[self.vars.i+2][2]))
+            self.vars.acceleration = (np.sqrt(np.square(waypoints[self.vars.i+3, 0]-waypoints[self.vars.i+2, 0])+np.square(waypoints[self.vars.i+3, 1]-waypoints[self.vars.i+2, 1]))*(waypoints[self.vars.i+3, 2]-waypoints[self.vars.i+3, 2])/(waypoints[self.vars.i+3, 2]+waypoints[self.vars.i+2, 2]))
             #if (v-v_desired <= 0):
-            throttle_output = np.minimum(np.maximum(((v_desired-v)*3.1 - (v-self.vars.v_previous)*6 + (v_desired - self.vars.v_req_previous)*12 + self.vars.distance*0.08 + 12000*self.vars.acceleration + 301000*(self.vars.acceleration-self.vars.acceleration_previous)),0),1)
+            throttle_output = np.minimum(np.maximum(((v_desired-v)*gains['kp_speed'] - (v-self.vars.v_previous)*gains['kd_speed'] + (v_desired - self.vars.v_req_previous)*gains['kff_speed'] + self.vars.distance*gains['k_distance'] + gains['k_accel']*self.vars.acceleration + gains['k_jerk']*(self.vars.acceleration-self.vars.acceleration_previous) + gains['kff_accel']*self._desired_accel),0),1)
             if (v-v_desired <= 0):
                 if (v == 0):
                     #throttle_output = 0.5
@@ -211,108 +414,113 @@ class Controller2D(object):
             # MODULE 7: IMPLEMENTATION OF LATERAL CONTROLLER HERE
             
             
-            if (y-self.vars.y_previous > 0):
-                self.vars.fangle = np.arctan((x-self.vars.x_previous)/(y-self.vars.y_previous))
-            elif (y-self.vars.y_previous == 0):
-                if (x > self.vars.x_previous):
-                    self.vars.fangle = np.pi/2
-                elif (x < self.vars.x_previous):
-                    self.vars.fangle = -np.pi/2
+            if self._lookahead is None:
+                if (y-self.vars.y_previous > 0):
+                    self.vars.fangle = np.arctan((x-self.vars.x_previous)/(y-self.vars.y_previous))
+                elif (y-self.vars.y_previous == 0):
+                    if (x > self.vars.x_previous):
+                        self.vars.fangle = np.pi/2
+                    elif (x < self.vars.x_previous):
+                        self.vars.fangle = -np.pi/2
+                    else:
+                        self.vars.fangle = 0
                 else:
-                    self.vars.fangle = 0
-            else:
-                self.vars.fangle = np.arctan((x-self.vars.x_previous)/(y-self.vars.y_previous)) + np.pi
+                    self.vars.fangle = np.arctan((x-self.vars.x_previous)/(y-self.vars.y_previous)) + np.pi
 
 
 
-            if (waypoints[self.vars.i+2][1]-y > 0):
-                self.vars.fanglea = np.arctan((waypoints[self.vars.i+2][0]-x)/(waypoints[self.vars.i+2][1]-y))
-            elif (waypoints[self.vars.i+2][1]-y == 0):
-                if (waypoints[self.vars.i+2][0]-x > 0):
-                    self.vars.fanglea = np.pi/2
-                elif (waypoints[self.vars.i+2][0]-x < 0):
-                    self.vars.fanglea = -np.pi/2
+                if (waypoints[self.vars.i+2, 1]-y > 0):
+                    self.vars.fanglea = np.arctan((waypoints[self.vars.i+2, 0]-x)/(waypoints[self.vars.i+2, 1]-y))
+                elif (waypoints[self.vars.i+2, 1]-y == 0):
+                    if (waypoints[self.vars.i+2, 0]-x > 0):
+                        self.vars.fanglea = np.pi/2
+                    elif (waypoints[self.vars.i+2, 0]-x < 0):
+                        self.vars.fanglea = -np.pi/2
+                    else:
+                        self.vars.fanglea = 0
                 else:
-                    self.vars.fanglea = 0
-            else:
-                self.vars.fanglea = np.arctan((waypoints[self.vars.i+2][0]-x)/(waypoints[self.vars.i+2][1]-y)) + np.pi
+                    self.vars.fanglea = np.arctan((waypoints[self.vars.i+2, 0]-x)/(waypoints[self.vars.i+2, 1]-y)) + np.pi
 
 
 
-            if (waypoints[self.vars.i+4][1]-y > 0):
-                self.vars.fangleb = np.arctan((waypoints[self.vars.i+4][0]-x)/(waypoints[self.vars.i+4][1]-y))
-            elif (waypoints[self.vars.i+4][1]-y == 0):
-                if (waypoints[self.vars.i+4][0]-x > 0):
-                    self.vars.fangleb = np.pi/2
-                elif (waypoints[self.vars.i+4][0]-x < 0):
-                    self.vars.fangleb = -np.pi/2
+                if (waypoints[self.vars.i+4, 1]-y > 0):
+                    self.vars.fangleb = np.arctan((waypoints[self.vars.i+4, 0]-x)/(waypoints[self.vars.i+4, 1]-y))
+                elif (waypoints[self.vars.i+4, 1]-y == 0):
+                    if (waypoints[self.vars.i+4, 0]-x > 0):
+                        self.vars.fangleb = np.pi/2
+                    elif (waypoints[self.vars.i+4, 0]-x < 0):
+                        self.vars.fangleb = -np.pi/2
+                    else:
+                        self.vars.fangleb = 0
                 else:
-                    self.vars.fangleb = 0
-            else:
-                self.vars.fangleb = np.arctan((waypoints[self.vars.i+4][0]-x)/(waypoints[self.vars.i+4][1]-y)) + np.pi
+                    self.vars.fangleb = np.arctan((waypoints[self.vars.i+4, 0]-x)/(waypoints[self.vars.i+4, 1]-y)) + np.pi
 
 
 
-            if (waypoints[self.vars.i+5][1]-waypoints[self.vars.i+4][1] > 0):
-                self.vars.fanglec = np.arctan((waypoints[self.vars.i+5][0]-waypoints[self.vars.i+4][0])/(waypoints[self.vars.i+5][1]-waypoints[self.vars.i+4][1]))
-            elif (waypoints[self.vars.i+5][1]-waypoints[self.vars.i+4][1] == 0):
-                if (waypoints[self.vars.i+5][0]-waypoints[self.vars.i+4][0] > 0):
-                    self.vars.fanglec = np.pi/2
-                elif (waypoints[self.vars.i+5][0]-waypoints[self.vars.i+4][0] < 0):
-                    self.vars.fanglec = -np.pi/2
+                if (waypoints[self.vars.i+5, 1]-waypoints[self.vars.i+4, 1] > 0):
+                    self.vars.fanglec = np.arctan((waypoints[self.vars.i+5, 0]-waypoints[self.vars.i+4, 0])/(waypoints[self.vars.i+5, 1]-waypoints[self.vars.i+4, 1]))
+                elif (waypoints[self.vars.i+5, 1]-waypoints[self.vars.i+4, 1] == 0):
+                    if (waypoints[self.vars.i+5, 0]-waypoints[self.vars.i+4, 0] > 0):
+                        self.vars.fanglec = np.pi/2
+                    elif (waypoints[self.vars.i+5, 0]-waypoints[self.vars.i+4, 0] < 0):
+                        self.vars.fanglec = -np.pi/2
+                    else:
+                        self.vars.fanglec = 0
                 else:
-                    self.vars.fanglec = 0
-            else:
-                self.vars.fanglec = np.arctan((waypoints[self.vars.i+5][0]-waypoints[self.vars.i+4][0])/(waypoints[self.vars.i+5][1]-waypoints[self.vars.i+4][1])) + np.pi
+                    self.vars.fanglec = np.arctan((waypoints[self.vars.i+5, 0]-waypoints[self.vars.i+4, 0])/(waypoints[self.vars.i+5, 1]-waypoints[self.vars.i+4, 1])) + np.pi
 
 
 
-            if (waypoints[self.vars.i+1][1]-waypoints[self.vars.i][1] > 0):
-                self.vars.fangled = np.arctan((waypoints[self.vars.i+1][0]-waypoints[self.vars.i][0])/(waypoints[self.vars.i+1][1]-waypoints[self.vars.i][1]))
-            elif (waypoints[self.vars.i+1][1]-waypoints[self.vars.i][1] == 0):
-                if (waypoints[self.vars.i+1][0]-waypoints[self.vars.i][0] > 0):
-                    self.vars.fangled = np.pi/2
-                elif (waypoints[self.vars.i+1][0]-waypoints[self.vars.i][0] < 0):
-                    self.vars.fangled = -np.pi/2
+                if (waypoints[self.vars.i+1, 1]-waypoints[self.vars.i, 1] > 0):
+                    self.vars.fangled = np.arctan((waypoints[self.vars.i+1, 0]-waypoints[self.vars.i, 0])/(waypoints[self.vars.i+1, 1]-waypoints[self.vars.i, 1]))
+                elif (waypoints[self.vars.i+1, 1]-waypoints[self.vars.i, 1] == 0):
+                    if (waypoints[self.vars.i+1, 0]-waypoints[self.vars.i, 0] > 0):
+                        self.vars.fangled = np.pi/2
+                    elif (waypoints[self.vars.i+1, 0]-waypoints[self.vars.i, 0] < 0):
+                        self.vars.fangled = -np.pi/2
+                    else:
+                        self.vars.fangled = 0
                 else:
-                    self.vars.fangled = 0
-            else:
-                self.vars.fangled = np.arctan((waypoints[self.vars.i+1][0]-waypoints[self.vars.i][0])/(waypoints[self.vars.i+1][1]-waypoints[self.vars.i][1])) + np.pi
+                    self.vars.fangled = np.arctan((waypoints[self.vars.i+1, 0]-waypoints[self.vars.i, 0])/(waypoints[self.vars.i+1, 1]-waypoints[self.vars.i, 1])) + np.pi
+
+                self.vars.k_1 = gains['k_1']
+                self.vars.k_2 = gains['k_2']
+                self.vars.k_3 = gains['k_3']
+                self.vars.k_4 = gains['k_4']
 
-            self.vars.k_1 = 0.0022
-            self.vars.k_2 = 0.038
-            self.vars.k_3 = 0.24
-            self.vars.k_4 = 0.57
 
+                self.vars.diff_1 = self.vars.fangle-self.vars.fanglea
+                self.vars.diff_2 = self.vars.fangle-self.vars.fangleb
+                self.vars.diff_3 = self.vars.fangle-self.vars.fanglec
+                self.vars.diff_4 = self.vars.fangle-self.vars.fangled
 
-            self.vars.diff_1 = self.vars.fangle-self.vars.fanglea
-            self.vars.diff_2 = self.vars.fangle-self.vars.fangleb
-            self.vars.diff_3 = self.vars.fangle-self.vars.fanglec
-            self.vars.diff_4 = self.vars.fangle-self.vars.fangled
+                if (self.vars.fangle-self.vars.fanglea > np.pi):
+                    self.vars.diff_1 = -(2*np.pi - self.vars.fangle + self.vars.fanglea)
+                elif (self.vars.fangle-self.vars.fanglea < -np.pi):
+                    self.vars.diff_1 = self.vars.fangle - self.vars.fanglea + 2*np.pi
 
-            if (self.vars.fangle-self.vars.fanglea > np.pi):
-                self.vars.diff_1 = -(2*np.pi - self.vars.fangle + self.vars.fanglea)
-            elif (self.vars.fangle-self.vars.fanglea < -np.pi):
-                self.vars.diff_1 = self.vars.fangle - self.vars.fanglea + 2*np.pi
+                if (self.vars.fangle-self.vars.fangleb > np.pi):
+                    self.vars.diff_2 = -(2*np.pi - self.vars.fangle + self.vars.fangleb)
+                elif (self.vars.fangle - self.vars.fangleb < -np.pi):
+                    self.vars.diff_2 = self.vars.fangle - self.vars.fangleb + 2*np.pi
 
-            if (self.vars.fangle-self.vars.fangleb > np.pi):
-                self.vars.diff_2 = -(2*np.pi - self.vars.fangle + self.vars.fangleb)
-            elif (self.vars.fangle - self.vars.fangleb < -np.pi):
-                self.vars.diff_2 = self.vars.fangle - self.vars.fangleb + 2*np.pi
+                if (self.vars.fangle-self.vars.fanglec > np.pi):
+                    self.vars.diff_3 = -(2*np.pi - self.vars.fangle + self.vars.fanglec)
+                elif (self.vars.fangle-self.vars.fanglec < -np.pi):
+                    self.vars.diff_3 = self.vars.fangle - self.vars.fanglec + 2*np.pi
 
-            if (self.vars.fangle-self.vars.fanglec > np.pi):
-                self.vars.diff_3 = -(2*np.pi - self.vars.fangle + self.vars.fanglec)
-            elif (self.vars.fangle-self.vars.fanglec < -np.pi):
-                self.vars.diff_3 = self.vars.fangle - self.vars.fanglec + 2*np.pi
+                if (self.vars.fangle -self.vars.fangled > np.pi):
+                    self.vars.diff_4 = -(2*np.pi - self.vars.fangle + self.vars.fangled)
+                elif (self.vars.fangle-self.vars.fangled < -np.pi):
+                    self.vars.diff_4 = self.vars.fangle - self.vars.fangled + 2*np.pi
 
-            if (self.vars.fangle -self.vars.fangled > np.pi):
-                self.vars.diff_4 = -(2*np.pi - self.vars.fangle + self.vars.fangled)
-            elif (self.vars.fangle-self.vars.fangled < -np.pi):
-                self.vars.diff_4 = self.vars.fangle - self.vars.fangled + 2*np.pi
+                self.vars.steer_put = (self.vars.k_1*(self.vars.diff_1) + self.vars.k_2*(self.vars.diff_2) + self.vars.k_3*(self.vars.diff_3) + self.vars.k_4*(self.vars.diff_4))
+            else:
+                self.vars.fangle, self.vars.steer_put = \
+                        self._lookahead_steer(x, y, waypoints)
 
-            self.vars.steer_put = (self.vars.k_1*(self.vars.diff_1) + self.vars.k_2*(self.vars.diff_2) + self.vars.k_3*(self.vars.diff_3) + self.vars.k_4*(self.vars.diff_4))
             self.vars.diffangle = self.vars.fangle-self.vars.steer_previous
-            steer_output = self.vars.steer_put + (self.vars.prev_diffangle - self.vars.diffangle)*3
+            steer_output = self.vars.steer_put + (self.vars.prev_diffangle - self.vars.diffangle)*gains['k_steer_damping']
             if (steer_output >= 1.22):
                 steer_output = 1.22
             elif (steer_output <= -1.22):
@@ -322,6 +530,11 @@ class Controller2D(object):
             ######################################################
 
 
+            if self._mpc is not None:
+                throttle_output, steer_output, brake_output = \
+                        self._mpc_controls(x, y, yaw, v, t, throttle_output,
+                                           steer_output, brake_output)
+
             ######################################################
             # SET CONTROLS OUTPUT
             ######################################################
@@ -340,7 +553,7 @@ class Controller2D(object):
             self.vars.k = self.vars.i
             self.vars.acceleration_previous = self.vars.acceleration
             for self.vars.j in range(10):
-                if self.vars.distance >= np.sqrt(np.square(x-waypoints[self.vars.i+self.vars.j-5][0])+np.square(y-waypoints[self.vars.i+self.vars.j-5][1])):
+                if self.vars.distance >= np.sqrt(np.square(x-waypoints[self.vars.i+self.vars.j-5, 0])+np.square(y-waypoints[self.vars.i+self.vars.j-5, 1])):
                     self.vars.k = self.vars.i + self.vars.j-5
             self.vars.i = self.vars.k
             self.vars.steer_previous = self.vars.fangle
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+"""
+Batched 2D controller stepping many vehicles in one vectorized call.
+"""
+import numpy as np
+
+from Controller import DEFAULT_GAINS
+
+MAX_GATHER_ELEMENTS = 1 << 16   # waypoints gathered per chunk when searching
+                                # the desired speed of many vehicles
+
+class BatchController2D(object):
+    """ Batched 2D Controller
+
+    Runs the Controller2D.update_controls law for N vehicles at once. All
+    vehicles share one path array and track their own window into it,
+    given as [window_start, window_end) row indices. Inside its window, each
+    vehicle sees exactly the waypoint list a Controller2D would be given
+    with path[window_start:window_end], so the produced commands are the
+    same numbers the scalar controller produces for every vehicle.
+
+    The reference acceleration of the path rows (see speed_profile.py), if
+    given, is fed forward with the kff_accel gain: each vehicle takes the
+    value of its closest row, as a Controller2D given
+    reference_accel[window_start:window_end] with its window does.
+    """
+    def __init__(self, num_vehicles, path, gains=None, reference_accel=None):
+        """
+        Args:
+            num_vehicles: Number of vehicles controlled by this instance
+            path: (M, 3) array of [x, y, v] rows shared by all vehicles
+            gains: Controller gains overriding Controller.DEFAULT_GAINS,
+                   shared by all vehicles
+            reference_accel: Optional (M,) reference acceleration of the
+                             path rows
+        """
+        n = int(num_vehicles)
+        self._num_vehicles       = n
+        self._start_control_loop = np.zeros(n, dtype=bool)
+        self._desired_speed      = np.zeros(n)
+        self._desired_accel      = np.zeros(n)
+        self._set_throttle       = np.zeros(n)
+        self._set_brake          = np.zeros(n)
+        self._set_steer          = np.zeros(n)
+        self._conv_rad_to_steer  = 180.0 / 70.0 / np.pi
+        self.update_path(path, reference_accel)
+
+        # Persistent controller variables (Controller2D.vars)
+        self._v_previous            = np.zeros(n)
+        self._x_previous            = np.zeros(n)
+        self._y_previous            = np.zeros(n)
+        self._v_req_previous        = np.zeros(n)
+        self._acceleration_previous = np.zeros(n)
+        self._steer_previous        = np.zeros(n)
+        self._prev_diffangle        = np.zeros(n)
+        self._i                     = np.zeros(n, dtype=np.int64)
+
+        self._gains = dict(DEFAULT_GAINS)
+        if gains:
+            unknown = set(gains) - set(DEFAULT_GAINS)
+            if unknown:
+                raise ValueError('unknown controller gains: %s' %
+                                 ', '.join(sorted(unknown)))
+            self._gains.update(gains)
+
+    def __len__(self):
+        return self._num_vehicles
+
+    def update_path(self, path, reference_accel=None):
+        """Sets the path shared by all vehicles.
+
+        Args:
+            path: (M, 3) array of [x, y, v] rows
+            reference_accel: Optional (M,) reference acceleration of the
+                             rows, fed forward with the kff_accel gain
+        """
+        self._path   = np.asarray(path, dtype=np.float64)
+        self._path_x = np.ascontiguousarray(self._path[:, 0])
+        self._path_y = np.ascontiguousarray(self._path[:, 1])
+        self._path_accel = None
+        if reference_accel is not None:
+            self._path_accel = np.asarray(reference_accel, dtype=np.float64)
+            if self._path_accel.shape != (self._path.shape[0],):
+                raise ValueError('reference_accel needs one value per path '
+                                 'row')
+        self._desired_accel[:] = 0.0
+
+    def get_commands(self):
+        return self._set_throttle, self._set_steer, self._set_brake
+
+    @property
+    def desired_speed(self):
+        return self._desired_speed
+
+    @property
+    def desired_accel(self):
+        return self._desired_accel
+
+    def update_controls(self, x, y, yaw, speed, window_start, window_end,
+                        frame):
+        """Computes the commands of every vehicle for one control tick.
+
+        Args:
+            x: (N,) X positions in meters
+            y: (N,) Y positions in meters
+            yaw: (N,) yaw poses in radians
+            speed: (N,) forward speeds in meters per second
+            window_start: (N,) first path row of each vehicle's waypoints
+            window_end: (N,) path row after the last of each vehicle's
+                        waypoints
+            frame: Current frame number (scalar or (N,)). As in
+                   Controller2D.update_values, a vehicle starts being
+                   controlled at its first non-zero frame.
+
+        Returns: (throttle, steer, brake)
+            throttle: (N,) throttle commands [0, 1]
+            steer: (N,) steer commands [-1, 1]
+            brake: (N,) brake commands [0, 1]
+        """
+        x      = np.asarray(x, dtype=np.float64)
+        y      = np.asarray(y, dtype=np.float64)
+        v      = np.asarray(speed, dtype=np.float64)
+        start  = np.asarray(window_start, dtype=np.int64)
+        length = np.asarray(window_end, dtype=np.int64) - start
+
+        self._start_control_loop |= np.broadcast_to(
+                np.asarray(frame) != 0, (self._num_vehicles,))
+        self._update_desired_speed(x, y, start, length)
+
+        active = np.flatnonzero(self._start_control_loop)
+        if active.shape[0] == self._num_vehicles:
+            self._step(slice(None), x, y, v, start, length)
+        elif active.shape[0]:
+            self._step(active, x[active], y[active], v[active],
+                       start[active], length[active])
+        return self.get_commands()
+
+    def _update_desired_speed(self, x, y, start, length):
+        # Closest waypoint of every window, first one on ties. Short windows
+        # are padded by repeating their last row, which never wins a tie.
+        width = max(int(length.max()), 1)
+        chunk = max(1, MAX_GATHER_ELEMENTS // width)
+        offsets = np.arange(width)
+        last = start + np.maximum(length, 1) - 1
+        for lo in range(0, self._num_vehicles, chunk):
+            hi = min(lo + chunk, self._num_vehicles)
+            rows = np.minimum(start[lo:hi, None] + offsets, last[lo:hi, None])
+            dx = self._path_x[rows]
+            dx -= x[lo:hi, None]
+            dx *= dx
+            dy = self._path_y[rows]
+            dy -= y[lo:hi, None]
+            dy *= dy
+            dx += dy
+            closest = rows[np.arange(hi - lo), np.argmin(dx, axis=1)]
+            self._desired_speed[lo:hi] = self._path[closest, 2]
+            if self._path_accel is not None:
+                self._desired_accel[lo:hi] = self._path_accel[closest]
+
+    def _rows(self, sel, start, length, offset):
+        # Path rows of waypoints[i + offset] inside each window, with
+        # Python's wrap around for negative list indices
+        index = self._i[sel] + offset
+        index = np.where(index < 0, index + length, index)
+        if np.any((index < 0) | (index >= length)):
+            raise IndexError('waypoint index out of the vehicle window')
+        return self._path[start + index]
+
+    def _step(self, sel, x, y, v, start, length):
+        gains = self._gains
+        v_desired = self._desired_speed[sel]
+        desired_accel = self._desired_accel[sel]
+        v_previous = self._v_previous[sel]
+        v_req_previous = self._v_req_previous[sel]
+        acceleration_previous = self._acceleration_previous[sel]
+        x_previous = self._x_previous[sel]
+        y_previous = self._y_previous[sel]
+
+        wp_0 = self._rows(sel, start, length, 0)
+        wp_1 = self._rows(sel, start, length, 1)
+        wp_2 = self._rows(sel, start, length, 2)
+        wp_3 = self._rows(sel, start, length, 3)
+        wp_4 = self._rows(sel, start, length, 4)
+        wp_5 = self._rows(sel, start, length, 5)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Longitudinal controller
+            x_difference = x - wp_0[:, 0]
+            y_difference = y - wp_0[:, 1]
+            distance = np.sqrt(np.square(x_difference) +
+                               np.square(y_difference))
+            acceleration = np.sqrt(np.square(wp_3[:, 0] - wp_2[:, 0]) +
+                                   np.square(wp_3[:, 1] - wp_2[:, 1])) *\
+                           (wp_3[:, 2] - wp_3[:, 2]) /\
+                           (wp_3[:, 2] + wp_2[:, 2])
+            throttle_output = np.minimum(np.maximum(
+                    ((v_desired - v)*gains['kp_speed'] -
+                     (v - v_previous)*gains['kd_speed'] +
+                     (v_desired - v_req_previous)*gains['kff_speed'] +
+                     distance*gains['k_distance'] +
+                     gains['k_accel']*acceleration +
+                     gains['k_jerk']*(acceleration - acceleration_previous) +
+                     gains['kff_accel']*desired_accel),
+                    0), 1)
+            brake_output = np.minimum(np.maximum(
+                    (-0.1*((v_desired - v)*0.9 - (v - v_previous)*5 +
+                           (v_desired - v_req_previous)*6 + distance*0.1)),
+                    0), 1)
+            accelerating = v - v_desired <= 0
+            throttle_output = np.where(accelerating & (v == 0),
+                                       1.0, throttle_output)
+            brake_output = np.where(accelerating, 0.0, brake_output)
+
+            # Lateral controller
+            fangle  = _bearing(x - x_previous, y - y_previous)
+            fanglea = _bearing(wp_2[:, 0] - x, wp_2[:, 1] - y)
+            fangleb = _bearing(wp_4[:, 0] - x, wp_4[:, 1] - y)
+            fanglec = _bearing(wp_5[:, 0] - wp_4[:, 0],
+                               wp_5[:, 1] - wp_4[:, 1])
+            fangled = _bearing(wp_1[:, 0] - wp_0[:, 0],
+                               wp_1[:, 1] - wp_0[:, 1])
+
+            steer_put = gains['k_1']*_wrap_difference(fangle, fanglea) +\
+                        gains['k_2']*_wrap_difference(fangle, fangleb) +\
+                        gains['k_3']*_wrap_difference(fangle, fanglec) +\
+                        gains['k_4']*_wrap_difference(fangle, fangled)
+            diffangle = fangle - self._steer_previous[sel]
+            steer_output = steer_put +\
+                           (self._prev_diffangle[sel] - diffangle) *\
+                           gains['k_steer_damping']
+            steer_output = np.where(steer_output >= 1.22, 1.22,
+                                    np.where(steer_output <= -1.22, -1.22,
+                                             steer_output))
+
+            # Set controls output (clamped as in Controller2D.set_*)
+            self._set_throttle[sel] = np.fmax(np.fmin(throttle_output, 1.0),
+                                              0.0)
+            self._set_steer[sel] = np.fmax(np.fmin(
+                    self._conv_rad_to_steer * steer_output, 1.0), -1.0)
+            self._set_brake[sel] = np.fmax(np.fmin(brake_output, 1.0), 0.0)
+
+            # Store old values. The closest of the 10 waypoints around i
+            # (the last one on ties) becomes the next i.
+            neighbours = self._i[sel, None] + np.arange(-5, 5)
+            neighbours = np.where(neighbours < 0,
+                                  neighbours + length[:, None], neighbours)
+            if np.any((neighbours < 0) | (neighbours >= length[:, None])):
+                raise IndexError('waypoint index out of the vehicle window')
+            wp_n = self._path[start[:, None] + neighbours]
+            closer = distance[:, None] >= np.sqrt(
+                    np.square(x[:, None] - wp_n[..., 0]) +
+                    np.square(y[:, None] - wp_n[..., 1]))
+            last = 9 - np.argmax(closer[:, ::-1], axis=1)
+            self._i[sel] = np.where(closer.any(axis=1),
+                                    self._i[sel] + last - 5, self._i[sel])
+
+        self._v_previous[sel] = v
+        self._y_previous[sel] = y
+        self._x_previous[sel] = x
+        self._v_req_previous[sel] = v_desired
+        self._acceleration_previous[sel] = acceleration
+        self._steer_previous[sel] = fangle
+        self._prev_diffangle[sel] = diffangle
+
+def _bearing(dx, dy):
+    """Heading of (dx, dy) measured from the y axis, branch for branch as
+    computed by Controller2D (range [-pi/2, 3pi/2)).
+    """
+    angle = np.arctan(dx / dy)
+    return np.where(dy > 0, angle,
+                    np.where(dy == 0,
+                             np.where(dx > 0, np.pi/2,
+                                      np.where(dx < 0, -np.pi/2, 0.0)),
+                             angle + np.pi))
+
+def _wrap_difference(fangle, target):
+    """fangle - target wrapped into [-pi, pi] as in Controller2D.
+    """
+    diff = fangle - target
+    return np.where(diff > np.pi, -(2*np.pi - fangle + target),
+                    np.where(diff < -np.pi, fangle - target + 2*np.pi,
+                             diff))
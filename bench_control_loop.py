@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmarks of the waypoint follower control loop hot path.
+
+Replays a recorded trajectory (controller_output/trajectory.txt) through the
+same closest index search, lookahead windowing and Controller2D calls that
+exec_waypoint_nav_demo runs every frame. Reports per-call latency
+percentiles and memory allocated per call, and compares the median latency
+against a stored baseline so that performance regressions fail loudly.
+The control_kernel.py kernel is first checked against the NumPy law on
+the same recording (control_kernel.check_parity), a mismatch fails the run
+as well.
+"""
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+import Controller
+import control_kernel
+import path_interp
+import waypoint_nav
+
+# Path parameters, as in module_7.py
+DIST_THRESHOLD_TO_LAST_WAYPOINT = 2.0  # replay ends this close to the end
+INTERP_LOOKAHEAD_DISTANCE = 20   # lookahead in meters
+INTERP_DISTANCE_RES       = 0.01 # distance between interpolated points
+
+BENCH_DIR          = os.path.dirname(os.path.realpath(__file__))
+TRAJECTORY_FILE    = os.path.join(BENCH_DIR, 'controller_output',
+                                  'trajectory.txt')
+WAYPOINTS_FILENAME = os.path.join(BENCH_DIR, 'racetrack_waypoints.txt')
+BASELINE_FILE      = os.path.join(BENCH_DIR, 'bench_baseline.json')
+
+DEFAULT_TOLERANCE  = 0.5    # allowed relative slowdown of the median
+ALLOC_FRAMES       = 300    # frames replayed while tracing allocations
+
+BENCHMARKS = [
+    'closest_index',
+    'lookahead_window',
+    'update_waypoints',
+    'update_desired_speed',
+    'update_controls',
+]
+
+def load_inputs(trajectory_file, waypoints_file):
+    """Loads the recorded frames and the path to replay them against.
+
+    Returns: (frames, waypoints_np)
+        frames: (F, 5) array of [x, y, yaw, v, t] rows
+        waypoints_np: (N, 3) array of [x, y, v] waypoints. When the
+                      waypoint file does not exist the recorded trajectory
+                      itself is used as the path.
+    """
+    trajectory = np.loadtxt(trajectory_file, delimiter=',', ndmin=2)
+    if os.path.exists(waypoints_file):
+        waypoints_np = path_interp.read_waypoints_file(waypoints_file)
+    else:
+        waypoints_np = trajectory[:, :3].copy()
+
+    dx = np.diff(trajectory[:, 0], append=trajectory[-1, 0])
+    dy = np.diff(trajectory[:, 1], append=trajectory[-1, 1])
+    yaw = np.arctan2(dy, dx)
+    frames = np.column_stack((trajectory[:, 0], trajectory[:, 1], yaw,
+                              trajectory[:, 2], trajectory[:, 3]))
+    return frames, waypoints_np
+
+def replay(frames, waypoints_np, trace_alloc=False, kernel=None):
+    """Runs the control loop stages over the recorded frames.
+
+    Args:
+        kernel: Kernel backend of Controller2D (see set_kernel), None for
+                the NumPy implementation
+
+    Returns: (latencies, allocations)
+        latencies: Dict of per-call latencies in seconds for each benchmark
+        allocations: Dict of per-call peak allocated bytes for each
+                     benchmark (empty unless trace_alloc is set)
+    """
+    wp_interp   = path_interp.InterpolatedPath(waypoints_np,
+                                               INTERP_DISTANCE_RES)
+    wp_interp.dense()   # built at startup in the demo, not timed
+    lookahead   = waypoint_nav.LookaheadTable(wp_interp.distance,
+                                              INTERP_LOOKAHEAD_DISTANCE)
+    controller  = Controller.Controller2D(waypoints_np, kernel=kernel)
+    tracker     = waypoint_nav.ProgressTracker(waypoints_np)
+
+    latencies   = dict((name, []) for name in BENCHMARKS)
+    allocations = dict((name, []) for name in BENCHMARKS)
+    clock = time.perf_counter
+
+    def run(name, func, *args):
+        if trace_alloc:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        start = clock()
+        result = func(*args)
+        latencies[name].append(clock() - start)
+        if trace_alloc:
+            allocations[name].append(tracemalloc.get_traced_memory()[1] -
+                                     before)
+        return result
+
+    for frame, (x, y, yaw, v, t) in enumerate(frames):
+        closest_index, _ = run('closest_index', tracker.update, x, y)
+        new_waypoints = run('lookahead_window', lookahead_waypoints,
+                            wp_interp, lookahead, closest_index)
+        run('update_waypoints', controller.update_waypoints, new_waypoints)
+        controller.update_values(x, y, yaw, v, t, frame)
+        run('update_desired_speed', controller.update_desired_speed)
+        run('update_controls', controller.update_controls)
+
+        # The demo stops once the car is close to the last waypoint
+        if np.hypot(waypoints_np[-1, 0] - x, waypoints_np[-1, 1] - y) <\
+           DIST_THRESHOLD_TO_LAST_WAYPOINT:
+            break
+    return latencies, allocations
+
+def lookahead_waypoints(wp_interp, lookahead, closest_index):
+    first_index, last_index = lookahead.window(closest_index)
+    return wp_interp.window_view(first_index, last_index)
+
+def summarize(latencies, allocations):
+    results = {}
+    for name in BENCHMARKS:
+        samples = 1e6 * np.array(latencies[name])
+        results[name] = {
+            'calls':  len(samples),
+            'p50_us': float(np.percentile(samples, 50)),
+            'p90_us': float(np.percentile(samples, 90)),
+            'p99_us': float(np.percentile(samples, 99)),
+            'max_us': float(samples.max()),
+        }
+        if allocations[name]:
+            results[name]['alloc_kib'] = \
+                    float(np.mean(allocations[name])) / 1024.0
+    return results
+
+def print_results(results, baseline):
+    print('%-22s %8s %10s %10s %10s %10s %10s %12s' % (
+            'benchmark', 'calls', 'p50 (us)', 'p90 (us)', 'p99 (us)',
+            'max (us)', 'KiB/call', 'vs baseline'))
+    for name in BENCHMARKS:
+        result = results[name]
+        versus = '-'
+        if name in baseline:
+            versus = '%+.0f%%' % (100.0 * (result['p50_us'] /
+                                           baseline[name]['p50_us'] - 1.0))
+        print('%-22s %8d %10.1f %10.1f %10.1f %10.1f %10.1f %12s' % (
+                name, result['calls'], result['p50_us'], result['p90_us'],
+                result['p99_us'], result['max_us'],
+                result.get('alloc_kib', float('nan')), versus))
+
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for name in BENCHMARKS:
+        if name not in baseline:
+            continue
+        limit = baseline[name]['p50_us'] * (1.0 + tolerance)
+        if results[name]['p50_us'] > limit:
+            regressions.append((name, results[name]['p50_us'], limit))
+    return regressions
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument(
+        '--trajectory',
+        default=TRAJECTORY_FILE,
+        help='recorded "x, y, v, t" trajectory to replay')
+    argparser.add_argument(
+        '--waypoints',
+        default=WAYPOINTS_FILENAME,
+        help='waypoint file to track (default: the recorded trajectory '
+             'when racetrack_waypoints.txt is missing)')
+    argparser.add_argument(
+        '--baseline',
+        default=BASELINE_FILE,
+        help='baseline file to compare against (default: %(default)s)')
+    argparser.add_argument(
+        '--save-baseline',
+        action='store_true',
+        help='store the results as the new baseline')
+    argparser.add_argument(
+        '--tolerance',
+        default=DEFAULT_TOLERANCE,
+        type=float,
+        help='allowed relative slowdown of the median latency '
+             '(default: %(default)s)')
+    argparser.add_argument(
+        '--repeat',
+        default=3,
+        type=int,
+        help='number of times the recording is replayed (default: 3)')
+    argparser.add_argument(
+        '--kernel',
+        choices=['python', 'numba', 'auto'],
+        help='run Controller2D with a control_kernel.py backend')
+    args = argparser.parse_args()
+
+    frames, waypoints_np = load_inputs(args.trajectory, args.waypoints)
+
+    # A kernel that drifts from the NumPy law is not worth timing
+    backend = args.kernel or 'auto'
+    try:
+        num_frames, num_exact, max_difference = control_kernel.check_parity(
+                None if backend == 'auto' else backend, args.trajectory,
+                args.waypoints)
+    except AssertionError as error:
+        print('KERNEL PARITY FAILURE (%s): %s' % (backend, error),
+              file=sys.stderr)
+        return 1
+    print('kernel parity (%s): %d frames, %d bit identical, max difference '
+          '%.3g' % (backend, num_frames, num_exact, max_difference))
+
+    # Warm up, then time the replays without allocation tracing
+    replay(frames[:ALLOC_FRAMES], waypoints_np, kernel=args.kernel)
+    latencies = dict((name, []) for name in BENCHMARKS)
+    for _ in range(args.repeat):
+        run_latencies, _ = replay(frames, waypoints_np,
+                                  kernel=args.kernel)
+        for name in BENCHMARKS:
+            latencies[name].extend(run_latencies[name])
+
+    tracemalloc.start()
+    _, allocations = replay(frames[:ALLOC_FRAMES], waypoints_np,
+                            trace_alloc=True, kernel=args.kernel)
+    tracemalloc.stop()
+
+    results = summarize(latencies, allocations)
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_results(results, baseline)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write('\n')
+        print('Baseline written to %s' % args.baseline)
+        return 0
+
+    regressions = find_regressions(results, baseline, args.tolerance)
+    for name, p50, limit in regressions:
+        print('PERFORMANCE REGRESSION: %s p50 %.1f us exceeds %.1f us' %
+              (name, p50, limit), file=sys.stderr)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the per-tick nearest waypoint lookup in Controller2D.
+
+Compares the vectorized scan of Controller2D.update_desired_speed
+(waypoint_index.nearest_waypoint) with the Python loop it used to run, for
+waypoint counts from 10^2 to 10^6. The waypoint window of the controller
+holds about 2000 points (INTERP_LOOKAHEAD_DISTANCE / INTERP_DISTANCE_RES).
+"""
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import time
+import numpy as np
+
+import waypoint_index
+
+WAYPOINT_SPACING = 0.5      # distance between synthetic waypoints in meters
+LATERAL_NOISE    = 1.0      # max offset of query positions from the path
+NUM_QUERIES      = 200      # number of queries timed per waypoint count
+
+def make_waypoints(num_points, seed=0):
+    """Generates a smooth synthetic track as [[x0, y0, v0], ...].
+    """
+    rng = np.random.RandomState(seed)
+    smoothing = min(50, num_points)
+    turn_rate = np.convolve(rng.uniform(-0.05, 0.05, num_points),
+                            np.ones(smoothing) / smoothing, mode='same')
+    heading = np.cumsum(turn_rate)
+    x = np.cumsum(WAYPOINT_SPACING * np.cos(heading))
+    y = np.cumsum(WAYPOINT_SPACING * np.sin(heading))
+    v = np.full(num_points, 10.0)
+    return np.column_stack((x, y, v)).tolist()
+
+def make_queries(waypoints, num_queries, seed=1):
+    rng = np.random.RandomState(seed)
+    waypoints_np = np.array(waypoints)
+    rows = rng.randint(0, len(waypoints), num_queries)
+    offsets = rng.uniform(-LATERAL_NOISE, LATERAL_NOISE, (num_queries, 2))
+    return waypoints_np[rows, :2] + offsets
+
+def linear_nearest(waypoints, x, y):
+    """The linear scan previously done in update_desired_speed.
+    """
+    min_idx  = 0
+    min_dist = float("inf")
+    for i in range(len(waypoints)):
+        dist = np.linalg.norm(np.array([
+                waypoints[i][0] - x,
+                waypoints[i][1] - y]))
+        if dist < min_dist:
+            min_dist = dist
+            min_idx = i
+    return min_idx
+
+def time_queries(lookup, queries):
+    start = time.perf_counter()
+    for x, y in queries:
+        lookup(x, y)
+    return (time.perf_counter() - start) / len(queries)
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument(
+        '--max-linear-points',
+        metavar='N',
+        default=10**5,
+        type=int,
+        help='largest waypoint count timed with the linear scan '
+             '(default: 100000)')
+    argparser.add_argument(
+        '--queries',
+        metavar='Q',
+        default=NUM_QUERIES,
+        type=int,
+        help='queries timed per waypoint count (default: %d)' % NUM_QUERIES)
+    args = argparser.parse_args()
+
+    print('%10s %14s %14s' % ('waypoints', 'scan (us/tick)',
+                              'loop (us/tick)'))
+    for exponent in range(2, 7):
+        num_points = 10**exponent
+        waypoints = make_waypoints(num_points)
+        waypoints_np = np.array(waypoints)
+        queries = make_queries(waypoints, args.queries)
+
+        scan_time = time_queries(
+                lambda x, y: waypoint_index.nearest_waypoint(waypoints_np,
+                                                             x, y),
+                queries)
+
+        linear = '-'
+        if num_points <= args.max_linear_points:
+            # The linear scan is slow, only time a few queries
+            linear_queries = queries[:max(1, args.queries * 100 // num_points)]
+            for x, y in linear_queries:
+                expected = linear_nearest(waypoints, x, y)
+                assert waypoint_index.nearest_waypoint(waypoints_np,
+                                                       x, y) == expected
+            linear = '%.1f' % (1e6 * time_queries(
+                    lambda x, y: linear_nearest(waypoints, x, y),
+                    linear_queries))
+
+        print('%10d %14.1f %14s' % (num_points, 1e6 * scan_time, linear))
+
+if __name__ == '__main__':
+    main()
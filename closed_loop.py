@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+
+"""
+Headless closed-loop episodes of the waypoint follower.
+
+Runs the exec_waypoint_nav_demo control loop (localization, lookahead
+windowing and Controller2D) against the local kinematic simulator, without
+plotting, and reports how well the path was tracked.
+"""
+import collections
+import os
+import numpy as np
+
+import Controller
+import kinematic_sim
+import path_interp
+import route_store
+import spline_path
+import speed_profile
+import stage_profile
+import telemetry
+import episode_history
+import waypoint_nav
+
+# Episode parameters, as in module_7.py
+WAIT_TIME_BEFORE_START = 5.00   # game seconds (time before controller start)
+TOTAL_RUN_TIME         = 200.00 # game seconds (total runtime before sim end)
+TOTAL_FRAME_BUFFER     = 300    # number of frames to buffer after total runtime
+DIST_THRESHOLD_TO_LAST_WAYPOINT = 2.0  # some distance from last position before
+                                       # simulation ends
+INTERP_LOOKAHEAD_DISTANCE = 20   # lookahead in meters
+INTERP_LOOKAHEAD_TIME     = 0.0  # extra lookahead in seconds at the
+                                 # waypoint speed (0 for a fixed lookahead)
+INTERP_DISTANCE_RES       = 0.01 # distance between interpolated points
+
+# Stages of ControlPipeline.step (see stage_profile.py)
+PIPELINE_STAGES = ['closest_index', 'lookahead_window', 'update_controls']
+STAGE_CLOSEST_INDEX, STAGE_LOOKAHEAD_WINDOW, STAGE_UPDATE_CONTROLS = \
+        range(len(PIPELINE_STAGES))
+
+EPISODE_DIR        = os.path.dirname(os.path.realpath(__file__))
+WAYPOINTS_FILENAME = os.path.join(EPISODE_DIR, 'racetrack_waypoints.txt')
+TRAJECTORY_FILE    = os.path.join(EPISODE_DIR, 'controller_output',
+                                  'trajectory.txt')
+
+EpisodeResult = collections.namedtuple('EpisodeResult', [
+    'reached_the_end',  # whether the car got close to the last waypoint
+    'completion_time',  # game seconds after the start delay (None if not
+                        # reached)
+    'mean_error',       # mean distance from the car to the path (m)
+    'max_error',        # max distance from the car to the path (m)
+    'x_history',        # car x per controlled frame
+    'y_history',        # car y per controlled frame
+    'speed_history',    # car forward speed per controlled frame
+    'time_history',     # game seconds after the start delay
+])
+
+def load_track(waypoints_file=WAYPOINTS_FILENAME):
+    """Loads a waypoint file, or the recorded trajectory if it is missing.
+
+    Returns: waypoints_np
+        waypoints_np: (N, 3) array of [x, y, v] waypoints
+    """
+    if os.path.exists(waypoints_file):
+        return path_interp.read_waypoints_file(waypoints_file)
+    trajectory = np.loadtxt(TRAJECTORY_FILE, delimiter=',', ndmin=2)
+    return trajectory[:, :3].copy()
+
+def distance_to_path(waypoints_np, closest_index, x, y):
+    """Distance from (x, y) to the path segments around closest_index.
+    """
+    best = np.hypot(waypoints_np[closest_index, 0] - x,
+                    waypoints_np[closest_index, 1] - y)
+    for i in (closest_index - 1, closest_index):
+        if i < 0 or i + 1 >= waypoints_np.shape[0]:
+            continue
+        seg_x = waypoints_np[i+1, 0] - waypoints_np[i, 0]
+        seg_y = waypoints_np[i+1, 1] - waypoints_np[i, 1]
+        seg_len2 = seg_x**2 + seg_y**2
+        if seg_len2 == 0:
+            continue
+        u = ((x - waypoints_np[i, 0]) * seg_x +
+             (y - waypoints_np[i, 1]) * seg_y) / seg_len2
+        u = min(max(u, 0.0), 1.0)
+        best = min(best, np.hypot(waypoints_np[i, 0] + u * seg_x - x,
+                                  waypoints_np[i, 1] + u * seg_y - y))
+    return best
+
+class ControlPipeline(object):
+    """ Control Pipeline
+
+    The per-frame work of the control loop, run by exec_waypoint_nav_demo
+    and the headless tools alike: localization on the path
+    (waypoint_nav.ProgressTracker), the lookahead window of the
+    interpolated (or spline) path and Controller2D. Each
+    step() takes one measurement and returns the commands, marking the
+    PIPELINE_STAGES of an optional stage_profile.StageProfiler (the caller
+    starts and ends its frames).
+    """
+    def __init__(self, waypoints_np, gains=None, lookahead=None,
+                 spline=False, profile=False, mpc=None, kernel=None,
+                 paged=False, profiler=None, stage_offset=0, wp_interp=None,
+                 route=None, controller_class=None,
+                 lookahead_distance=INTERP_LOOKAHEAD_DISTANCE,
+                 lookahead_time=INTERP_LOOKAHEAD_TIME,
+                 resolution=INTERP_DISTANCE_RES):
+        """
+        Args:
+            waypoints_np: (N, 3) array of [x, y, v] waypoints (None with a
+                          route)
+            gains, lookahead, spline, profile, mpc, kernel, paged: See
+                run_episode
+            profiler: Optional stage_profile.StageProfiler over
+                      PIPELINE_STAGES, or over more stages with
+                      PIPELINE_STAGES starting at stage_offset
+            stage_offset: Profiler stage index of PIPELINE_STAGES[0]
+            wp_interp: Optional path_interp.InterpolatedPath of
+                       waypoints_np at the resolution (e.g. the memory-mapped
+                       path of path_interp.load_compiled_path), built when
+                       omitted. Not used with profile, which changes the
+                       waypoint speeds, nor when paged.
+            route: Optional route_store.RouteStore of the waypoints (see
+                   route_store.RouteStore.open), used when paged and closed
+                   by the caller. Built from waypoints_np when omitted,
+                   which needs the whole route in memory.
+            controller_class: Controller2D class to run (default:
+                              Controller.Controller2D)
+            lookahead_distance: Lookahead distance of the windows at
+                                standstill in meters
+            lookahead_time: Extra lookahead in seconds at the waypoint speed
+            resolution: Distance between interpolated points in meters
+        """
+        if paged and (spline or profile):
+            raise ValueError('the paged route does not support the spline '
+                             'path nor the speed profile')
+        if controller_class is None:
+            controller_class = Controller.Controller2D
+        self.resolution   = float(resolution)
+        self.wp_accel     = None
+        self.spline_wp    = None
+        self._own_route   = None     # route built here, closed by close()
+        if paged:
+            # The route store stands in for both the lookahead table and
+            # the dense path windows, nothing is built over the whole route
+            if route is None:
+                route = route_store.RouteStore(
+                        path_interp.InterpolatedPath(
+                                np.asarray(waypoints_np, dtype=np.float64),
+                                self.resolution).to_table(),
+                        self.resolution, lookahead_distance, lookahead_time)
+                self._own_route = route
+            self.waypoints_np     = route.waypoints
+            self.wp_interp        = route
+            self.lookahead_table  = route
+            self.progress_tracker = route_store.PagedProgressTracker(route)
+            self.controller       = controller_class(
+                    route.window_view(*route.window(0)), gains, lookahead,
+                    mpc, kernel)
+        else:
+            waypoints_np = np.asarray(waypoints_np, dtype=np.float64)
+            wp_accel     = None
+            if profile:
+                waypoints_np, wp_accel = speed_profile.profile_waypoints(
+                        waypoints_np)
+            self.waypoints_np = waypoints_np
+            if wp_interp is None or profile:
+                wp_interp = path_interp.InterpolatedPath(waypoints_np,
+                                                         self.resolution)
+            self.wp_interp    = wp_interp
+            if wp_accel is not None:
+                self.wp_accel = self.wp_interp.expand(wp_accel)
+            if spline:
+                self.spline_wp = spline_path.SplinePath(waypoints_np)
+            else:
+                # Dense points built (or mapped) once here, the windows are
+                # views of them
+                self.wp_interp.dense()
+            self.lookahead_table  = waypoint_nav.LookaheadTable(
+                    self.wp_interp.distance,
+                    waypoint_nav.lookahead_distances(waypoints_np,
+                                                     lookahead_distance,
+                                                     lookahead_time))
+            self.progress_tracker = waypoint_nav.ProgressTracker(waypoints_np)
+            self.controller       = controller_class(waypoints_np, gains,
+                                                     lookahead, mpc, kernel)
+        if profiler is None:
+            profiler = stage_profile.StageProfiler(PIPELINE_STAGES,
+                                                   enabled=False)
+        self.profiler     = profiler
+        self._stages      = [stage_offset + stage for stage in
+                             range(len(PIPELINE_STAGES))]
+        self.waypoint_window = None     # waypoints of the last step
+
+    def step(self, x, y, yaw, speed, timestamp, frame):
+        """Runs the pipeline on one measurement.
+
+        Returns: (throttle, steer, brake, closest_index)
+        """
+        profiler = self.profiler
+        stages   = self._stages
+        closest_index, _ = self.progress_tracker.update(x, y)
+        profiler.mark(stages[STAGE_CLOSEST_INDEX])
+        first_index, last_index = self.lookahead_table.window(closest_index)
+        reference_accel = None
+        if self.spline_wp is None:
+            new_waypoints = self.wp_interp.window_view(first_index,
+                                                       last_index)
+            if self.wp_accel is not None:
+                reference_accel = self.wp_accel[
+                        self.wp_interp.hash[first_index]:
+                        self.wp_interp.hash[last_index] + 1]
+        else:
+            new_waypoints = self.spline_wp.waypoint_window(
+                    first_index, last_index, self.resolution)
+        self.waypoint_window = new_waypoints
+        controller = self.controller
+        controller.update_waypoints(new_waypoints, reference_accel)
+        profiler.mark(stages[STAGE_LOOKAHEAD_WINDOW])
+        controller.update_values(x, y, yaw, speed, timestamp, frame)
+        controller.update_controls()
+        throttle, steer, brake = controller.get_commands()
+        profiler.mark(stages[STAGE_UPDATE_CONTROLS])
+        return throttle, steer, brake, closest_index
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Releases the paged route built by the pipeline, its prefetch
+        thread and pages (the pipeline can no longer step).
+        """
+        if self._own_route is not None:
+            self._own_route.close()
+            self._own_route = None
+
+    def reached_the_end(self, x, y):
+        """Whether (x, y) is close enough to the last waypoint to stop.
+        """
+        return np.hypot(self.waypoints_np[-1, 0] - x,
+                        self.waypoints_np[-1, 1] - y) <\
+               DIST_THRESHOLD_TO_LAST_WAYPOINT
+
+def run_episode(waypoints_np, gains=None, lookahead=None, spline=False,
+                profile=False, mpc=None, kernel=None, paged=False,
+                route=None, time_step=kinematic_sim.SIM_TIME_STEP,
+                total_run_time=TOTAL_RUN_TIME):
+    """Runs one closed-loop episode against the kinematic simulator.
+
+    Args:
+        waypoints_np: (N, 3) array of [x, y, v] waypoints (None with a
+                      route)
+        gains: Controller gains overriding Controller.DEFAULT_GAINS
+        lookahead: Lookahead points of the vectorized lateral mode (see
+                   Controller.Controller2D)
+        spline: Sample the waypoint windows from a cubic spline path
+                (spline_path.SplinePath) instead of the linear one
+        profile: Track the curvature-aware speed profile of the path
+                 (speed_profile.py) instead of the waypoint speeds
+        mpc: Optional mpc.MPCSolver, runs the controller in the model
+             predictive mode
+        kernel: Kernel backend of the controller law (see
+                Controller.Controller2D.set_kernel)
+        paged: Localize and window through a paged route store
+               (route_store.py) instead of the whole-route tables
+        route: Optional route_store.RouteStore of the waypoints, opened
+               by the caller (see ControlPipeline)
+        time_step: Simulator time step in seconds
+        total_run_time: Game seconds before the episode is stopped
+
+    Returns: EpisodeResult
+    """
+    with ControlPipeline(waypoints_np, gains, lookahead, spline, profile, mpc,
+                         kernel, paged, route=route) as pipeline:
+        waypoints_np = pipeline.waypoints_np
+        client       = kinematic_sim.make_kinematic_client(
+                kinematic_sim.start_transform_from_waypoints(waypoints_np),
+                time_step)
+
+        total_episode_frames = int((total_run_time + WAIT_TIME_BEFORE_START) /
+                                   time_step) + TOTAL_FRAME_BUFFER
+        history = episode_history.HistoryBuffer(telemetry.TELEMETRY_DTYPE,
+                                                total_episode_frames)
+        errors  = []
+
+        reached_the_end = False
+        for frame in range(total_episode_frames):
+            measurement_data, _ = client.read_data()
+            transform     = measurement_data.player_measurements.transform
+            current_x     = transform.location.x
+            current_y     = transform.location.y
+            current_yaw   = np.radians(transform.rotation.yaw)
+            current_speed = measurement_data.player_measurements.forward_speed
+            current_timestamp = float(measurement_data.game_timestamp) / 1000.0
+
+            if current_timestamp <= WAIT_TIME_BEFORE_START:
+                client.send_control(kinematic_sim.VehicleControl(brake=1.0))
+                continue
+            current_timestamp = current_timestamp - WAIT_TIME_BEFORE_START
+
+            cmd_throttle, cmd_steer, cmd_brake, closest_index = pipeline.step(
+                    current_x, current_y, current_yaw, current_speed,
+                    current_timestamp, frame)
+            client.send_control(kinematic_sim.VehicleControl(
+                    throttle=cmd_throttle, steer=cmd_steer, brake=cmd_brake))
+
+            history.append(frame, current_timestamp, current_x, current_y,
+                           current_yaw, current_speed, cmd_throttle, cmd_steer,
+                           cmd_brake, pipeline.controller._desired_speed,
+                           closest_index)
+            errors.append(distance_to_path(waypoints_np, closest_index,
+                                           current_x, current_y))
+
+            if pipeline.reached_the_end(current_x, current_y):
+                reached_the_end = True
+                break
+
+    errors = np.array(errors) if errors else np.array([np.inf])
+    return EpisodeResult(
+            reached_the_end=reached_the_end,
+            completion_time=(float(history.last('time')) if reached_the_end
+                             else None),
+            mean_error=float(np.mean(errors)),
+            max_error=float(np.max(errors)),
+            x_history=history.view('x'),
+            y_history=history.view('y'),
+            speed_history=history.view('speed'),
+            time_history=history.view('time'))
@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+
+"""
+Scalar kernel of the Controller2D.update_controls law.
+
+The default longitudinal and lateral laws of Controller2D are computed in
+one function over plain floats and the math module, instead of NumPy
+scalar calls and self.vars attribute traffic. The function takes the
+waypoint window, the persistent controller variables packed in a list or
+array (KERNEL_STATE) and the packed gains (KERNEL_GAINS), updates the
+state in place and returns the three commands.
+
+When Numba is installed the same source is compiled with numba.njit,
+otherwise the pure Python version is used. The math module and NumPy's
+vectorized arctan may round a few results differently in the last bit, so
+the kernel matches the NumPy controller within KERNEL_TOLERANCE rather
+than bit for bit (check_parity() measures it on a recorded trajectory).
+
+Usage:
+    python control_kernel.py [--backend python|numba]
+"""
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import math
+import sys
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Persistent controller variables carried between ticks, in kernel order
+KERNEL_STATE = (
+    'v_previous',
+    'x_previous',
+    'y_previous',
+    'v_req_previous',
+    'acceleration_previous',
+    'steer_previous',
+    'prev_diffangle',
+    'i',
+)
+
+# Gains used by the kernel, in kernel order
+KERNEL_GAINS = (
+    'kp_speed',
+    'kd_speed',
+    'kff_speed',
+    'k_distance',
+    'k_accel',
+    'k_jerk',
+    'kff_accel',
+    'k_1',
+    'k_2',
+    'k_3',
+    'k_4',
+    'k_steer_damping',
+)
+
+KERNEL_TOLERANCE = 1e-9     # max command difference to the NumPy controller
+
+def _identity(function):
+    return function
+
+def _make_kernel(jit):
+    """Builds the kernel functions with a decorator (numba.njit or none).
+    """
+    @jit
+    def divide(a, b):
+        # IEEE division (inf or nan on a zero divisor), as in NumPy
+        if b == 0.0:
+            if a == 0.0 or a != a:
+                return math.nan
+            return math.copysign(math.inf, a) * math.copysign(1.0, b)
+        return a / b
+
+    @jit
+    def clip(value, lower, upper):
+        # np.minimum(np.maximum(value, lower), upper), nan propagates
+        if value != value:
+            return value
+        return min(max(value, lower), upper)
+
+    @jit
+    def bearing(dx, dy):
+        # Heading of (dx, dy) from the y axis in [-pi/2, 3pi/2), branch for
+        # branch as computed by Controller2D
+        if dy > 0:
+            return math.atan(dx / dy)
+        elif dy == 0:
+            if dx > 0:
+                return math.pi/2
+            elif dx < 0:
+                return -math.pi/2
+            return 0.0
+        return math.atan(dx / dy) + math.pi
+
+    @jit
+    def wrap_difference(fangle, target):
+        # fangle - target wrapped into [-pi, pi] as in Controller2D
+        if fangle - target > math.pi:
+            return -(2*math.pi - fangle + target)
+        elif fangle - target < -math.pi:
+            return fangle - target + 2*math.pi
+        return fangle - target
+
+    @jit
+    def update_controls(waypoints, state, x, y, v, v_desired, desired_accel,
+                        gains):
+        v_previous            = state[0]
+        x_previous            = state[1]
+        y_previous            = state[2]
+        v_req_previous        = state[3]
+        acceleration_previous = state[4]
+        steer_previous        = state[5]
+        prev_diffangle        = state[6]
+        i                     = int(state[7])
+
+        x0 = float(waypoints[i, 0])
+        y0 = float(waypoints[i, 1])
+        x1 = float(waypoints[i+1, 0])
+        y1 = float(waypoints[i+1, 1])
+        x2 = float(waypoints[i+2, 0])
+        y2 = float(waypoints[i+2, 1])
+        v2 = float(waypoints[i+2, 2])
+        x3 = float(waypoints[i+3, 0])
+        y3 = float(waypoints[i+3, 1])
+        v3 = float(waypoints[i+3, 2])
+        x4 = float(waypoints[i+4, 0])
+        y4 = float(waypoints[i+4, 1])
+        x5 = float(waypoints[i+5, 0])
+        y5 = float(waypoints[i+5, 1])
+
+        # Longitudinal controller
+        x_difference = x - x0
+        y_difference = y - y0
+        distance = math.sqrt(x_difference*x_difference +
+                             y_difference*y_difference)
+        acceleration = divide(math.sqrt((x3 - x2)*(x3 - x2) +
+                                        (y3 - y2)*(y3 - y2)) * (v3 - v3),
+                              v3 + v2)
+        throttle_output = clip((v_desired - v)*gains[0] -
+                               (v - v_previous)*gains[1] +
+                               (v_desired - v_req_previous)*gains[2] +
+                               distance*gains[3] + gains[4]*acceleration +
+                               gains[5]*(acceleration -
+                                         acceleration_previous) +
+                               gains[6]*desired_accel, 0.0, 1.0)
+        brake_output = 0.0
+        if v - v_desired <= 0:
+            if v == 0:
+                throttle_output = 1.0
+        else:
+            brake_output = clip(-0.1*((v_desired - v)*0.9 -
+                                      (v - v_previous)*5 +
+                                      (v_desired - v_req_previous)*6 +
+                                      distance*0.1), 0.0, 1.0)
+
+        # Lateral controller
+        fangle  = bearing(x - x_previous, y - y_previous)
+        fanglea = bearing(x2 - x, y2 - y)
+        fangleb = bearing(x4 - x, y4 - y)
+        fanglec = bearing(x5 - x4, y5 - y4)
+        fangled = bearing(x1 - x0, y1 - y0)
+        steer_put = (gains[7]*wrap_difference(fangle, fanglea) +
+                     gains[8]*wrap_difference(fangle, fangleb) +
+                     gains[9]*wrap_difference(fangle, fanglec) +
+                     gains[10]*wrap_difference(fangle, fangled))
+        diffangle = fangle - steer_previous
+        steer_output = steer_put + (prev_diffangle - diffangle)*gains[11]
+        if steer_output >= 1.22:
+            steer_output = 1.22
+        elif steer_output <= -1.22:
+            steer_output = -1.22
+
+        # Store old values. The last of the 10 waypoints around i that is
+        # not farther than waypoint i becomes the next i.
+        k = i
+        for j in range(10):
+            row = i + j - 5
+            dx  = x - float(waypoints[row, 0])
+            dy  = y - float(waypoints[row, 1])
+            if distance >= math.sqrt(dx*dx + dy*dy):
+                k = row
+        state[0] = v
+        state[1] = x
+        state[2] = y
+        state[3] = v_desired
+        state[4] = acceleration
+        state[5] = fangle
+        state[6] = diffangle
+        state[7] = k
+        return throttle_output, steer_output, brake_output
+
+    return update_controls
+
+python_kernel = _make_kernel(_identity)
+
+_compiled_kernel = None
+
+def compiled_kernel():
+    """Returns the Numba compiled kernel, or None without Numba.
+
+    The kernel is compiled on the first call for the argument types.
+    """
+    global _compiled_kernel
+    if numba is None:
+        return None
+    if _compiled_kernel is None:
+        _compiled_kernel = _make_kernel(numba.njit(boundscheck=True))
+    return _compiled_kernel
+
+def get_kernel(backend):
+    """Returns the kernel of a backend.
+
+    Args:
+        backend: 'python', 'numba' or 'auto' (numba when installed, else
+                 python)
+
+    Returns: (kernel, compiled)
+        kernel: Kernel function (see _make_kernel update_controls)
+        compiled: Whether it is the Numba kernel, which takes the state and
+                  the gains as float64 arrays (lists for the Python one)
+    """
+    if backend not in ('python', 'numba', 'auto'):
+        raise ValueError('unknown kernel backend %r' % (backend,))
+    if backend != 'python':
+        kernel = compiled_kernel()
+        if kernel is not None:
+            return kernel, True
+        if backend == 'numba':
+            raise ImportError('the numba kernel backend needs numba')
+    return python_kernel, False
+
+def pack_gains(gains, compiled=False):
+    """Packs a gains dict (see Controller.DEFAULT_GAINS) in kernel order,
+    as a float64 array for the compiled kernel or a list of floats.
+    """
+    packed = [float(gains[name]) for name in KERNEL_GAINS]
+    if compiled:
+        return np.array(packed)
+    return packed
+
+def check_parity(backend=None, trajectory_file=None, waypoints_file=None,
+                 tolerance=KERNEL_TOLERANCE):
+    """Replays a recorded trajectory through two controllers, one with the
+    kernel and one with the NumPy law, and compares their commands.
+
+    Runs with every bench_control_loop.py run, so a kernel change that
+    drifts from the NumPy law fails the benchmark gate.
+
+    Args:
+        backend: 'python', 'numba' or None for the default kernel
+        trajectory_file: Recorded trajectory replayed (default: the one of
+                         bench_control_loop.py)
+        waypoints_file: Waypoint file of the path (default: the one of
+                        bench_control_loop.py)
+        tolerance: Max allowed command difference, AssertionError above it
+                   (None to only measure)
+
+    Returns: (num_frames, num_exact, max_difference)
+        num_frames: Number of controlled frames compared
+        num_exact: Number of frames with bit identical commands
+        max_difference: Largest difference of a command
+    """
+    # Imported here, Controller imports this module
+    import Controller
+    import bench_control_loop
+
+    if trajectory_file is None:
+        trajectory_file = bench_control_loop.TRAJECTORY_FILE
+    if waypoints_file is None:
+        waypoints_file = bench_control_loop.WAYPOINTS_FILENAME
+    frames, waypoints_np = bench_control_loop.load_inputs(trajectory_file,
+                                                          waypoints_file)
+    wp_interp = bench_control_loop.path_interp.InterpolatedPath(
+            waypoints_np, bench_control_loop.INTERP_DISTANCE_RES)
+    lookahead = bench_control_loop.waypoint_nav.LookaheadTable(
+            wp_interp.distance, bench_control_loop.INTERP_LOOKAHEAD_DISTANCE)
+    tracker   = bench_control_loop.waypoint_nav.ProgressTracker(waypoints_np)
+    reference = Controller.Controller2D(waypoints_np)
+    kernel    = Controller.Controller2D(waypoints_np)
+    kernel.set_kernel(backend or 'auto')
+
+    num_frames = 0
+    num_exact  = 0
+    max_difference = 0.0
+    for frame, (x, y, yaw, v, t) in enumerate(frames):
+        closest_index, _ = tracker.update(x, y)
+        new_waypoints = bench_control_loop.lookahead_waypoints(
+                wp_interp, lookahead, closest_index)
+        commands = []
+        for controller in (reference, kernel):
+            controller.update_waypoints(new_waypoints)
+            controller.update_values(x, y, yaw, v, t, frame)
+            controller.update_controls()
+            commands.append(np.array(controller.get_commands(),
+                                     dtype=np.float64))
+        if frame:
+            difference = np.abs(commands[0] - commands[1])
+            num_frames += 1
+            num_exact  += bool(np.all(commands[0] == commands[1]))
+            max_difference = max(max_difference, float(np.max(difference)))
+
+        # The replay stops once the car is close to the last waypoint
+        if np.hypot(waypoints_np[-1, 0] - x, waypoints_np[-1, 1] - y) <\
+           bench_control_loop.DIST_THRESHOLD_TO_LAST_WAYPOINT:
+            break
+    if tolerance is not None and not max_difference <= tolerance:
+        raise AssertionError(
+                'kernel commands differ from the NumPy controller by %.3g '
+                '(tolerance %.3g) over %d frames' %
+                (max_difference, tolerance, num_frames))
+    return num_frames, num_exact, max_difference
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument(
+        '--backend',
+        choices=['python', 'numba'],
+        help='kernel to check (default: numba when installed)')
+    argparser.add_argument(
+        '--tolerance',
+        type=float,
+        default=KERNEL_TOLERANCE,
+        help='max allowed command difference (default: %(default)s)')
+    args = argparser.parse_args()
+
+    if args.backend == 'numba' and numba is None:
+        argparser.error('numba is not installed')
+    num_frames, num_exact, max_difference = check_parity(args.backend,
+                                                         tolerance=None)
+    print('backend: %s' % (args.backend or
+                           ('numba' if numba is not None else 'python')))
+    print('frames: %d, bit identical: %d, max difference: %.3g' %
+          (num_frames, num_exact, max_difference))
+    if max_difference > args.tolerance:
+        print('parity check failed (tolerance %.3g)' % args.tolerance)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
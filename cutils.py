@@ -5,3 +5,43 @@ class CUtils(object):
     def create_var(self, var_name, value):
         if not var_name in self.__dict__:
             self.__dict__[var_name] = value
+
+class CVars(object):
+    """Fixed layout persistent variables.
+
+    Variables declared in the layout live in __slots__ and are created once
+    with their default values, so there is no per-iteration create_var cost
+    and no dict lookup when they are accessed. create_var keeps working for
+    variables outside the layout, which are stored in a regular __dict__.
+    """
+    __slots__   = ('__dict__',)
+    _layout     = ()
+    _slot_names = frozenset()
+
+    def __init__(self):
+        for var_name, value in self._layout:
+            setattr(self, var_name, value)
+
+    def create_var(self, var_name, value):
+        if not var_name in self._slot_names and \
+           not var_name in self.__dict__:
+            self.__dict__[var_name] = value
+
+_vars_classes = {}
+
+def make_vars(layout):
+    """Creates a CVars instance for a layout of (name, default) pairs.
+
+    Example: self.vars = make_vars([('v_previous', 0.0), ('i', 0)])
+    """
+    layout = tuple(layout)
+    cls = _vars_classes.get(layout)
+    if cls is None:
+        slot_names = tuple(var_name for var_name, _ in layout)
+        cls = type('CVars', (CVars,), {
+            '__slots__':   slot_names,
+            '_layout':     layout,
+            '_slot_names': frozenset(slot_names),
+        })
+        _vars_classes[layout] = cls
+    return cls()
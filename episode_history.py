@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+"""
+Preallocated per-frame history of an episode.
+
+Signals are stored as records of a NumPy structured dtype (for example
+telemetry.TELEMETRY_DTYPE) in one preallocated array, so appending a frame
+does not box a Python float per signal and readers get plain array views
+of the recorded frames without copying.
+"""
+import numpy as np
+
+class HistoryBuffer(object):
+    """ History Buffer
+
+    In the default (growable) mode the buffer keeps every record and doubles
+    its storage when it is full. In ring mode it keeps the last capacity
+    records: every record is written twice, at i % capacity and at
+    i % capacity + capacity, so that the last records are always one
+    contiguous slice of the storage and view() never has to copy.
+
+    Views stay valid while records are appended, but a growable buffer
+    that reallocates leaves earlier views pointing at the old storage.
+    """
+    def __init__(self, dtype, capacity, ring=False):
+        """
+        Args:
+            dtype: Structured dtype of one record
+            capacity: Number of records preallocated (growable mode) or
+                      kept (ring mode)
+            ring: Keep only the last capacity records
+        """
+        if capacity < 1:
+            raise ValueError('capacity must be positive, got %d' % capacity)
+        self.dtype    = np.dtype(dtype)
+        self.capacity = int(capacity)
+        self.ring     = bool(ring)
+        self._data    = np.zeros(2*self.capacity if self.ring
+                                 else self.capacity, dtype=self.dtype)
+        self._start   = 0   # storage index of the oldest record
+        self._count   = 0   # number of records available
+        self.num_appended = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, *values):
+        """Appends one record given as the values of the dtype fields.
+        """
+        if self.ring:
+            position = self.num_appended % self.capacity
+            self._data[position] = values
+            self._data[position + self.capacity] = values
+            self.num_appended += 1
+            self._count = min(self.num_appended, self.capacity)
+            self._start = (self.num_appended - self._count) % self.capacity
+        else:
+            if self._count == self._data.shape[0]:
+                data = np.zeros(2*self._data.shape[0], dtype=self.dtype)
+                data[:self._count] = self._data
+                self._data = data
+            self._data[self._count] = values
+            self._count += 1
+            self.num_appended += 1
+
+    def view(self, field=None):
+        """Returns the available records, oldest first, without copying.
+
+        Args:
+            field: Name of a single field to return, or None for the
+                   structured records
+
+        Returns: Array view of the records (or of one of their fields)
+        """
+        records = self._data[self._start:self._start + self._count]
+        if field is None:
+            return records
+        return records[field]
+
+    def last(self, field=None):
+        """Returns the newest record (or one of its fields).
+        """
+        if not self._count:
+            raise IndexError('history is empty')
+        record = self._data[self._start + self._count - 1]
+        if field is None:
+            return record
+        return record[field]
+
+    def clear(self):
+        self._start = 0
+        self._count = 0
+        self.num_appended = 0
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+"""
+Parallel sweep of the Controller2D gains.
+
+Evaluates a grid or a random sample of gain sets with one headless
+closed-loop episode each (closed_loop.run_episode), spread over a process
+pool, and prints the gain sets ranked by tracking error and completion time.
+
+Examples:
+    gain_sweep.py --grid k_4=0.4,0.57,0.7 --grid kp_speed=2,3.1,4
+    gain_sweep.py --random 64 --spread 0.3 --seed 1
+"""
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import csv
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+import warnings
+import numpy as np
+
+import Controller
+import closed_loop
+
+def parse_grid(grid_args):
+    """Parses "name=v1,v2,..." options into a list of gain dicts.
+    """
+    names  = []
+    values = []
+    for grid_arg in grid_args:
+        name, _, value_list = grid_arg.partition('=')
+        if name not in Controller.DEFAULT_GAINS or not value_list:
+            raise ValueError('invalid --grid option: %r' % grid_arg)
+        names.append(name)
+        values.append([float(value) for value in value_list.split(',')])
+    return [dict(zip(names, combination))
+            for combination in itertools.product(*values)]
+
+def random_gain_sets(num_sets, spread, seed, names=None):
+    """Samples gain sets uniformly within +/- spread of the defaults.
+    """
+    rng = np.random.RandomState(seed)
+    names = names or sorted(Controller.DEFAULT_GAINS)
+    gain_sets = []
+    for _ in range(num_sets):
+        gain_sets.append(dict(
+                (name, float(Controller.DEFAULT_GAINS[name] *
+                             rng.uniform(1.0 - spread, 1.0 + spread)))
+                for name in names))
+    return gain_sets
+
+_track = None
+
+def _init_worker(waypoints_np):
+    global _track
+    _track = waypoints_np
+    warnings.simplefilter('ignore', RuntimeWarning)
+
+def evaluate(gains):
+    """Runs one episode with the given gains and returns its metrics.
+    """
+    start = time.time()
+    try:
+        result = closed_loop.run_episode(_track, gains)
+        metrics = {
+            'reached_the_end': result.reached_the_end,
+            'completion_time': result.completion_time,
+            'mean_error':      result.mean_error,
+            'max_error':       result.max_error,
+            'failure':         '',
+        }
+    except (IndexError, ValueError, FloatingPointError) as error:
+        # The controller can run off its waypoint window with bad gains
+        metrics = {
+            'reached_the_end': False,
+            'completion_time': None,
+            'mean_error':      float('inf'),
+            'max_error':       float('inf'),
+            'failure':         '%s: %s' % (type(error).__name__, error),
+        }
+    metrics['gains'] = gains
+    metrics['wall_time'] = time.time() - start
+    return metrics
+
+def rank_key(metrics):
+    completion_time = metrics['completion_time']
+    return (not metrics['reached_the_end'],
+            metrics['mean_error'],
+            completion_time if completion_time is not None else float('inf'))
+
+def print_table(ranked, names):
+    header = ['rank', 'end', 'mean err', 'max err', 'time (s)'] + names
+    print(' '.join('%10s' % column for column in header))
+    for rank, metrics in enumerate(ranked, 1):
+        completion_time = metrics['completion_time']
+        row = ['%d' % rank,
+               'yes' if metrics['reached_the_end'] else 'no',
+               '%.3f' % metrics['mean_error'],
+               '%.3f' % metrics['max_error'],
+               '%.2f' % completion_time if completion_time is not None
+               else '-']
+        row += ['%.6g' % metrics['gains'].get(name,
+                                              Controller.DEFAULT_GAINS[name])
+                for name in names]
+        print(' '.join('%10s' % column for column in row))
+
+def write_csv(ranked, names, file_name):
+    with open(file_name, 'w') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['rank', 'reached_the_end', 'mean_error',
+                         'max_error', 'completion_time', 'failure'] + names)
+        for rank, metrics in enumerate(ranked, 1):
+            writer.writerow([rank, metrics['reached_the_end'],
+                             metrics['mean_error'], metrics['max_error'],
+                             metrics['completion_time'], metrics['failure']] +
+                            [metrics['gains'].get(
+                                    name, Controller.DEFAULT_GAINS[name])
+                             for name in names])
+
+def main():
+    argparser = argparse.ArgumentParser(
+            description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument(
+        '--grid',
+        metavar='NAME=V1,V2',
+        action='append',
+        default=[],
+        help='values of one gain to sweep (repeat for a cartesian grid), '
+             'gain names: %s' % ', '.join(sorted(Controller.DEFAULT_GAINS)))
+    argparser.add_argument(
+        '--random',
+        metavar='N',
+        default=0,
+        type=int,
+        help='number of random gain sets to evaluate')
+    argparser.add_argument(
+        '--spread',
+        default=0.25,
+        type=float,
+        help='relative range of the random samples (default: 0.25)')
+    argparser.add_argument(
+        '--gains',
+        metavar='NAME',
+        action='append',
+        default=None,
+        help='gain to randomize (repeatable, default: all gains)')
+    argparser.add_argument(
+        '--seed',
+        default=0,
+        type=int,
+        help='seed of the random samples (default: 0)')
+    argparser.add_argument(
+        '--waypoints',
+        default=closed_loop.WAYPOINTS_FILENAME,
+        help='waypoint file to track (default: the recorded trajectory '
+             'when racetrack_waypoints.txt is missing)')
+    argparser.add_argument(
+        '-j', '--processes',
+        default=os.cpu_count(),
+        type=int,
+        help='number of worker processes (default: all cores)')
+    argparser.add_argument(
+        '-o', '--output',
+        metavar='PATH',
+        default=None,
+        help='also write the ranked table to a CSV file')
+    args = argparser.parse_args()
+
+    gain_sets = parse_grid(args.grid) if args.grid else []
+    gain_sets += random_gain_sets(args.random, args.spread, args.seed,
+                                  args.gains)
+    if not gain_sets:
+        gain_sets = [{}]    # evaluate the default gains only
+    names = sorted(set(name for gains in gain_sets for name in gains))
+
+    waypoints_np = closed_loop.load_track(args.waypoints)
+    print('Evaluating %d gain sets on %d processes...' %
+          (len(gain_sets), args.processes))
+    start = time.time()
+    pool = multiprocessing.Pool(args.processes, _init_worker, (waypoints_np,))
+    try:
+        results = pool.map(evaluate, gain_sets, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    print('Done in %.1f s.' % (time.time() - start))
+
+    ranked = sorted(results, key=rank_key)
+    print_table(ranked, names)
+    if args.output:
+        write_csv(ranked, names, args.output)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
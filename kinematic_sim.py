@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+"""
+Headless in-process vehicle simulator with the CARLA client surface used by
+the waypoint follower demo.
+
+The vehicle follows a kinematic bicycle model with first order throttle,
+brake and steering response. The simulator is synchronous: every
+send_control() advances the world by one fixed time step, so episodes run
+as fast as the client loop allows.
+"""
+import math
+
+SIM_TIME_STEP       = 0.033  # seconds of game time per frame
+WHEELBASE           = 2.9    # distance between front and rear axle (m)
+MAX_STEER_ANGLE     = 70.0   # front wheel angle at full steer (degrees)
+MAX_ACCELERATION    = 5.0    # acceleration at full throttle (m/s^2)
+MAX_DECELERATION    = 9.0    # deceleration at full brake (m/s^2)
+DRAG_COEFFICIENT    = 0.0015 # aerodynamic drag (1/m), decel = c * v^2
+ROLLING_RESISTANCE  = 0.15   # constant deceleration while moving (m/s^2)
+PEDAL_TIME_CONSTANT = 0.1    # throttle and brake response lag (s)
+STEER_TIME_CONSTANT = 0.05   # steering response lag (s)
+
+class _Message(object):
+    """Attribute container standing in for the CARLA protobuf messages.
+    """
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(
+                '%s=%r' % item for item in sorted(self.__dict__.items())))
+
+class Location(_Message):
+    pass
+
+class Rotation(_Message):
+    pass
+
+class Transform(_Message):
+    pass
+
+class VehicleControl(_Message):
+    def __init__(self, steer=0.0, throttle=0.0, brake=0.0, hand_brake=False,
+                 reverse=False):
+        super(VehicleControl, self).__init__(steer=steer, throttle=throttle,
+                                             brake=brake,
+                                             hand_brake=hand_brake,
+                                             reverse=reverse)
+
+class CarlaSettings(_Message):
+    """Stands in for carla.settings.CarlaSettings, the settings are only
+    stored.
+    """
+    def set(self, **settings):
+        self.__dict__.update(settings)
+
+def make_transform(x, y, yaw, z=0.0):
+    """Creates a transform from a position and a yaw in degrees.
+    """
+    return Transform(location=Location(x=x, y=y, z=z),
+                     rotation=Rotation(pitch=0.0, yaw=yaw, roll=0.0))
+
+def start_transform_from_waypoints(waypoints):
+    """Returns a transform on the first waypoint facing the second one.
+
+    Args:
+        waypoints: Waypoints as [[x0, y0, v0], [x1, y1, v1], ...]
+    """
+    x0, y0 = waypoints[0][0], waypoints[0][1]
+    x1, y1 = waypoints[1][0], waypoints[1][1]
+    return make_transform(x0, y0, math.degrees(math.atan2(y1 - y0, x1 - x0)))
+
+class KinematicSimulator(object):
+    """ Kinematic Simulator
+
+    Implements load_settings, start_episode, read_data and send_control
+    like carla.client.CarlaClient. Poses follow the CARLA (UE4) convention:
+    yaw in degrees, a positive steer turns right and increases the yaw.
+    """
+    def __init__(self, start_transform, time_step=SIM_TIME_STEP,
+                 map_name='KinematicSim'):
+        """
+        Args:
+            start_transform: Transform the vehicle spawns at
+            time_step: Game time advanced by every control command (s)
+            map_name: Map name reported in the scene description
+        """
+        self._start_transform = start_transform
+        self._time_step       = float(time_step)
+        self._map_name        = map_name
+        self._settings        = None
+        self._reset()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def _reset(self):
+        self._frame    = 0
+        self._time     = 0.0
+        self._x        = self._start_transform.location.x
+        self._y        = self._start_transform.location.y
+        self._z        = self._start_transform.location.z
+        self._yaw      = math.radians(self._start_transform.rotation.yaw)
+        self._speed    = 0.0
+        self._accel    = 0.0
+        self._throttle = 0.0
+        self._brake    = 0.0
+        self._steer    = 0.0
+
+    def load_settings(self, carla_settings):
+        """Stores the settings and returns the scene description.
+        """
+        self._settings = carla_settings
+        return _Message(map_name=self._map_name,
+                        player_start_spots=[self._start_transform],
+                        sensors=[])
+
+    def start_episode(self, player_start_index):
+        """Respawns the vehicle. There is one start spot, any index uses it.
+        """
+        self._reset()
+
+    def read_data(self):
+        """Returns the measurements of the current frame and no sensor data.
+        """
+        transform = make_transform(self._x, self._y,
+                                   math.degrees(self._yaw), self._z)
+        acceleration = Location(x=self._accel * math.cos(self._yaw),
+                                y=self._accel * math.sin(self._yaw), z=0.0)
+        player_measurements = _Message(
+                transform=transform,
+                acceleration=acceleration,
+                forward_speed=self._speed,
+                collision_vehicles=0.0,
+                collision_pedestrians=0.0,
+                collision_other=0.0,
+                intersection_otherlane=0.0,
+                intersection_offroad=0.0,
+                autopilot_control=VehicleControl())
+        measurements = _Message(
+                frame_number=self._frame,
+                platform_timestamp=int(self._time * 1000.0),
+                game_timestamp=int(round(self._time * 1000.0)),
+                player_measurements=player_measurements,
+                non_player_agents=[])
+        return measurements, {}
+
+    def send_control(self, *args, **kwargs):
+        """Applies a control command and advances the world one time step.
+
+        Accepts a VehicleControl like object or the steer, throttle, brake,
+        hand_brake and reverse keyword arguments.
+        """
+        if args:
+            control = args[0]
+        else:
+            control = VehicleControl(**kwargs)
+        self._step(min(max(float(control.throttle), 0.0), 1.0),
+                   min(max(float(control.steer), -1.0), 1.0),
+                   1.0 if control.hand_brake else
+                   min(max(float(control.brake), 0.0), 1.0))
+
+    def _step(self, throttle, steer, brake):
+        dt = self._time_step
+
+        # First order response of the actuators
+        pedal_gain = min(dt / PEDAL_TIME_CONSTANT, 1.0)
+        steer_gain = min(dt / STEER_TIME_CONSTANT, 1.0)
+        self._throttle += pedal_gain * (throttle - self._throttle)
+        self._brake    += pedal_gain * (brake - self._brake)
+        self._steer    += steer_gain * (steer - self._steer)
+
+        # Longitudinal dynamics, the vehicle never rolls backwards
+        accel = MAX_ACCELERATION * self._throttle -\
+                DRAG_COEFFICIENT * self._speed**2
+        decel = MAX_DECELERATION * self._brake
+        if self._speed > 0.0:
+            decel += ROLLING_RESISTANCE
+        new_speed = max(self._speed + (accel - decel) * dt, 0.0)
+        if self._speed == 0.0 and accel <= decel:
+            new_speed = 0.0
+        self._accel = (new_speed - self._speed) / dt
+
+        # Kinematic bicycle model about the rear axle
+        mean_speed  = 0.5 * (self._speed + new_speed)
+        wheel_angle = math.radians(MAX_STEER_ANGLE) * self._steer
+        yaw_rate    = mean_speed / WHEELBASE * math.tan(wheel_angle)
+        mid_yaw     = self._yaw + 0.5 * yaw_rate * dt
+        self._x    += mean_speed * math.cos(mid_yaw) * dt
+        self._y    += mean_speed * math.sin(mid_yaw) * dt
+        self._yaw   = math.atan2(math.sin(self._yaw + yaw_rate * dt),
+                                 math.cos(self._yaw + yaw_rate * dt))
+
+        self._speed  = new_speed
+        self._time  += dt
+        self._frame += 1
+
+def make_kinematic_client(start_transform, time_step=SIM_TIME_STEP):
+    """Creates a simulator, a drop in for carla.client.make_carla_client.
+
+    Use it as a context manager:
+        with make_kinematic_client(start_transform) as client:
+            ...
+    """
+    return KinematicSimulator(start_transform, time_step)
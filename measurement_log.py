@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+"""
+Binary log of the full measurement stream of an episode.
+
+Every read_data() of the client is stored as one fixed-size record
+(MEASUREMENT_DTYPE) holding the player measurements of the frame (raw pose
+in CARLA units, acceleration, forward speed, collision and lane
+intersection values, the frame number and the timestamps) together with
+the control sent back for that frame. Unlike the telemetry file
+(telemetry.py), which has the controlled frames only, the log has every
+frame the server sent, including the frames before the controller starts.
+
+The file is a small header followed by the raw records, so it is read with
+a memory map without parsing: record k sits at a fixed offset, and a frame
+is found in O(1) from its server frame number (frame_index).
+
+Running this script prints a summary of a log, or converts it into the
+text trajectory format.
+"""
+from __future__ import print_function
+
+import argparse
+import math
+import os
+import struct
+import numpy as np
+
+import kinematic_sim
+import telemetry
+
+MEASUREMENT_VERSION = 1         # bump when the record layout changes
+MEASUREMENT_MAGIC   = b'SDCMLG'
+MEASUREMENT_HEADER  = struct.Struct('<6sHQ')  # magic, version, record size
+MEASUREMENT_DTYPE   = np.dtype([
+    ('frame_number',           np.int64),   # server frame number
+    ('platform_timestamp',     np.int64),   # ms
+    ('game_timestamp',         np.int64),   # ms
+    ('x',                      np.float64), # m
+    ('y',                      np.float64),
+    ('z',                      np.float64),
+    ('pitch',                  np.float64), # degrees
+    ('yaw',                    np.float64),
+    ('roll',                   np.float64),
+    ('acceleration_x',         np.float64), # m/s^2
+    ('acceleration_y',         np.float64),
+    ('acceleration_z',         np.float64),
+    ('forward_speed',          np.float64), # m/s
+    ('collision_vehicles',     np.float64),
+    ('collision_pedestrians',  np.float64),
+    ('collision_other',        np.float64),
+    ('intersection_otherlane', np.float64),
+    ('intersection_offroad',   np.float64),
+    ('throttle',               np.float64), # control sent for the frame
+    ('steer',                  np.float64),
+    ('brake',                  np.float64),
+    ('hand_brake',             np.uint8),
+    ('reverse',                np.uint8),
+    ('has_control',            np.uint8),   # 0 if no control was sent
+    ('_padding',               np.uint8, (5,)),
+])
+DEFAULT_CHUNK_RECORDS = 256     # about 8 s of frames at 30 Hz
+
+class MeasurementRecorder(object):
+    """ Measurement Recorder
+
+    Appends one MEASUREMENT_DTYPE record per frame to a binary file, in
+    chunks of chunk_records records. record_measurements() starts the
+    record of a frame and record_control() completes it with the control
+    sent back. The file can be read while it is being written
+    (read_measurements).
+    """
+    def __init__(self, file_name, chunk_records=DEFAULT_CHUNK_RECORDS):
+        """
+        Args:
+            file_name: Log file to create (overwritten if it exists)
+            chunk_records: Number of records buffered between writes
+        """
+        self.file_name   = file_name
+        self._chunk      = np.zeros(chunk_records, dtype=MEASUREMENT_DTYPE)
+        self._num_buffered = 0
+        self.num_records = 0
+        self._file       = open(file_name, 'wb')
+        self._file.write(MEASUREMENT_HEADER.pack(
+                MEASUREMENT_MAGIC, MEASUREMENT_VERSION,
+                MEASUREMENT_DTYPE.itemsize))
+        self._file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def record_measurements(self, measurements):
+        """Starts the record of a frame.
+
+        Args:
+            measurements: Measurements returned by the client read_data()
+        """
+        # The chunk is written out once full, when the control of its last
+        # record has been recorded
+        if self._num_buffered == self._chunk.shape[0]:
+            self.flush()
+        player       = measurements.player_measurements
+        location     = player.transform.location
+        rotation     = player.transform.rotation
+        acceleration = player.acceleration
+        self._chunk[self._num_buffered] = (
+                measurements.frame_number, measurements.platform_timestamp,
+                measurements.game_timestamp,
+                location.x, location.y, location.z,
+                rotation.pitch, rotation.yaw, rotation.roll,
+                acceleration.x, acceleration.y, acceleration.z,
+                player.forward_speed,
+                player.collision_vehicles, player.collision_pedestrians,
+                player.collision_other, player.intersection_otherlane,
+                player.intersection_offroad,
+                0.0, 0.0, 0.0, 0, 0, 0, 0)
+        self._num_buffered += 1
+        self.num_records   += 1
+
+    def record_control(self, control):
+        """Stores the control sent for the frame last recorded.
+
+        The first control sent after a frame is its control. Controls sent
+        without reading a new frame in between (e.g. the stop command at
+        the end of an episode) are not stored, so they never overwrite the
+        control of the last frame.
+
+        Args:
+            control: VehicleControl sent to the server
+        """
+        if not self._num_buffered:
+            return
+        record = self._chunk[self._num_buffered - 1]
+        if record['has_control']:
+            return
+        record['throttle']    = control.throttle
+        record['steer']       = control.steer
+        record['brake']       = control.brake
+        record['hand_brake']  = control.hand_brake
+        record['reverse']     = control.reverse
+        record['has_control'] = 1
+
+    def flush(self):
+        """Writes the buffered records to the file.
+        """
+        if self._num_buffered:
+            self._file.write(self._chunk[:self._num_buffered].tobytes())
+            self._num_buffered = 0
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+class RecordingClient(object):
+    """ Recording Client
+
+    Wraps a client (CARLA, kinematic_sim or standin_server) and records
+    every read_data() and send_control() in a MeasurementRecorder. Other
+    attributes are those of the wrapped client.
+    """
+    def __init__(self, client, recorder):
+        self._client   = client
+        self._recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def read_data(self):
+        measurements, sensor_data = self._client.read_data()
+        self._recorder.record_measurements(measurements)
+        return measurements, sensor_data
+
+    def send_control(self, *args, **kwargs):
+        self._client.send_control(*args, **kwargs)
+        if args:
+            self._recorder.record_control(args[0])
+        else:
+            self._recorder.record_control(
+                    kinematic_sim.VehicleControl(**kwargs))
+
+def read_measurements(file_name, mmap=True):
+    """Reads the records of a measurement log.
+
+    A partially written last record (e.g. after a crash) is ignored.
+
+    Args:
+        file_name: Log file written by MeasurementRecorder
+        mmap: Memory-map the records instead of reading them
+
+    Returns: Structured array with the MEASUREMENT_DTYPE layout
+    """
+    with open(file_name, 'rb') as log_file:
+        header = log_file.read(MEASUREMENT_HEADER.size)
+    if len(header) < MEASUREMENT_HEADER.size:
+        raise ValueError('%s is not a measurement log' % file_name)
+    magic, version, itemsize = MEASUREMENT_HEADER.unpack(header)
+    if magic != MEASUREMENT_MAGIC:
+        raise ValueError('%s is not a measurement log' % file_name)
+    if version != MEASUREMENT_VERSION or \
+       itemsize != MEASUREMENT_DTYPE.itemsize:
+        raise ValueError('%s has measurement log version %d, expected %d' %
+                         (file_name, version, MEASUREMENT_VERSION))
+
+    num_records = ((os.path.getsize(file_name) - MEASUREMENT_HEADER.size) //
+                   MEASUREMENT_DTYPE.itemsize)
+    if num_records == 0:
+        return np.zeros(0, dtype=MEASUREMENT_DTYPE)
+    if mmap:
+        return np.memmap(file_name, dtype=MEASUREMENT_DTYPE, mode='r',
+                         offset=MEASUREMENT_HEADER.size, shape=(num_records,))
+    return np.fromfile(file_name, dtype=MEASUREMENT_DTYPE, count=num_records,
+                       offset=MEASUREMENT_HEADER.size)
+
+def frame_index(records, frame_number):
+    """Index of the record of a server frame number, -1 if not logged.
+
+    O(1) when the logged frame numbers are consecutive (the synchronous
+    mode), a binary search over the increasing frame numbers otherwise.
+    """
+    num_records = records.shape[0]
+    if num_records == 0:
+        return -1
+    index = frame_number - int(records[0]['frame_number'])
+    if 0 <= index < num_records and \
+       records[index]['frame_number'] == frame_number:
+        return index
+    index = int(np.searchsorted(records['frame_number'], frame_number))
+    if index < num_records and records[index]['frame_number'] == frame_number:
+        return index
+    return -1
+
+def time_index(records, game_seconds):
+    """Index of the first record at or after a game time in seconds.
+    """
+    return int(np.searchsorted(records['game_timestamp'],
+                               int(math.ceil(game_seconds * 1000.0))))
+
+def to_telemetry(records, start_time=0.0):
+    """Converts the frames of a log into telemetry records.
+
+    Args:
+        records: Records of read_measurements
+        start_time: Game seconds before the controller starts. Only the
+                    later frames are converted, with their time relative to
+                    it (as the demo logs them).
+
+    Returns: Structured array with the telemetry.TELEMETRY_DTYPE layout,
+             the frame field is the index of the record in the log
+    """
+    game_time = records['game_timestamp'] / 1000.0
+    index     = np.flatnonzero(game_time > start_time)
+    converted = np.zeros(index.shape[0], dtype=telemetry.TELEMETRY_DTYPE)
+    converted['frame'] = index
+    converted['time']  = game_time[index] - start_time
+    converted['x']     = records['x'][index]
+    converted['y']     = records['y'][index]
+    converted['yaw']   = np.radians(records['yaw'][index])
+    converted['speed'] = records['forward_speed'][index]
+    for name in ('throttle', 'steer', 'brake'):
+        converted[name] = records[name][index]
+    return converted
+
+def main():
+    argparser = argparse.ArgumentParser(
+            description='Print a summary of a measurement log.')
+    argparser.add_argument(
+        'log_file',
+        help='measurement log written by the demo')
+    argparser.add_argument(
+        '--frame',
+        type=int,
+        default=None,
+        help='also print the record of this server frame number')
+    argparser.add_argument(
+        '--trajectory',
+        metavar='PATH',
+        default=None,
+        help='write the frames in the text trajectory format')
+    args = argparser.parse_args()
+
+    records = read_measurements(args.log_file)
+    print('%d frames' % records.shape[0])
+    if records.shape[0]:
+        print('frame numbers %d to %d, game time %.3f s to %.3f s' % (
+                records[0]['frame_number'], records[-1]['frame_number'],
+                records[0]['game_timestamp'] / 1000.0,
+                records[-1]['game_timestamp'] / 1000.0))
+    if args.frame is not None:
+        index = frame_index(records, args.frame)
+        if index < 0:
+            print('frame %d is not in the log' % args.frame)
+        else:
+            record = records[index]
+            for name in MEASUREMENT_DTYPE.names:
+                if not name.startswith('_'):
+                    print('%-24s %s' % (name, record[name]))
+    if args.trajectory is not None:
+        telemetry.write_trajectory_text(to_telemetry(records),
+                                        args.trajectory)
+        print('trajectory written to %s' % args.trajectory)
+
+if __name__ == '__main__':
+    main()
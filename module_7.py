@@ -22,19 +22,22 @@ import logging
 import time
 import math
 import numpy as np
-import csv
-import matplotlib.pyplot as plt
 import controller2d
 import configparser 
-
-# Script level imports
+import path_interp
+import route_store
+import closed_loop
+import mpc
+import kinematic_sim
+import telemetry
+import measurement_log
+import episode_history
+import plot_process
+import stage_profile
+
+# Script level imports. The CARLA PythonAPI is imported where a server is
+# used, so that --headless runs without it.
 sys.path.append(os.path.abspath(sys.path[0] + '/..'))
-import live_plotter as lv   # Custom live plotting library
-from carla            import sensor
-from carla.client     import make_carla_client, VehicleControl
-from carla.settings   import CarlaSettings
-from carla.tcp        import TCPConnectionError
-from carla.controller import utils
 
 """
 Configurable params
@@ -68,12 +71,6 @@ WEATHERID = {
 SIMWEATHER = WEATHERID["CLEARNOON"]     # set simulation weather
 
 PLAYER_START_INDEX = 1      # spawn index for player (keep to 1)
-FIGSIZE_X_INCHES   = 8      # x figure size of feedback in inches
-FIGSIZE_Y_INCHES   = 8      # y figure size of feedback in inches
-PLOT_LEFT          = 0.1    # in fractions of figure width and height
-PLOT_BOT           = 0.1    
-PLOT_WIDTH         = 0.8
-PLOT_HEIGHT        = 0.8
 
 WAYPOINTS_FILENAME = 'racetrack_waypoints.txt'  # waypoint file to load
 DIST_THRESHOLD_TO_LAST_WAYPOINT = 2.0  # some distance from last position before
@@ -83,7 +80,41 @@ DIST_THRESHOLD_TO_LAST_WAYPOINT = 2.0  # some distance from last position before
 INTERP_MAX_POINTS_PLOT    = 10   # number of points used for displaying
                                  # lookahead path
 INTERP_LOOKAHEAD_DISTANCE = 20   # lookahead in meters
+INTERP_LOOKAHEAD_TIME     = 0.0  # extra lookahead in seconds at the
+                                 # waypoint speed (0 for a fixed lookahead)
 INTERP_DISTANCE_RES       = 0.01 # distance between interpolated points
+INTERP_SPLINE             = False # sample the path from cubic splines
+                                  # instead of linear interpolation
+SPEED_PROFILE             = False # track a curvature-aware speed profile
+                                  # instead of the waypoint speeds
+ROUTE_PAGING              = False # keep only the pages of the route near
+                                  # the car resident (route_store.py), for
+                                  # very long routes. Not combined with
+                                  # INTERP_SPLINE nor SPEED_PROFILE.
+
+# Model predictive control parameters
+CONTROLLER_MPC            = False # optimize the commands with the MPC
+                                  # solver (falls back to the geometric
+                                  # law when over the time budget)
+MPC_TIME_BUDGET           = 0.005 # seconds of solver compute per frame
+
+# Controller law implementation: None for NumPy, or a control_kernel.py
+# backend ('auto' compiles it with Numba when installed, else pure Python)
+CONTROLLER_KERNEL         = None
+
+# Frame loop stages timed with --profile-stages (the stages of the control
+# pipeline, closed_loop.PIPELINE_STAGES, in the middle)
+STAGE_NAMES = [
+    'read_data',
+    'pose',
+] + closed_loop.PIPELINE_STAGES + [
+    'history',
+    'plotting',
+    'send_control',
+]
+(STAGE_READ_DATA, STAGE_POSE, STAGE_CLOSEST_INDEX, STAGE_LOOKAHEAD_WINDOW,
+ STAGE_UPDATE_CONTROLS, STAGE_HISTORY, STAGE_PLOTTING,
+ STAGE_SEND_CONTROL) = range(len(STAGE_NAMES))
 
 # controller output directory
 CONTROLLER_OUTPUT_FOLDER = os.path.dirname(os.path.realpath(__file__)) +\
@@ -91,8 +122,15 @@ CONTROLLER_OUTPUT_FOLDER = os.path.dirname(os.path.realpath(__file__)) +\
 
 def make_carla_settings(args):
     """Make a CarlaSettings object with the settings we need.
+
+    With --headless, the settings stand-in of kinematic_sim.py is filled
+    instead.
     """
-    settings = CarlaSettings()
+    if args.headless:
+        settings = kinematic_sim.CarlaSettings()
+    else:
+        from carla.settings import CarlaSettings
+        settings = CarlaSettings()
     
     # There is no need for non-agent info requests if there are no pedestrians
     # or vehicles.
@@ -196,47 +234,77 @@ def send_control_command(client, throttle, steer, brake,
         hand_brake: Whether the hand brake is engaged
         reverse: Whether the sim car is in the reverse gear
     """
-    control = VehicleControl()
     # Clamp all values within their limits
     steer = np.fmax(np.fmin(steer, 1.0), -1.0)
     throttle = np.fmax(np.fmin(throttle, 1.0), 0)
     brake = np.fmax(np.fmin(brake, 1.0), 0)
 
-    control.steer = steer
-    control.throttle = throttle
-    control.brake = brake
-    control.hand_brake = hand_brake
-    control.reverse = reverse
-    client.send_control(control)
+    # The clients build their own VehicleControl from the keywords (CARLA
+    # or kinematic_sim), so the PythonAPI is not needed here
+    client.send_control(steer=steer, throttle=throttle, brake=brake,
+                        hand_brake=hand_brake, reverse=reverse)
 
 def create_controller_output_dir(output_folder):
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
-def store_trajectory_plot(graph, fname):
-    """ Store the resulting plot.
+def create_telemetry_writer():
+    """ Create the streaming telemetry file of the episode.
     """
     create_controller_output_dir(CONTROLLER_OUTPUT_FOLDER)
+    file_name = os.path.join(CONTROLLER_OUTPUT_FOLDER, 'telemetry.bin')
+    return telemetry.TelemetryWriter(file_name)
 
-    file_name = os.path.join(CONTROLLER_OUTPUT_FOLDER, fname)
-    graph.savefig(file_name)
+def create_measurement_recorder():
+    """ Create the measurement log of the episode (every frame read).
+    """
+    create_controller_output_dir(CONTROLLER_OUTPUT_FOLDER)
+    file_name = os.path.join(CONTROLLER_OUTPUT_FOLDER, 'measurements.bin')
+    return measurement_log.MeasurementRecorder(file_name)
 
-def write_trajectory_file(x_list, y_list, v_list, t_list):
+def write_trajectory_file(history):
+    """ Write the episode history to the trajectory text file.
+    """
     create_controller_output_dir(CONTROLLER_OUTPUT_FOLDER)
     file_name = os.path.join(CONTROLLER_OUTPUT_FOLDER, 'trajectory.txt')
+    telemetry.write_trajectory_text(history.view(), file_name)
+
+def make_client(args):
+    """Connects to the CARLA server or creates the headless simulator.
 
-    with open(file_name, 'w') as trajectory_file: 
-        for i in range(len(x_list)):
-            trajectory_file.write('%3.3f, %3.3f, %2.3f, %6.3f\n' %\
-                                  (x_list[i], y_list[i], v_list[i], t_list[i]))
+    With --headless, the local kinematic simulator (kinematic_sim.py) is
+    used instead of a CARLA server. The vehicle spawns on the first
+    waypoint, facing the second one.
+    """
+    if args.headless:
+        waypoints_np = path_interp.load_compiled_table(
+                WAYPOINTS_FILENAME, INTERP_DISTANCE_RES)['waypoint']
+        return kinematic_sim.make_kinematic_client(
+                kinematic_sim.start_transform_from_waypoints(waypoints_np))
+    from carla.client import make_carla_client
+    return make_carla_client(args.host, args.port)
+
+def connection_errors(args):
+    """Errors after which the demo reconnects to the CARLA server (none
+    with --headless).
+    """
+    if args.headless:
+        return ()
+    from carla.tcp import TCPConnectionError
+    return (TCPConnectionError,)
 
 def exec_waypoint_nav_demo(args):
     """ Executes waypoint navigation demo.
     """
 
-    with make_carla_client(args.host, args.port) as client:
+    with make_client(args) as carla_client, \
+         create_measurement_recorder() as measurement_recorder:
         print('Carla client connected.')
 
+        # Every frame read and control sent is logged to the measurement log
+        client = measurement_log.RecordingClient(carla_client,
+                                                 measurement_recorder)
+
         settings = make_carla_settings(args)
 
         # Now we load these settings into the server. The server replies
@@ -274,20 +342,27 @@ def exec_waypoint_nav_demo(args):
         enable_live_plot = enable_live_plot == 'True'
         live_plot_period = float(demo_opt.get('live_plotting_period', 0))
 
-        # Set options
-        live_plot_timer = Timer(live_plot_period)
-
         #############################################
         # Load Waypoints
         #############################################
-        # Opens the waypoint file and stores it to "waypoints"
+        # Opens the compiled path of the waypoint file (compiling it on the
+        # first run) and stores the waypoints to "waypoints". The compiled
+        # path is memory-mapped and already holds the interpolation tables
+        # and the dense points. A paged route (ROUTE_PAGING) only opens the
+        # table, its pages and dense points are computed around the car.
         waypoints_file = WAYPOINTS_FILENAME
-        waypoints_np   = None
-        with open(waypoints_file) as waypoints_file_handle:
-            waypoints = list(csv.reader(waypoints_file_handle, 
-                                        delimiter=',',
-                                        quoting=csv.QUOTE_NONNUMERIC))
-            waypoints_np = np.array(waypoints)
+        route          = None
+        wp_interp      = None
+        if ROUTE_PAGING:
+            route      = route_store.RouteStore.open(
+                    waypoints_file, INTERP_DISTANCE_RES,
+                    lookahead_distance=INTERP_LOOKAHEAD_DISTANCE,
+                    lookahead_time=INTERP_LOOKAHEAD_TIME)
+            waypoints_np = route.waypoints
+        else:
+            wp_interp  = path_interp.load_compiled_path(waypoints_file,
+                                                        INTERP_DISTANCE_RES)
+            waypoints_np = wp_interp.waypoints
 
         # Because the waypoints are discrete and our controller performs better
         # with a continuous path, here we will send a subset of the waypoints
@@ -307,51 +382,54 @@ def exec_waypoint_nav_demo(args):
         # reduce these effects?
         
         # Linear interpolation computations
-        # Compute a list of distances between waypoints
-        wp_distance = []   # distance array
-        for i in range(1, waypoints_np.shape[0]):
-            wp_distance.append(
-                    np.sqrt((waypoints_np[i, 0] - waypoints_np[i-1, 0])**2 +
-                            (waypoints_np[i, 1] - waypoints_np[i-1, 1])**2))
-        wp_distance.append(0)  # last distance is 0 because it is the distance
-                               # from the last waypoint to the last waypoint
-
-        # Linearly interpolate between waypoints and store in a list
-        wp_interp      = []    # interpolated values 
-                               # (rows = waypoints, columns = [x, y, v])
-        wp_interp_hash = []    # hash table which indexes waypoints_np
-                               # to the index of the waypoint in wp_interp
-        interp_counter = 0     # counter for current interpolated point index
-        for i in range(waypoints_np.shape[0] - 1):
-            # Add original waypoint to interpolated waypoints list (and append
-            # it to the hash table)
-            wp_interp.append(list(waypoints_np[i]))
-            wp_interp_hash.append(interp_counter)   
-            interp_counter+=1
-            
-            # Interpolate to the next waypoint. First compute the number of
-            # points to interpolate based on the desired resolution and
-            # incrementally add interpolated points until the next waypoint
-            # is about to be reached.
-            num_pts_to_interp = int(np.floor(wp_distance[i] /\
-                                         float(INTERP_DISTANCE_RES)) - 1)
-            wp_vector = waypoints_np[i+1] - waypoints_np[i]
-            wp_uvector = wp_vector / np.linalg.norm(wp_vector)
-            for j in range(num_pts_to_interp):
-                next_wp_vector = INTERP_DISTANCE_RES * float(j+1) * wp_uvector
-                wp_interp.append(list(waypoints_np[i] + next_wp_vector))
-                interp_counter+=1
-        # add last waypoint at the end
-        wp_interp.append(list(waypoints_np[-1]))
-        wp_interp_hash.append(interp_counter)   
-        interp_counter+=1
+        # The interpolated path (wp_interp, loaded above) holds the
+        # waypoints, their distances and the interpolated points. Between
+        # each pair of waypoints, points are placed every
+        # INTERP_DISTANCE_RES meters towards the next waypoint. Slices are
+        # rows of [x, y, v] (rows = waypoints).
 
         #############################################
         # Controller 2D Class Declaration
         #############################################
         # This is where we take the controller2d.py class
-        # and apply it to the simulator
-        controller = controller2d.Controller2D(waypoints)
+        # and apply it to the simulator. It runs in the control pipeline
+        # shared with the headless tools (closed_loop.ControlPipeline),
+        # which also holds the path:
+        # - the lookahead window of every closest waypoint index, computed
+        #   once (INTERP_LOOKAHEAD_DISTANCE, INTERP_LOOKAHEAD_TIME)
+        # - Spline interpolation (INTERP_SPLINE): the waypoint windows are
+        #   sampled every INTERP_DISTANCE_RES meters from cubic splines
+        #   fitted once through the waypoints, so the path sent to the
+        #   controller is smooth at the waypoints as well.
+        # - Speed profile (SPEED_PROFILE): the reference speed of every
+        #   waypoint is replaced by a feasible profile computed once from
+        #   the path curvature and the acceleration limits
+        #   (speed_profile.py). The reference acceleration of every
+        #   interpolated point is sent to the controller with each window.
+        # - Route paging (ROUTE_PAGING): the windows, their dense points
+        #   and the localization are served by pages of the route loaded
+        #   around the car (and ahead of it on a background thread), so
+        #   nothing is computed over the whole route.
+        mpc_solver = None
+        if CONTROLLER_MPC:
+            mpc_solver = mpc.MPCSolver(time_budget=MPC_TIME_BUDGET)
+
+        # Per-stage latency of every frame (--profile-stages)
+        profiler = stage_profile.StageProfiler(
+                STAGE_NAMES, enabled=args.profile_stages,
+                trace_file=args.stage_trace)
+        pipeline = closed_loop.ControlPipeline(
+                waypoints_np, spline=INTERP_SPLINE, profile=SPEED_PROFILE,
+                mpc=mpc_solver, kernel=CONTROLLER_KERNEL,
+                paged=ROUTE_PAGING, profiler=profiler,
+                stage_offset=STAGE_CLOSEST_INDEX, wp_interp=wp_interp,
+                route=route, controller_class=controller2d.Controller2D,
+                lookahead_distance=INTERP_LOOKAHEAD_DISTANCE,
+                lookahead_time=INTERP_LOOKAHEAD_TIME,
+                resolution=INTERP_DISTANCE_RES)
+        controller   = pipeline.controller
+        waypoints_np = pipeline.waypoints_np   # with the speed profile
+        waypoints    = waypoints_np
 
         #############################################
         # Determine simulation average timestep (and total frames)
@@ -398,276 +476,157 @@ def exec_waypoint_nav_demo(args):
         measurement_data, sensor_data = client.read_data()
         start_x, start_y, start_yaw = get_current_pose(measurement_data)
         send_control_command(client, throttle=0.0, steer=0, brake=1.0)
-        x_history     = [start_x]
-        y_history     = [start_y]
-        yaw_history   = [start_yaw]
-        time_history  = [0]
-        speed_history = [0]
+        history = episode_history.HistoryBuffer(telemetry.TELEMETRY_DTYPE,
+                                                TOTAL_EPISODE_FRAMES + 1)
+        history.append(-1, 0, start_x, start_y, start_yaw, 0, 0, 0, 1.0, 0, 0)
 
         #############################################
         # Vehicle Trajectory Live Plotting Setup
         #############################################
-        # Uses the live plotter to generate live feedback during the simulation
-        # The two feedback includes the trajectory feedback and
-        # the controller feedback (which includes the speed tracking).
-        lp_traj = lv.LivePlotter(tk_title="Trajectory Trace")
-        lp_1d = lv.LivePlotter(tk_title="Controls Feedback")
-        
-        ###
-        # Add 2D position / trajectory plot
-        ###
-        trajectory_fig = lp_traj.plot_new_dynamic_2d_figure(
-                title='Vehicle Trajectory',
-                figsize=(FIGSIZE_X_INCHES, FIGSIZE_Y_INCHES),
-                edgecolor="black",
-                rect=[PLOT_LEFT, PLOT_BOT, PLOT_WIDTH, PLOT_HEIGHT])
-
-        trajectory_fig.set_invert_x_axis() # Because UE4 uses left-handed 
-                                           # coordinate system the X
-                                           # axis in the graph is flipped
-        trajectory_fig.set_axis_equal()    # X-Y spacing should be equal in size
-
-        # Add waypoint markers
-        trajectory_fig.add_graph("waypoints", window_size=waypoints_np.shape[0],
-                                 x0=waypoints_np[:,0], y0=waypoints_np[:,1],
-                                 linestyle="-", marker="", color='g')
-        # Add trajectory markers
-        trajectory_fig.add_graph("trajectory", window_size=TOTAL_EPISODE_FRAMES,
-                                 x0=[start_x]*TOTAL_EPISODE_FRAMES, 
-                                 y0=[start_y]*TOTAL_EPISODE_FRAMES,
-                                 color=[1, 0.5, 0])
-        # Add lookahead path
-        trajectory_fig.add_graph("lookahead_path", 
-                                 window_size=INTERP_MAX_POINTS_PLOT,
-                                 x0=[start_x]*INTERP_MAX_POINTS_PLOT, 
-                                 y0=[start_y]*INTERP_MAX_POINTS_PLOT,
-                                 color=[0, 0.7, 0.7],
-                                 linewidth=4)
-        # Add starting position marker
-        trajectory_fig.add_graph("start_pos", window_size=1, 
-                                 x0=[start_x], y0=[start_y],
-                                 marker=11, color=[1, 0.5, 0], 
-                                 markertext="Start", marker_text_offset=1)
-        # Add end position marker
-        trajectory_fig.add_graph("end_pos", window_size=1, 
-                                 x0=[waypoints_np[-1, 0]], 
-                                 y0=[waypoints_np[-1, 1]],
-                                 marker="D", color='r', 
-                                 markertext="End", marker_text_offset=1)
-        # Add car marker
-        trajectory_fig.add_graph("car", window_size=1, 
-                                 marker="s", color='b', markertext="Car",
-                                 marker_text_offset=1)
-
-        ###
-        # Add 1D speed profile updater
-        ###
-        forward_speed_fig =\
-                lp_1d.plot_new_dynamic_figure(title="Forward Speed (m/s)")
-        forward_speed_fig.add_graph("forward_speed", 
-                                    label="forward_speed", 
-                                    window_size=TOTAL_EPISODE_FRAMES)
-        forward_speed_fig.add_graph("reference_signal", 
-                                    label="reference_Signal", 
-                                    window_size=TOTAL_EPISODE_FRAMES)
-
-        # Add throttle signals graph
-        throttle_fig = lp_1d.plot_new_dynamic_figure(title="Throttle")
-        throttle_fig.add_graph("throttle", 
-                              label="throttle", 
-                              window_size=TOTAL_EPISODE_FRAMES)
-        # Add brake signals graph
-        brake_fig = lp_1d.plot_new_dynamic_figure(title="Brake")
-        brake_fig.add_graph("brake", 
-                              label="brake", 
-                              window_size=TOTAL_EPISODE_FRAMES)
-        # Add steering signals graph
-        steer_fig = lp_1d.plot_new_dynamic_figure(title="Steer")
-        steer_fig.add_graph("steer", 
-                              label="steer", 
-                              window_size=TOTAL_EPISODE_FRAMES)
-
-        # live plotter is disabled, hide windows
-        if not enable_live_plot:
-            lp_traj._root.withdraw()
-            lp_1d._root.withdraw()        
-
-        # Iterate the frames until the end of the waypoints is reached or
-        # the TOTAL_EPISODE_FRAMES is reached. The controller simulation then
-        # ouptuts the results to the controller output directory.
-        reached_the_end = False
-        skip_first_frame = True
-        closest_index    = 0  # Index of waypoint that is currently closest to
-                              # the car (assumed to be the first index)
-        closest_distance = 0  # Closest distance of closest waypoint to car
-        for frame in range(TOTAL_EPISODE_FRAMES):
-            # Gather current data from the CARLA server
-            measurement_data, sensor_data = client.read_data()
-
-            # Update pose, timestamp
-            current_x, current_y, current_yaw = \
-                get_current_pose(measurement_data)
-            current_speed = measurement_data.player_measurements.forward_speed
-            current_timestamp = float(measurement_data.game_timestamp) / 1000.0
-
-            # Wait for some initial time before starting the demo
-            if current_timestamp <= WAIT_TIME_BEFORE_START:
-                send_control_command(client, throttle=0.0, steer=0, brake=1.0)
-                continue
-            else:
-                current_timestamp = current_timestamp - WAIT_TIME_BEFORE_START
-            
-            # Store history
-            x_history.append(current_x)
-            y_history.append(current_y)
-            yaw_history.append(current_yaw)
-            speed_history.append(current_speed)
-            time_history.append(current_timestamp) 
-
-            ###
-            # Controller update (this uses the controller2d.py implementation)
-            ###
-
-            # To reduce the amount of waypoints sent to the controller,
-            # provide a subset of waypoints that are within some 
-            # lookahead distance from the closest point to the car. Provide
-            # a set of waypoints behind the car as well.
-            
-            # Find closest waypoint index to car. First increment the index
-            # from the previous index until the new distance calculations
-            # are increasing. Apply the same rule decrementing the index.
-            # The final index should be the closest point (it is assumed that
-            # the car will always break out of instability points where there
-            # are two indices with the same minimum distance, as in the
-            # center of a circle)
-            closest_distance = np.linalg.norm(np.array([
-                    waypoints_np[closest_index, 0] - current_x,
-                    waypoints_np[closest_index, 1] - current_y]))
-            new_distance = closest_distance
-            new_index = closest_index
-            while new_distance <= closest_distance:
-                closest_distance = new_distance
-                closest_index = new_index
-                new_index += 1
-                if new_index >= waypoints_np.shape[0]:  # End of path
-                    break
-                new_distance = np.linalg.norm(np.array([
-                        waypoints_np[new_index, 0] - current_x,
-                        waypoints_np[new_index, 1] - current_y]))
-            new_distance = closest_distance
-            new_index = closest_index
-            while new_distance <= closest_distance:
-                closest_distance = new_distance
-                closest_index = new_index
-                new_index -= 1
-                if new_index < 0:  # Beginning of path
-                    break
-                new_distance = np.linalg.norm(np.array([
-                        waypoints_np[new_index, 0] - current_x,
-                        waypoints_np[new_index, 1] - current_y]))
-
-            # Once the closest index is found, return the path that has 1
-            # waypoint behind and X waypoints ahead, where X is the index
-            # that has a lookahead distance specified by 
-            # INTERP_LOOKAHEAD_DISTANCE
-            waypoint_subset_first_index = closest_index - 1
-            if waypoint_subset_first_index < 0:
-                waypoint_subset_first_index = 0
-
-            waypoint_subset_last_index = closest_index
-            total_distance_ahead = 0
-            while total_distance_ahead < INTERP_LOOKAHEAD_DISTANCE:
-                total_distance_ahead += wp_distance[waypoint_subset_last_index]
-                waypoint_subset_last_index += 1
-                if waypoint_subset_last_index >= waypoints_np.shape[0]:
-                    waypoint_subset_last_index = waypoints_np.shape[0] - 1
+        # The live plots (trajectory feedback and controller feedback) are
+        # drawn by a separate process (plot_process.py). The control loop
+        # only publishes one sample per frame to it, so the plot refresh
+        # never delays the commands sent to the server.
+        live_plot = plot_process.LivePlotProcess(
+                waypoints_np, start_x, start_y,
+                enable_live_plot=enable_live_plot,
+                refresh_period=live_plot_period,
+                output_folder=CONTROLLER_OUTPUT_FOLDER,
+                num_path_points=INTERP_MAX_POINTS_PLOT)
+
+        telemetry_writer = None
+        try:
+            telemetry_writer = create_telemetry_writer()
+            telemetry_writer.append(*history.last())
+
+            # Iterate the frames until the end of the waypoints is reached
+            # or the TOTAL_EPISODE_FRAMES is reached. The controller
+            # simulation then ouptuts the results to the controller output
+            # directory.
+            reached_the_end = False
+            skip_first_frame = True
+            closest_index    = 0  # Index of waypoint that is currently
+                                  # closest to the car (assumed to be the
+                                  # first index)
+            for frame in range(TOTAL_EPISODE_FRAMES):
+                profiler.start_frame(frame)
+                # Gather current data from the CARLA server
+                measurement_data, sensor_data = client.read_data()
+                profiler.mark(STAGE_READ_DATA)
+
+                # Update pose, timestamp
+                current_x, current_y, current_yaw = \
+                    get_current_pose(measurement_data)
+                current_speed = \
+                    measurement_data.player_measurements.forward_speed
+                current_timestamp = \
+                    float(measurement_data.game_timestamp) / 1000.0
+                profiler.mark(STAGE_POSE)
+
+                # Wait for some initial time before starting the demo
+                if current_timestamp <= WAIT_TIME_BEFORE_START:
+                    send_control_command(client, throttle=0.0, steer=0,
+                                         brake=1.0)
+                    profiler.mark(STAGE_SEND_CONTROL)
+                    profiler.end_frame()
+                    continue
+                else:
+                    current_timestamp = \
+                        current_timestamp - WAIT_TIME_BEFORE_START
+
+                ###
+                # Controller update (this uses the controller2d.py
+                # implementation)
+                ###
+
+                # To reduce the amount of waypoints sent to the controller,
+                # provide a subset of waypoints that are within some 
+                # lookahead distance from the closest point to the car. Provide
+                # a set of waypoints behind the car as well.
+                # The pipeline finds the closest waypoint index to the car (the
+                # car is projected onto the path segments next to the
+                # previously tracked one), takes the window of 1 waypoint
+                # behind and the waypoints ahead within the lookahead distance,
+                # as a read-only view into the dense path (nothing is computed
+                # or copied per frame), and updates the controller with it.
+                cmd_throttle, cmd_steer, cmd_brake, closest_index = \
+                        pipeline.step(current_x, current_y, current_yaw,
+                                      current_speed, current_timestamp, frame)
+                new_waypoints = pipeline.waypoint_window
+
+                # Store history
+                history.append(frame, current_timestamp,
+                               current_x, current_y, current_yaw, current_speed,
+                               cmd_throttle, cmd_steer, cmd_brake,
+                               controller._desired_speed, closest_index)
+                telemetry_writer.append(*history.last())
+                profiler.mark(STAGE_HISTORY)
+
+                # Skip the first frame (so the controller has proper outputs)
+                if skip_first_frame and frame == 0:
+                    pass
+                else:
+                    # Publish the new feedback to the live plotter.
+                    # When plotting lookahead path, only plot a number of
+                    # points (INTERP_MAX_POINTS_PLOT amount of points). This
+                    # is meant to decrease load when live plotting
+                    path_indices = np.floor(np.linspace(
+                            0, new_waypoints.shape[0]-1,
+                            INTERP_MAX_POINTS_PLOT))
+                    path_indices = path_indices.astype(int)
+                    live_plot.publish(current_timestamp, current_x, current_y,
+                                      current_speed, controller._desired_speed,
+                                      cmd_throttle, cmd_brake, cmd_steer,
+                                      new_waypoints[path_indices, 0],
+                                      new_waypoints[path_indices, 1])
+                    profiler.mark(STAGE_PLOTTING)
+
+                # Output controller command to CARLA server
+                send_control_command(client,
+                                     throttle=cmd_throttle,
+                                     steer=cmd_steer,
+                                     brake=cmd_brake)
+                profiler.mark(STAGE_SEND_CONTROL)
+                profiler.end_frame()
+
+                # Find if reached the end of waypoint. If the car is within
+                # DIST_THRESHOLD_TO_LAST_WAYPOINT to the last waypoint,
+                # the simulation will end.
+                dist_to_last_waypoint = np.linalg.norm(np.array([
+                    waypoints[-1][0] - current_x,
+                    waypoints[-1][1] - current_y]))
+                if  dist_to_last_waypoint < DIST_THRESHOLD_TO_LAST_WAYPOINT:
+                    reached_the_end = True
+                if reached_the_end:
                     break
 
-            # Use the first and last waypoint subset indices into the hash
-            # table to obtain the first and last indicies for the interpolated
-            # list. Update the interpolated waypoints to the controller
-            # for the next controller update.
-            new_waypoints = \
-                    wp_interp[wp_interp_hash[waypoint_subset_first_index]:\
-                              wp_interp_hash[waypoint_subset_last_index] + 1]
-            controller.update_waypoints(new_waypoints)
-
-            # Update the other controller values and controls
-            controller.update_values(current_x, current_y, current_yaw, 
-                                     current_speed,
-                                     current_timestamp, frame)
-            controller.update_controls()
-            cmd_throttle, cmd_steer, cmd_brake = controller.get_commands()
-
-            # Skip the first frame (so the controller has proper outputs)
-            if skip_first_frame and frame == 0:
-                pass
-            else:
-                # Update live plotter with new feedback
-                trajectory_fig.roll("trajectory", current_x, current_y)
-                trajectory_fig.roll("car", current_x, current_y)
-                # When plotting lookahead path, only plot a number of points
-                # (INTERP_MAX_POINTS_PLOT amount of points). This is meant
-                # to decrease load when live plotting
-                new_waypoints_np = np.array(new_waypoints)
-                path_indices = np.floor(np.linspace(0, 
-                                                    new_waypoints_np.shape[0]-1,
-                                                    INTERP_MAX_POINTS_PLOT))
-                trajectory_fig.update("lookahead_path", 
-                        new_waypoints_np[path_indices.astype(int), 0],
-                        new_waypoints_np[path_indices.astype(int), 1],
-                        new_colour=[0, 0.7, 0.7])
-                forward_speed_fig.roll("forward_speed", 
-                                       current_timestamp, 
-                                       current_speed)
-                forward_speed_fig.roll("reference_signal", 
-                                       current_timestamp, 
-                                       controller._desired_speed)
-
-                throttle_fig.roll("throttle", current_timestamp, cmd_throttle)
-                brake_fig.roll("brake", current_timestamp, cmd_brake)
-                steer_fig.roll("steer", current_timestamp, cmd_steer)
-
-                # Refresh the live plot based on the refresh rate 
-                # set by the options
-                if enable_live_plot and \
-                   live_plot_timer.has_exceeded_lap_period():
-                    lp_traj.refresh()
-                    lp_1d.refresh()
-                    live_plot_timer.lap()
-
-            # Output controller command to CARLA server
-            send_control_command(client,
-                                 throttle=cmd_throttle,
-                                 steer=cmd_steer,
-                                 brake=cmd_brake)
-
-            # Find if reached the end of waypoint. If the car is within
-            # DIST_THRESHOLD_TO_LAST_WAYPOINT to the last waypoint,
-            # the simulation will end.
-            dist_to_last_waypoint = np.linalg.norm(np.array([
-                waypoints[-1][0] - current_x,
-                waypoints[-1][1] - current_y]))
-            if  dist_to_last_waypoint < DIST_THRESHOLD_TO_LAST_WAYPOINT:
-                reached_the_end = True
+            # End of demo - Stop vehicle and Store outputs to the controller
+            # output directory.
             if reached_the_end:
-                break
-
-        # End of demo - Stop vehicle and Store outputs to the controller output
-        # directory.
-        if reached_the_end:
-            print("Reached the end of path. Writing to controller_output...")
-        else:
-            print("Exceeded assessment time. Writing to controller_output...")
-        # Stop the car
-        send_control_command(client, throttle=0.0, steer=0.0, brake=1.0)
-        # Store the various outputs
-        store_trajectory_plot(trajectory_fig.fig, 'trajectory.png')
-        store_trajectory_plot(forward_speed_fig.fig, 'forward_speed.png')
-        store_trajectory_plot(throttle_fig.fig, 'throttle_output.png')
-        store_trajectory_plot(brake_fig.fig, 'brake_output.png')
-        store_trajectory_plot(steer_fig.fig, 'steer_output.png')
-        write_trajectory_file(x_history, y_history, speed_history, time_history)
+                print("Reached the end of path. "
+                      "Writing to controller_output...")
+            else:
+                print("Exceeded assessment time. "
+                      "Writing to controller_output...")
+            # Stop the car
+            send_control_command(client, throttle=0.0, steer=0.0, brake=1.0)
+        finally:
+            # Store the various outputs (the plotting process saves the
+            # figures once it has drawn the last samples). The plotting
+            # process is stopped even when the episode fails, else it
+            # keeps waiting for samples and the demo never exits. The
+            # telemetry and the stage trace of the frames run so far are
+            # written, and the paged route stops its prefetch thread.
+            live_plot.close()
+            if telemetry_writer is not None:
+                telemetry_writer.close()
+            if args.profile_stages:
+                print(profiler.report())
+                profiler.close()
+            pipeline.close()
+            if route is not None:
+                route.close()
+        write_trajectory_file(history)
 
 def main():
     """Main function.
@@ -680,6 +639,10 @@ def main():
         -q, --quality-level: graphics quality level [Low or Epic]
         -i, --images-to-disk: save images to disk
         -c, --carla-settings: Path to CarlaSettings.ini file
+        --headless: run against the local kinematic simulator
+        --profile-stages: print the latency of every frame loop stage
+        --stage-trace: write the per-frame stage latencies to a CSV file
+                       (implies --profile-stages)
     """
     argparser = argparse.ArgumentParser(description=__doc__)
     argparser.add_argument(
@@ -714,7 +677,24 @@ def main():
         dest='settings_filepath',
         default=None,
         help='Path to a "CarlaSettings.ini" file')
+    argparser.add_argument(
+        '--headless',
+        action='store_true',
+        help='run against the local kinematic simulator instead of CARLA')
+    argparser.add_argument(
+        '--profile-stages',
+        action='store_true',
+        help='print p50/p99/max latency of every frame loop stage at the '
+             'end of the episode')
+    argparser.add_argument(
+        '--stage-trace',
+        metavar='PATH',
+        default=None,
+        help='also write the per-frame stage latencies (ns) to a CSV file '
+             '(implies --profile-stages)')
     args = argparser.parse_args()
+    if args.stage_trace is not None:
+        args.profile_stages = True
 
     # Logging startup info
     log_level = logging.DEBUG if args.debug else logging.INFO
@@ -724,13 +704,14 @@ def main():
     args.out_filename_format = '_out/episode_{:0>4d}/{:s}/{:0>6d}'
 
     # Execute when server connection is established
+    retry_errors = connection_errors(args)
     while True:
         try:
             exec_waypoint_nav_demo(args)
             print('Done.')
             return
 
-        except TCPConnectionError as error:
+        except retry_errors as error:
             logging.error(error)
             time.sleep(1)
 
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+
+"""
+Deadline-bounded model predictive control of the lateral and longitudinal
+commands.
+
+The vehicle is predicted with the kinematic bicycle model of the headless
+simulator (kinematic_sim.py) over a short horizon of acceleration and
+steering commands. The command sequences are optimized by sampling: every
+iteration rolls out a batch of perturbed sequences at once in NumPy, scores
+them against the waypoint window and moves the mean sequence towards the
+low cost ones (path integral / MPPI update). The loop stops when the time
+budget of the tick runs out, and the best sequence found so far is used.
+The solution of the previous tick, shifted by the elapsed time, is the
+first candidate of the next one (warm start).
+"""
+import time
+import numpy as np
+
+import kinematic_sim
+
+MPC_HORIZON       = 15      # number of predicted steps
+MPC_TIME_STEP     = 0.1     # seconds per predicted step
+MPC_NUM_SAMPLES   = 64      # candidate command sequences per iteration
+MPC_TIME_BUDGET   = 0.005   # seconds of compute per tick (None: no limit)
+MPC_MAX_ITERATIONS = 8      # iterations per tick
+MPC_PATH_SPACING  = 0.5     # m, spacing of the path points scored against
+MPC_SPEED_PREVIEW = 2.0     # m, the reference speed of a point is read this
+                            # far ahead (a car at rest on a waypoint with no
+                            # speed would otherwise never start)
+MAX_STEER         = 1.22    # rad, steering limit of Controller2D
+
+# Cost weights. Any subset can be overridden per solver instance.
+DEFAULT_WEIGHTS = {
+    'lateral':    4.0,      # squared distance to the path (per m^2)
+    'heading':    2.0,      # squared heading error to the path (per rad^2)
+    'speed':      0.5,      # squared error to the reference speed
+    'steer':      0.1,      # squared steering angle
+    'steer_rate': 20.0,     # squared change of steering per step
+    'accel':      0.01,     # squared acceleration command
+    'accel_rate': 0.05,     # squared change of acceleration per step
+    'terminal':   5.0,      # weight of the last step relative to the others
+}
+
+class MPCSolver(object):
+    """ MPC Solver
+
+    The decision variables are the commanded acceleration (m/s^2, negative
+    when braking) and front wheel angle (rad) of every step of the horizon.
+    solve() returns the first command of the best sequence, or None when
+    not a single iteration finished within the time budget, in which case
+    the caller keeps its own (geometric) law for the tick.
+
+    Solve statistics are counted in num_solves, num_fallbacks (no
+    solution) and num_timeouts (stopped by the budget before
+    max_iterations), and last_iterations / last_solve_time describe the
+    last tick.
+    """
+    def __init__(self, horizon=MPC_HORIZON, time_step=MPC_TIME_STEP,
+                 num_samples=MPC_NUM_SAMPLES, time_budget=MPC_TIME_BUDGET,
+                 max_iterations=MPC_MAX_ITERATIONS, weights=None,
+                 path_spacing=MPC_PATH_SPACING,
+                 speed_preview=MPC_SPEED_PREVIEW, seed=0):
+        """
+        Args:
+            horizon: Number of predicted steps
+            time_step: Duration of a predicted step in seconds
+            num_samples: Candidate sequences rolled out per iteration
+            time_budget: Compute budget per tick in seconds (None for no
+                         limit, then max_iterations always run)
+            max_iterations: Maximum number of iterations per tick
+            weights: Cost weights overriding DEFAULT_WEIGHTS
+            path_spacing: Spacing of the path points in meters
+            speed_preview: Distance ahead of a path point its reference
+                           speed is read at, in meters
+            seed: Seed of the sampling noise
+        """
+        if horizon < 1 or num_samples < 2:
+            raise ValueError('the horizon must be positive and there must '
+                             'be at least 2 samples')
+        self.horizon        = int(horizon)
+        self.time_step      = float(time_step)
+        self.num_samples    = int(num_samples)
+        self.time_budget    = time_budget
+        self.max_iterations = int(max_iterations)
+        self.path_spacing   = float(path_spacing)
+        self.speed_preview  = float(speed_preview)
+        self.weights        = dict(DEFAULT_WEIGHTS)
+        if weights:
+            unknown = set(weights) - set(DEFAULT_WEIGHTS)
+            if unknown:
+                raise ValueError('unknown MPC weights: %s' %
+                                 ', '.join(sorted(unknown)))
+            self.weights.update(weights)
+
+        self.wheelbase  = kinematic_sim.WHEELBASE
+        self.max_accel  = kinematic_sim.MAX_ACCELERATION
+        self.max_decel  = kinematic_sim.MAX_DECELERATION
+        # Sampling spread of the acceleration and steering commands
+        self.sigma      = np.array([1.5, 0.15])
+        self.lower      = np.array([-self.max_decel, -MAX_STEER])
+        self.upper      = np.array([self.max_accel, MAX_STEER])
+        # Cost of every step, the last one weighted as the terminal cost
+        self._step_weight = np.ones(self.horizon)
+        self._step_weight[-1] = self.weights['terminal']
+
+        self._rng       = np.random.default_rng(seed)
+        self.reset()
+
+    def reset(self):
+        """Drops the warm start and the statistics.
+        """
+        self._solution      = np.zeros((self.horizon, 2))
+        self._solution_time = None
+        self._last_command  = np.zeros(2)
+        self._iteration_time = 0.0     # running estimate of one iteration
+        self.num_solves      = 0
+        self.num_fallbacks   = 0
+        self.num_timeouts    = 0
+        self.last_iterations = 0
+        self.last_solve_time = 0.0
+
+    def _warm_start(self, timestamp):
+        # Shift the previous solution by the time elapsed since it was
+        # computed, holding the last command at the end of the horizon
+        if self._solution_time is None:
+            return self._solution.copy()
+        elapsed = min(max(timestamp - self._solution_time, 0.0),
+                      self.horizon * self.time_step)
+        steps = np.arange(self.horizon) * self.time_step
+        shifted = np.empty_like(self._solution)
+        for column in range(2):
+            shifted[:, column] = np.interp(steps + elapsed, steps,
+                                           self._solution[:, column])
+        return shifted
+
+    def _reference(self, waypoints):
+        # Path points every path_spacing meters of the window, with the
+        # unit tangent and the (previewed) reference speed at each point
+        segments = np.hypot(np.diff(waypoints[:, 0]), np.diff(waypoints[:, 1]))
+        arc_length = np.concatenate(([0.0], np.cumsum(segments)))
+        if arc_length[-1] <= 0.0:
+            return None
+        samples = np.arange(0.0, arc_length[-1], self.path_spacing)
+        rows    = np.searchsorted(arc_length, samples)
+        points  = waypoints[np.append(rows, waypoints.shape[0] - 1), :2]
+        tangent = np.diff(points, axis=0)
+        length  = np.hypot(tangent[:, 0], tangent[:, 1])
+        keep    = length > 0.0
+        if not np.any(keep):
+            return None
+        speeds  = np.interp(samples + self.speed_preview, arc_length,
+                            waypoints[:, 2])
+        return (points[:-1][keep], tangent[keep] / length[keep, None],
+                speeds[keep])
+
+    def rollout(self, x, y, yaw, speed, commands):
+        """Predicts the states of a batch of command sequences.
+
+        Args:
+            x, y, yaw, speed: Current state (m, m, rad, m/s)
+            commands: (K, horizon, 2) [acceleration, wheel angle] sequences
+
+        Returns: (K, horizon, 4) predicted [x, y, yaw, speed] after every
+                 step
+        """
+        dt = self.time_step
+        # Speed clipped at zero every step: the cumulative sum reflected at
+        # zero (v_k = S_k - min(0, min_j<=k S_j)), so the whole horizon is
+        # integrated without a Python loop over the steps
+        total = float(speed) + np.cumsum(commands[..., 0]*dt, axis=1)
+        speed_after = total - np.minimum(np.minimum.accumulate(total, axis=1),
+                                         0.0)
+        speed_before = np.empty_like(speed_after)
+        speed_before[:, 0]  = speed
+        speed_before[:, 1:] = speed_after[:, :-1]
+        mean_v   = 0.5 * (speed_before + speed_after)
+        yaw_rate = mean_v * np.tan(commands[..., 1]) / self.wheelbase
+        yaw_after = float(yaw) + np.cumsum(yaw_rate*dt, axis=1)
+        mid_yaw   = yaw_after - 0.5*dt*yaw_rate
+
+        states = np.empty(commands.shape[:2] + (4,))
+        states[..., 0] = float(x) + np.cumsum(mean_v*np.cos(mid_yaw)*dt, axis=1)
+        states[..., 1] = float(y) + np.cumsum(mean_v*np.sin(mid_yaw)*dt, axis=1)
+        states[..., 2] = yaw_after
+        states[..., 3] = speed_after
+        return states
+
+    def cost(self, states, commands, reference):
+        """Cost of every predicted sequence.
+
+        Args:
+            states: (K, horizon, 4) states from rollout()
+            commands: (K, horizon, 2) command sequences
+            reference: Path points, tangents and speeds (see _reference)
+
+        Returns: (K,) costs
+        """
+        points, tangents, speeds = reference
+        weights = self.weights
+        state_x = states[..., 0]
+        state_y = states[..., 1]
+        nearest = np.argmin((state_x[..., None] - points[:, 0])**2 +
+                            (state_y[..., None] - points[:, 1])**2, axis=2)
+        offset_x  = state_x - points[nearest, 0]
+        offset_y  = state_y - points[nearest, 1]
+        tangent_x = tangents[nearest, 0]
+        tangent_y = tangents[nearest, 1]
+        # Signed distance along the path normal and heading error
+        lateral = tangent_x*offset_y - tangent_y*offset_x
+        heading = np.remainder(states[..., 2] - np.arctan2(tangent_y,
+                                                           tangent_x) +
+                               np.pi, 2.0*np.pi) - np.pi
+        speed   = states[..., 3] - speeds[nearest]
+
+        step_cost = (weights['lateral']*lateral**2 +
+                     weights['heading']*heading**2 +
+                     weights['speed']*speed**2 +
+                     weights['accel']*commands[..., 0]**2 +
+                     weights['steer']*commands[..., 1]**2)
+        rates = np.diff(commands, axis=1, prepend=np.broadcast_to(
+                self._last_command, (commands.shape[0], 1, 2)))
+        step_cost += (weights['accel_rate']*rates[..., 0]**2 +
+                      weights['steer_rate']*rates[..., 1]**2)
+        return np.dot(step_cost, self._step_weight) / self.horizon
+
+    def solve(self, x, y, yaw, speed, waypoints, timestamp=None,
+              fallback=None):
+        """Optimizes the commands of the current tick.
+
+        Args:
+            x, y, yaw, speed: Current state (m, m, rad, m/s)
+            waypoints: (N, 3) array of [x, y, v] waypoints ahead of the car
+            timestamp: Current time in seconds, used to shift the previous
+                       solution (None: shift by one tick of time_step)
+            fallback: Optional [acceleration, wheel angle] command of another
+                      law, held over the horizon as an extra candidate
+
+        Returns: (acceleration, wheel_angle) of the first step, or None if no
+                 iteration finished within the time budget
+        """
+        start = time.perf_counter()
+        deadline = None
+        if self.time_budget is not None:
+            deadline = start + self.time_budget
+        if timestamp is None:
+            timestamp = (0.0 if self._solution_time is None else
+                         self._solution_time + self.time_step)
+        self.num_solves += 1
+        self.last_iterations = 0
+
+        reference = self._reference(np.asarray(waypoints, dtype=np.float64))
+        if reference is None:
+            self.num_fallbacks += 1
+            self.last_solve_time = time.perf_counter() - start
+            return None
+
+        mean = self._warm_start(timestamp)
+        best, best_cost = None, np.inf
+        sigma = self.sigma
+        for iteration in range(self.max_iterations):
+            # An iteration only starts if it is expected to finish within
+            # the budget, which bounds the tail latency of the tick
+            iteration_start = time.perf_counter()
+            if deadline is not None and\
+               iteration_start + self._iteration_time >= deadline:
+                # Let the estimate decay, so that one slow iteration does
+                # not disable the solver for good
+                self._iteration_time *= 0.9
+                self.num_timeouts += 1
+                break
+            noise = self._rng.standard_normal((self.num_samples,
+                                               self.horizon, 2)) * sigma
+            noise[0] = 0.0          # the mean itself
+            candidates = mean[None] + noise
+            if fallback is not None and iteration == 0:
+                candidates[1] = fallback
+            np.clip(candidates, self.lower, self.upper, out=candidates)
+
+            states = self.rollout(x, y, yaw, speed, candidates)
+            costs  = self.cost(states, candidates, reference)
+            costs  = np.where(np.isfinite(costs), costs, np.inf)
+            lowest = int(np.argmin(costs))
+            self.last_iterations = iteration + 1
+            if np.isfinite(costs[lowest]):
+                if costs[lowest] < best_cost:
+                    best, best_cost = candidates[lowest].copy(), costs[lowest]
+                # Move the mean towards the low cost candidates
+                spread = np.std(costs[np.isfinite(costs)]) + 1e-9
+                weight = np.exp(-(costs - costs[lowest]) / spread)
+                mean   = np.tensordot(weight / np.sum(weight), candidates,
+                                      axes=1)
+                sigma  = sigma * 0.7
+            self._iteration_time = max(time.perf_counter() - iteration_start,
+                                       0.9*self._iteration_time)
+
+        self.last_solve_time = time.perf_counter() - start
+        if best is None:
+            self.num_fallbacks += 1
+            return None
+        self._solution      = best
+        self._solution_time = timestamp
+        self._last_command  = best[0].copy()
+        return float(best[0, 0]), float(best[0, 1])
+
+    def pedals(self, acceleration, speed):
+        """Throttle and brake that give an acceleration at a speed.
+
+        Inverts the longitudinal model of kinematic_sim (drag and rolling
+        resistance included).
+
+        Returns: (throttle, brake) in [0, 1]
+        """
+        resistance = kinematic_sim.DRAG_COEFFICIENT * speed**2
+        if speed > 0.0:
+            resistance += kinematic_sim.ROLLING_RESISTANCE
+        net = acceleration + resistance
+        if net >= 0.0:
+            return min(net / self.max_accel, 1.0), 0.0
+        return 0.0, min(-net / self.max_decel, 1.0)
+
+    def acceleration(self, throttle, brake, speed):
+        """Acceleration of the model for throttle and brake commands.
+        """
+        resistance = kinematic_sim.DRAG_COEFFICIENT * speed**2
+        if speed > 0.0:
+            resistance += kinematic_sim.ROLLING_RESISTANCE
+        return self.max_accel*throttle - self.max_decel*brake - resistance
@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+
+"""
+Array backed, lazily evaluated linear interpolation of a waypoint path.
+
+Running this script compiles a waypoint file into binary path artifacts
+that are memory-mapped by later runs (see load_compiled_path): the path
+table and the dense path points. An artifact is a small header
+(PATH_CACHE_HEADER) followed by the raw records, like the telemetry file.
+The header holds the SHA-1 digest of the waypoint file it was compiled
+from, which confirms that an artifact matches the waypoint contents when
+the file was only touched.
+"""
+from __future__ import print_function
+
+import argparse
+import csv
+import glob
+import hashlib
+import os
+import struct
+import numpy as np
+
+PATH_CACHE_VERSION = 2          # bump when the artifact layout changes
+PATH_CACHE_MAGIC   = b'SDCPTH'
+PATH_CACHE_HEADER  = struct.Struct('<6sHQd20s')
+                                # magic, version, record size, resolution,
+                                # SHA-1 of the waypoint file contents
+PATH_CACHE_DTYPE   = np.dtype([
+    ('waypoint',   np.float64, (3,)),   # [x, y, v]
+    ('distance',   np.float64),         # x,y distance to the next waypoint
+    ('arc_length', np.float64),         # cumulative x,y distance
+    ('hash',       np.int64),           # index of the waypoint in the path
+    ('uvector',    np.float64, (3,)),   # unit vector to the next waypoint
+])
+DENSE_DTYPE        = np.dtype((np.float64, (3,)))  # [x, y, v] dense point
+DENSE_CHUNK        = 1 << 20    # dense points computed per compile step
+
+class InterpolatedPath(object):
+    """ Interpolated Path
+
+    Stand-in for the densified waypoint list ("wp_interp") built by the
+    waypoint follower demo. Only the original waypoints, their segment
+    lengths and the index of each waypoint in the dense path are stored.
+    Interpolated points are computed when a slice of the path is requested
+    and are returned as a contiguous (rows, 3) NumPy array of [x, y, v].
+
+    The dense path follows the original construction exactly: every
+    waypoint is followed by floor(d / resolution) - 1 points spaced
+    resolution apart along the direction to the next waypoint, where d is
+    the x,y distance between the two waypoints.
+    """
+    def __init__(self, waypoints, resolution):
+        """
+        Args:
+            waypoints: Waypoints as [[x0, y0, v0], ...] or an (N, 3) array
+            resolution: Distance between interpolated points in meters
+        """
+        self.waypoints  = np.ascontiguousarray(waypoints, dtype=np.float64)
+        self.resolution = float(resolution)
+
+        # Distance from each waypoint to the next one (0 for the last one)
+        deltas        = np.diff(self.waypoints, axis=0)
+        self.distance = np.zeros(self.waypoints.shape[0])
+        self.distance[:-1] = np.sqrt(deltas[:, 0]**2 + deltas[:, 1]**2)
+
+        # Cumulative x,y arc length at each waypoint
+        self.arc_length = np.concatenate(([0.0],
+                                          np.cumsum(self.distance[:-1])))
+
+        # Unit vector of each segment. Zero length segments never get
+        # interpolated points, keep their direction at zero.
+        norms = np.linalg.norm(deltas, axis=1)
+        self._uvectors = np.zeros_like(self.waypoints)
+        valid = norms > 0
+        self._uvectors[:-1][valid] = deltas[valid] / norms[valid, None]
+
+        # Index of each waypoint in the dense path ("wp_interp_hash")
+        num_interp = np.floor(self.distance[:-1] / self.resolution) - 1
+        num_interp = np.maximum(num_interp, 0).astype(np.int64)
+        self.hash = np.zeros(self.waypoints.shape[0], dtype=np.int64)
+        self.hash[1:] = np.cumsum(num_interp + 1)
+        self._dense = None
+
+    @classmethod
+    def from_table(cls, table, resolution, dense=None):
+        """Creates a path from a table made by to_table, without copying.
+
+        Args:
+            table: Structured array with the PATH_CACHE_DTYPE layout
+            resolution: Distance between interpolated points in meters
+            dense: Optional read-only (len(path), 3) array of the dense
+                   points (e.g. the memory-mapped dense artifact)
+        """
+        path = cls.__new__(cls)
+        path.waypoints  = table['waypoint']
+        path.resolution = float(resolution)
+        path.distance   = table['distance']
+        path.arc_length = table['arc_length']
+        path.hash       = table['hash']
+        path._uvectors  = table['uvector']
+        path._dense     = dense
+        return path
+
+    def to_table(self):
+        """Packs the path arrays into a PATH_CACHE_DTYPE structured array.
+        """
+        table = np.empty(self.waypoints.shape[0], dtype=PATH_CACHE_DTYPE)
+        table['waypoint']   = self.waypoints
+        table['distance']   = self.distance
+        table['arc_length'] = self.arc_length
+        table['hash']       = self.hash
+        table['uvector']    = self._uvectors
+        return table
+
+    def __len__(self):
+        return int(self.hash[-1]) + 1 if self.hash.shape[0] else 0
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            return self.points(np.arange(start, stop, step))
+        index = int(key)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('interpolated path index out of range')
+        return self.points(np.array([index]))[0]
+
+    def window(self, first_index, last_index):
+        """Returns the dense path between two original waypoints.
+
+        Args:
+            first_index: Index of the first waypoint of the window
+            last_index: Index of the last waypoint of the window (inclusive)
+
+        Returns: points
+            points: (rows, 3) array of [x, y, v], equal to
+                    wp_interp[wp_interp_hash[first_index]:
+                              wp_interp_hash[last_index] + 1]
+        """
+        return self[self.hash[first_index]:self.hash[last_index] + 1]
+
+    def dense(self):
+        """Returns the whole dense path as one read-only array.
+
+        The points are computed on the first call and kept, so that
+        window_view can hand out views of them. Paths loaded with
+        load_compiled_path memory-map them instead, other paths should
+        call dense() once at startup rather than in the control loop.
+
+        Returns: points
+            points: (len(self), 3) read-only array of [x, y, v]
+        """
+        if self._dense is None:
+            dense = self[:]
+            dense.flags.writeable = False
+            self._dense = dense
+        return self._dense
+
+    def window_view(self, first_index, last_index):
+        """Same as window, as a read-only view into the dense path.
+
+        No point is computed or copied per call once dense() exists.
+        """
+        return self.dense()[self.hash[first_index]:self.hash[last_index] + 1]
+
+    def expand(self, values):
+        """Expands per-waypoint values to every point of the dense path.
+
+        Each dense point takes the value of the waypoint it starts from,
+        so windows of the result line up with window_view.
+
+        Args:
+            values: (N,) array with one value per original waypoint
+
+        Returns: (len(self),) array
+        """
+        counts = np.diff(self.hash, append=self.hash[-1] + 1)
+        return np.repeat(np.asarray(values), counts)
+
+    def points(self, indices):
+        """Computes the dense path points at the given dense indices.
+
+        Args:
+            indices: Array of indices into the dense path
+
+        Returns: points
+            points: (len(indices), 3) contiguous array of [x, y, v]
+        """
+        segment = np.searchsorted(self.hash, indices, side='right') - 1
+        offset  = (indices - self.hash[segment]).astype(np.float64)
+        return self.waypoints[segment] +\
+               (self.resolution * offset)[:, None] * self._uvectors[segment]
+
+def read_waypoints_file(waypoints_file):
+    """Parses a waypoint file of "x, y, v" rows into an (N, 3) array.
+
+    Raises ValueError when the file has no rows or a row without exactly
+    three values.
+    """
+    with open(waypoints_file) as waypoints_file_handle:
+        waypoints = list(csv.reader(waypoints_file_handle,
+                                    delimiter=',',
+                                    quoting=csv.QUOTE_NONNUMERIC))
+    if not waypoints:
+        raise ValueError('%s has no waypoints' % waypoints_file)
+    for line, row in enumerate(waypoints):
+        if len(row) != 3:
+            raise ValueError('%s: line %d has %d values, expected "x, y, v"'
+                             % (waypoints_file, line + 1, len(row)))
+    return np.array(waypoints, dtype=np.float64)
+
+def waypoints_digest(waypoints_file):
+    """Returns the SHA-1 digest (20 bytes) of the contents of a file.
+    """
+    digest = hashlib.sha1()
+    with open(waypoints_file, 'rb') as waypoints_file_handle:
+        for chunk in iter(lambda: waypoints_file_handle.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+def compiled_path_filename(waypoints_file, resolution, kind='path'):
+    """Returns the artifact file name for a waypoint file and resolution.
+
+    The name holds a key of the size and modification time of the waypoint
+    file, the resolution and PATH_CACHE_VERSION, so finding the artifact
+    costs one stat() however large the file is, while edited files or
+    changed parameters never pick up a stale artifact.
+
+    Args:
+        waypoints_file: Path to the "x, y, v" waypoint file
+        resolution: Distance between interpolated points in meters
+        kind: 'path' for the path table, 'dense' for the dense points
+    """
+    stat = os.stat(waypoints_file)
+    key  = hashlib.sha1(('%d:%d:%r:%d' % (
+            stat.st_size, stat.st_mtime_ns, float(resolution),
+            PATH_CACHE_VERSION)).encode('ascii'))
+    return '%s.%s.%s.bin' % (waypoints_file, key.hexdigest()[:16], kind)
+
+def _artifact_dtype(kind):
+    return PATH_CACHE_DTYPE if kind == 'path' else DENSE_DTYPE
+
+def read_artifact_header(artifact_file, kind='path'):
+    """Reads and checks the header of a path artifact.
+
+    Returns: (resolution, digest)
+        resolution: Distance between interpolated points in meters
+        digest: SHA-1 digest of the waypoint file it was compiled from
+    """
+    with open(artifact_file, 'rb') as artifact_file_handle:
+        header = artifact_file_handle.read(PATH_CACHE_HEADER.size)
+    if len(header) < PATH_CACHE_HEADER.size:
+        raise ValueError('%s is not a path artifact' % artifact_file)
+    magic, version, itemsize, resolution, digest = \
+            PATH_CACHE_HEADER.unpack(header)
+    if magic != PATH_CACHE_MAGIC:
+        raise ValueError('%s is not a path artifact' % artifact_file)
+    if version != PATH_CACHE_VERSION or \
+       itemsize != _artifact_dtype(kind).itemsize:
+        raise ValueError('%s has path artifact version %d, expected %d' %
+                         (artifact_file, version, PATH_CACHE_VERSION))
+    return resolution, digest
+
+def _write_artifact_header(artifact_file_handle, kind, resolution, digest):
+    artifact_file_handle.write(PATH_CACHE_HEADER.pack(
+            PATH_CACHE_MAGIC, PATH_CACHE_VERSION,
+            _artifact_dtype(kind).itemsize, float(resolution), digest))
+
+def _reuse_artifact(waypoints_file, artifact_file, kind, resolution, digest):
+    """Renames an artifact of the same waypoint contents and resolution
+    (e.g. compiled before a checkout touched the waypoint file) to
+    artifact_file. Returns whether one was found.
+    """
+    pattern = '%s.*.%s.bin' % (glob.escape(waypoints_file), kind)
+    for candidate in glob.glob(pattern):
+        try:
+            candidate_resolution, candidate_digest = \
+                    read_artifact_header(candidate, kind)
+        except (OSError, ValueError):
+            continue
+        if candidate_digest == digest and \
+           candidate_resolution == float(resolution):
+            os.replace(candidate, artifact_file)
+            return True
+    return False
+
+def read_artifact(artifact_file, kind='path'):
+    """Memory-maps the records of a path artifact.
+
+    Returns: Structured array with the PATH_CACHE_DTYPE layout for a
+             'path' artifact, (N, 3) array of [x, y, v] for a 'dense' one
+    """
+    read_artifact_header(artifact_file, kind)
+    dtype = _artifact_dtype(kind)
+    num_records = ((os.path.getsize(artifact_file) - PATH_CACHE_HEADER.size)
+                   // dtype.itemsize)
+    if kind == 'path':
+        return np.memmap(artifact_file, dtype=dtype, mode='r',
+                         offset=PATH_CACHE_HEADER.size, shape=(num_records,))
+    return np.memmap(artifact_file, dtype=np.float64, mode='r',
+                     offset=PATH_CACHE_HEADER.size, shape=(num_records, 3))
+
+def compile_path(waypoints_file, resolution):
+    """Compiles a waypoint file into a binary path artifact next to it.
+
+    An artifact compiled from the same contents under an older key (see
+    compiled_path_filename) is renamed instead.
+
+    Args:
+        waypoints_file: Path to the "x, y, v" waypoint file
+        resolution: Distance between interpolated points in meters
+
+    Returns: artifact_file
+        artifact_file: Path of the written artifact
+    """
+    artifact_file = compiled_path_filename(waypoints_file, resolution)
+    digest = waypoints_digest(waypoints_file)
+    if _reuse_artifact(waypoints_file, artifact_file, 'path', resolution,
+                       digest):
+        return artifact_file
+    table = InterpolatedPath(read_waypoints_file(waypoints_file),
+                             resolution).to_table()
+
+    # Write to a temporary file first so readers never see a partial file
+    tmp_file = '%s.%d.tmp' % (artifact_file, os.getpid())
+    try:
+        with open(tmp_file, 'wb') as tmp_file_handle:
+            _write_artifact_header(tmp_file_handle, 'path', resolution,
+                                   digest)
+            tmp_file_handle.write(table.tobytes())
+        os.replace(tmp_file, artifact_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return artifact_file
+
+def compile_dense(waypoints_file, resolution):
+    """Compiles the dense points of a waypoint file into an artifact next
+    to it, DENSE_CHUNK points at a time.
+
+    Args:
+        waypoints_file: Path to the "x, y, v" waypoint file
+        resolution: Distance between interpolated points in meters
+
+    Returns: artifact_file
+        artifact_file: Path of the written artifact
+    """
+    artifact_file = compiled_path_filename(waypoints_file, resolution,
+                                           'dense')
+    table_file = compiled_path_filename(waypoints_file, resolution)
+    if not os.path.exists(table_file):
+        compile_path(waypoints_file, resolution)
+    _, digest = read_artifact_header(table_file)
+    if _reuse_artifact(waypoints_file, artifact_file, 'dense', resolution,
+                       digest):
+        return artifact_file
+    path = InterpolatedPath.from_table(read_artifact(table_file), resolution)
+
+    tmp_file = '%s.%d.tmp' % (artifact_file, os.getpid())
+    try:
+        with open(tmp_file, 'wb') as tmp_file_handle:
+            _write_artifact_header(tmp_file_handle, 'dense', resolution,
+                                   digest)
+            tmp_file_handle.truncate(PATH_CACHE_HEADER.size +
+                                     len(path) * DENSE_DTYPE.itemsize)
+        dense = np.memmap(tmp_file, dtype=np.float64, mode='r+',
+                          offset=PATH_CACHE_HEADER.size,
+                          shape=(len(path), 3))
+        for start in range(0, len(path), DENSE_CHUNK):
+            stop = min(start + DENSE_CHUNK, len(path))
+            dense[start:stop] = path.points(np.arange(start, stop))
+        dense.flush()
+        del dense
+        os.replace(tmp_file, artifact_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return artifact_file
+
+def load_compiled_table(waypoints_file, resolution):
+    """Memory-maps the compiled path table of a waypoint file, compiling
+    the waypoint file first when the artifact does not exist.
+
+    Args:
+        waypoints_file: Path to the "x, y, v" waypoint file
+        resolution: Distance between interpolated points in meters
+
+    Returns: table
+        table: Memory-mapped structured array with the PATH_CACHE_DTYPE
+               layout
+    """
+    artifact_file = compiled_path_filename(waypoints_file, resolution)
+    if not os.path.exists(artifact_file):
+        compile_path(waypoints_file, resolution)
+    return read_artifact(artifact_file)
+
+def load_compiled_path(waypoints_file, resolution):
+    """Loads the interpolated path of a waypoint file.
+
+    The compiled path table and dense points are memory-mapped when they
+    exist, otherwise the waypoint file is compiled first. Only the pages
+    of the dense points that are used get read.
+
+    Args:
+        waypoints_file: Path to the "x, y, v" waypoint file
+        resolution: Distance between interpolated points in meters
+
+    Returns: path
+        path: InterpolatedPath backed by the memory-mapped artifacts
+    """
+    table = load_compiled_table(waypoints_file, resolution)
+    dense_file = compiled_path_filename(waypoints_file, resolution, 'dense')
+    if not os.path.exists(dense_file):
+        compile_dense(waypoints_file, resolution)
+    # A plain array view of the memory map, memmap slices cost more
+    dense = read_artifact(dense_file, 'dense').view(np.ndarray)
+    return InterpolatedPath.from_table(table, resolution, dense)
+
+def main():
+    argparser = argparse.ArgumentParser(
+            description='Compile a waypoint file into path artifacts.')
+    argparser.add_argument(
+        'waypoints_file',
+        help='waypoint file with "x, y, v" rows')
+    argparser.add_argument(
+        '-r', '--resolution',
+        default=0.01,
+        type=float,
+        help='distance between interpolated points (default: 0.01)')
+    argparser.add_argument(
+        '--table-only',
+        action='store_true',
+        help='do not compile the dense points (routes only opened by '
+             'route_store.py)')
+    args = argparser.parse_args()
+
+    print(compile_path(args.waypoints_file, args.resolution))
+    if not args.table_only:
+        print(compile_dense(args.waypoints_file, args.resolution))
+
+if __name__ == '__main__':
+    main()
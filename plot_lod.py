@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+"""
+Level of detail buffers for the live plots.
+
+A DecimatedSeries keeps at most max_points points of a series of any
+length. Incoming samples are grouped in buckets of `factor` samples and
+each finished bucket is reduced to a fixed number of points. When the
+buffer is full, adjacent buckets are merged and the factor doubles, which
+moves the whole series one level up a min/max pyramid. Memory and the
+number of points to draw therefore stay constant however long the episode
+runs, while spikes stay visible in the min/max mode.
+"""
+import numpy as np
+
+MINMAX = 'minmax'   # keep the min and max sample of each bucket
+STRIDE = 'stride'   # keep the first sample of each bucket (2D paths)
+
+class DecimatedSeries(object):
+    """ Decimated Series
+
+    In MINMAX mode every bucket is reduced to its min and max y samples (in
+    the order they occurred), starting with buckets of 2 samples so that
+    the first level is lossless. In STRIDE mode every bucket is reduced to
+    its first sample, which suits x,y paths where both coordinates matter.
+    """
+    def __init__(self, max_points, mode=MINMAX):
+        """
+        Args:
+            max_points: Maximum number of points kept (a multiple of 4)
+            mode: MINMAX or STRIDE
+        """
+        if max_points < 4 or max_points % 4:
+            raise ValueError('max_points must be a positive multiple of 4, '
+                             'got %d' % max_points)
+        if mode not in (MINMAX, STRIDE):
+            raise ValueError('unknown decimation mode %r' % mode)
+        self.mode       = mode
+        self.max_points = int(max_points)
+        self.factor     = 2 if mode == MINMAX else 1
+        self.generation = 0     # incremented every time the buffer is merged
+        self.num_points = 0
+        self._x = np.empty(self.max_points)
+        self._y = np.empty(self.max_points)
+        self._bucket = []       # (x, y) samples of the unfinished bucket
+
+    def __len__(self):
+        return self.num_points
+
+    def append(self, x, y):
+        """Adds one sample.
+        """
+        self._bucket.append((x, y))
+        if len(self._bucket) < self.factor:
+            return
+        if self.mode == MINMAX:
+            ys = [sample[1] for sample in self._bucket]
+            first, second = sorted((int(np.argmin(ys)), int(np.argmax(ys))))
+            self._push(*self._bucket[first])
+            self._push(*self._bucket[second])
+        else:
+            self._push(*self._bucket[0])
+        self._bucket = []
+        if self.num_points == self.max_points:
+            self._merge()
+
+    def points(self):
+        """Returns the (x, y) arrays of the kept points, without copying.
+        """
+        return self._x[:self.num_points], self._y[:self.num_points]
+
+    def _push(self, x, y):
+        self._x[self.num_points] = x
+        self._y[self.num_points] = y
+        self.num_points += 1
+
+    def _merge(self):
+        half = self.num_points // 2
+        if self.mode == MINMAX:
+            # Each group of 4 points is 2 buckets of (min, max), keep the
+            # min and max of the group in time order
+            ys     = self._y[:self.num_points].reshape(-1, 4)
+            rows   = np.arange(ys.shape[0])
+            i_min  = np.argmin(ys, axis=1)
+            i_max  = np.argmax(ys, axis=1)
+            first  = 4*rows + np.minimum(i_min, i_max)
+            second = 4*rows + np.maximum(i_min, i_max)
+            keep   = np.column_stack((first, second)).ravel()
+        else:
+            keep = np.arange(0, self.num_points, 2)
+        self._x[:half] = self._x[keep]
+        self._y[:half] = self._y[keep]
+        self.num_points = half
+        self.factor *= 2
+        self.generation += 1
+
+def decimate_path(points, max_points):
+    """Keeps every stride-th row of a whole path and its last row (the
+    STRIDE mode over a path known in advance).
+
+    Args:
+        points: (N, ...) array of path points, e.g. [x, y, v] waypoints
+        max_points: Maximum number of rows kept (at least 2)
+
+    Returns: Array of at most max_points rows of points (points itself
+             when it has no more rows)
+    """
+    num_points = points.shape[0]
+    if num_points <= max_points:
+        return points
+    stride  = -(-(num_points - 1) // (max_points - 1))
+    indices = np.arange(0, num_points, stride)
+    if indices[-1] != num_points - 1:
+        indices = np.append(indices, num_points - 1)
+    return np.asarray(points[indices])
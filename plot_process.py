@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+
+"""
+Out-of-process live plotting of the waypoint follower.
+
+The control loop publishes one sample per frame into a ring of records in
+shared memory (SharedSampleRing). A separate plotting process owns the
+LivePlotter windows, consumes the samples at its own pace and saves the
+figures when the episode ends, so a slow GUI never delays the control
+commands sent to the simulator. The plotted series are decimated
+(plot_lod.py), so each graph holds at most PLOT_MAX_POINTS points however
+long the episode and the route are.
+"""
+import multiprocessing
+import os
+import time
+import numpy as np
+from multiprocessing import shared_memory
+
+import plot_lod
+
+PLOT_RING_CAPACITY = 4096   # samples buffered for the plotting process
+                            # (about 2 minutes at 30 Hz)
+PLOT_POLL_PERIOD   = 0.01   # seconds between polls when no sample is new
+PLOT_CLOSE_TIMEOUT = 60.0   # seconds allowed to save the figures on close
+PLOT_MAX_POINTS    = 2048   # points drawn per graph (level of detail)
+
+FIGSIZE_X_INCHES   = 8      # x figure size of feedback in inches
+FIGSIZE_Y_INCHES   = 8      # y figure size of feedback in inches
+PLOT_LEFT          = 0.1    # in fractions of figure width and height
+PLOT_BOT           = 0.1
+PLOT_WIDTH         = 0.8
+PLOT_HEIGHT        = 0.8
+
+def plot_sample_dtype(num_path_points):
+    """Record of one plotted frame, with num_path_points lookahead points.
+    """
+    return np.dtype([
+        ('time',          np.float64),
+        ('x',             np.float64),
+        ('y',             np.float64),
+        ('speed',         np.float64),
+        ('desired_speed', np.float64),
+        ('throttle',      np.float64),
+        ('brake',         np.float64),
+        ('steer',         np.float64),
+        ('path_x',        np.float64, (num_path_points,)),
+        ('path_y',        np.float64, (num_path_points,)),
+    ])
+
+class SharedSampleRing(object):
+    """ Shared Sample Ring
+
+    Single producer, single consumer ring of records in shared memory. The
+    producer writes a record and then increments the published count, so no
+    lock is taken on either side. The consumer copies the records published
+    since its last read and drops the ones the producer may have overwritten
+    while they were being copied (a consumer that falls more than capacity
+    records behind skips to the newest ones).
+    """
+    _HEADER_SIZE = 16   # int64 published count, int64 writer closed flag
+
+    def __init__(self, dtype, capacity, name=None):
+        """
+        Args:
+            dtype: Structured dtype of one record
+            capacity: Number of records in the ring
+            name: Name of an existing ring to attach to, or None to create
+                  a new one
+        """
+        self.dtype    = np.dtype(dtype)
+        self.capacity = int(capacity)
+        create = name is None
+        self._shm = shared_memory.SharedMemory(
+                name=name, create=create,
+                size=self._HEADER_SIZE + self.capacity*self.dtype.itemsize)
+        self._header  = np.ndarray((2,), dtype=np.int64, buffer=self._shm.buf)
+        self._records = np.ndarray((self.capacity,), dtype=self.dtype,
+                                   buffer=self._shm.buf,
+                                   offset=self._HEADER_SIZE)
+        if create:
+            self._header[:] = 0
+        self._num_read = 0
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @property
+    def writer_closed(self):
+        return bool(self._header[1])
+
+    def publish(self, *values):
+        """Writes one record given as the values of the dtype fields.
+        """
+        count = int(self._header[0])
+        self._records[count % self.capacity] = values
+        self._header[0] = count + 1
+
+    def close_writer(self):
+        self._header[1] = 1
+
+    def read_new(self):
+        """Returns a copy of the records published since the last read.
+        """
+        count = int(self._header[0])
+        first = max(self._num_read, count - self.capacity)
+        records = self._records[np.arange(first, count) % self.capacity]
+        # Records older than this may have been overwritten while copying
+        valid_first = int(self._header[0]) - self.capacity + 1
+        if first < valid_first:
+            records = records[valid_first - first:]
+        self._num_read = count
+        return records
+
+    def close(self, unlink=False):
+        self._header  = None
+        self._records = None
+        self._shm.close()
+        if unlink:
+            self._shm.unlink()
+
+class LivePlotProcess(object):
+    """ Live Plot Process
+
+    Starts the plotting process of an episode. publish() only copies a
+    sample into shared memory; close() asks the plotting process to draw
+    the remaining samples, save the figures and exit.
+    """
+    def __init__(self, waypoints_np, start_x, start_y,
+                 enable_live_plot=True, refresh_period=0.0,
+                 output_folder=None, num_path_points=10,
+                 max_points=PLOT_MAX_POINTS, capacity=PLOT_RING_CAPACITY):
+        """
+        Args:
+            waypoints_np: (N, 3) array of [x, y, v] waypoints to draw,
+                          decimated to max_points (plot_lod.decimate_path)
+                          before it is sent to the plotting process
+            start_x: Car X start position in meters
+            start_y: Car Y start position in meters
+            enable_live_plot: Show the plot windows while running
+            refresh_period: Minimum seconds between window refreshes
+            output_folder: Folder where the figures are saved on close
+                           (None to skip saving)
+            num_path_points: Number of lookahead path points per sample
+            max_points: Maximum number of points drawn per graph (a
+                        multiple of 4)
+            capacity: Number of samples buffered in shared memory
+        """
+        self.num_path_points = num_path_points
+        self._ring = SharedSampleRing(plot_sample_dtype(num_path_points),
+                                      capacity)
+        context = multiprocessing.get_context('spawn')
+        self._process = context.Process(
+                target=_plot_main,
+                args=(self._ring.name, num_path_points, capacity,
+                      plot_lod.decimate_path(np.asarray(waypoints_np),
+                                             max_points),
+                      start_x, start_y,
+                      max_points, enable_live_plot, refresh_period,
+                      output_folder),
+                name='live_plot')
+        self._process.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def publish(self, time, x, y, speed, desired_speed, throttle, brake,
+                steer, path_x, path_y):
+        """Publishes the sample of one frame.
+        """
+        self._ring.publish(time, x, y, speed, desired_speed, throttle, brake,
+                           steer, path_x, path_y)
+
+    def close(self, timeout=PLOT_CLOSE_TIMEOUT):
+        """Stops the plotting process once the figures are saved.
+        """
+        if self._ring is None:
+            return
+        self._ring.close_writer()
+        self._process.join(timeout)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+        self._ring.close(unlink=True)
+        self._ring = None
+
+class _LodGraph(object):
+    """Rolls the points of a DecimatedSeries into a live plot graph.
+    """
+    def __init__(self, figure, name, mode, max_points):
+        self.figure      = figure
+        self.name        = name
+        self.series      = plot_lod.DecimatedSeries(max_points, mode)
+        self._num_rolled = 0
+        self._generation = 0
+
+    def append(self, x, y):
+        self.series.append(x, y)
+
+    def flush(self):
+        """Rolls the points added since the last flush into the graph.
+
+        After the series is merged, the whole window is rolled again (padded
+        with the first point) so it only holds points of the merged level.
+        This happens once per doubling of the episode length.
+        """
+        xs, ys = self.series.points()
+        first = self._num_rolled
+        if self.series.generation != self._generation:
+            for _ in range(self.series.max_points - xs.shape[0]):
+                self.figure.roll(self.name, xs[0], ys[0])
+            first = 0
+            self._generation = self.series.generation
+        for i in range(first, xs.shape[0]):
+            self.figure.roll(self.name, xs[i], ys[i])
+        self._num_rolled = xs.shape[0]
+
+def _make_figures(lv, waypoints_np, start_x, start_y, max_points,
+                  num_path_points):
+    # Uses the live plotter to generate live feedback during the simulation
+    # The two feedback includes the trajectory feedback and
+    # the controller feedback (which includes the speed tracking).
+    lp_traj = lv.LivePlotter(tk_title="Trajectory Trace")
+    lp_1d = lv.LivePlotter(tk_title="Controls Feedback")
+
+    ###
+    # Add 2D position / trajectory plot
+    ###
+    trajectory_fig = lp_traj.plot_new_dynamic_2d_figure(
+            title='Vehicle Trajectory',
+            figsize=(FIGSIZE_X_INCHES, FIGSIZE_Y_INCHES),
+            edgecolor="black",
+            rect=[PLOT_LEFT, PLOT_BOT, PLOT_WIDTH, PLOT_HEIGHT])
+
+    trajectory_fig.set_invert_x_axis() # Because UE4 uses left-handed
+                                       # coordinate system the X
+                                       # axis in the graph is flipped
+    trajectory_fig.set_axis_equal()    # X-Y spacing should be equal in size
+
+    # Add waypoint markers
+    trajectory_fig.add_graph("waypoints", window_size=waypoints_np.shape[0],
+                             x0=waypoints_np[:,0], y0=waypoints_np[:,1],
+                             linestyle="-", marker="", color='g')
+    # Add trajectory markers
+    trajectory_fig.add_graph("trajectory", window_size=max_points,
+                             x0=[start_x]*max_points,
+                             y0=[start_y]*max_points,
+                             color=[1, 0.5, 0])
+    # Add lookahead path
+    trajectory_fig.add_graph("lookahead_path",
+                             window_size=num_path_points,
+                             x0=[start_x]*num_path_points,
+                             y0=[start_y]*num_path_points,
+                             color=[0, 0.7, 0.7],
+                             linewidth=4)
+    # Add starting position marker
+    trajectory_fig.add_graph("start_pos", window_size=1,
+                             x0=[start_x], y0=[start_y],
+                             marker=11, color=[1, 0.5, 0],
+                             markertext="Start", marker_text_offset=1)
+    # Add end position marker
+    trajectory_fig.add_graph("end_pos", window_size=1,
+                             x0=[waypoints_np[-1, 0]],
+                             y0=[waypoints_np[-1, 1]],
+                             marker="D", color='r',
+                             markertext="End", marker_text_offset=1)
+    # Add car marker
+    trajectory_fig.add_graph("car", window_size=1,
+                             marker="s", color='b', markertext="Car",
+                             marker_text_offset=1)
+
+    ###
+    # Add 1D speed profile updater
+    ###
+    forward_speed_fig =\
+            lp_1d.plot_new_dynamic_figure(title="Forward Speed (m/s)")
+    forward_speed_fig.add_graph("forward_speed",
+                                label="forward_speed",
+                                window_size=max_points)
+    forward_speed_fig.add_graph("reference_signal",
+                                label="reference_Signal",
+                                window_size=max_points)
+
+    # Add throttle signals graph
+    throttle_fig = lp_1d.plot_new_dynamic_figure(title="Throttle")
+    throttle_fig.add_graph("throttle",
+                          label="throttle",
+                          window_size=max_points)
+    # Add brake signals graph
+    brake_fig = lp_1d.plot_new_dynamic_figure(title="Brake")
+    brake_fig.add_graph("brake",
+                          label="brake",
+                          window_size=max_points)
+    # Add steering signals graph
+    steer_fig = lp_1d.plot_new_dynamic_figure(title="Steer")
+    steer_fig.add_graph("steer",
+                          label="steer",
+                          window_size=max_points)
+    return (lp_traj, lp_1d, trajectory_fig, forward_speed_fig, throttle_fig,
+            brake_fig, steer_fig)
+
+def _plot_main(ring_name, num_path_points, capacity, waypoints_np, start_x,
+               start_y, max_points, enable_live_plot, refresh_period,
+               output_folder):
+    import live_plotter as lv   # Custom live plotting library
+
+    ring = SharedSampleRing(plot_sample_dtype(num_path_points), capacity,
+                            name=ring_name)
+    lp_traj, lp_1d, trajectory_fig, forward_speed_fig, throttle_fig, \
+            brake_fig, steer_fig = _make_figures(lv, waypoints_np, start_x,
+                                                 start_y, max_points,
+                                                 num_path_points)
+    trajectory_graph = _LodGraph(trajectory_fig, "trajectory",
+                                 plot_lod.STRIDE, max_points)
+    signal_graphs = [
+        ('speed',         _LodGraph(forward_speed_fig, "forward_speed",
+                                    plot_lod.MINMAX, max_points)),
+        ('desired_speed', _LodGraph(forward_speed_fig, "reference_signal",
+                                    plot_lod.MINMAX, max_points)),
+        ('throttle',      _LodGraph(throttle_fig, "throttle",
+                                    plot_lod.MINMAX, max_points)),
+        ('brake',         _LodGraph(brake_fig, "brake",
+                                    plot_lod.MINMAX, max_points)),
+        ('steer',         _LodGraph(steer_fig, "steer",
+                                    plot_lod.MINMAX, max_points)),
+    ]
+    # live plotter is disabled, hide windows
+    if not enable_live_plot:
+        lp_traj._root.withdraw()
+        lp_1d._root.withdraw()
+
+    last_refresh = time.time()
+    while True:
+        writer_closed = ring.writer_closed
+        samples = ring.read_new()
+        if samples.shape[0] == 0:
+            if writer_closed:
+                break
+            time.sleep(PLOT_POLL_PERIOD)
+            continue
+
+        for sample in samples:
+            trajectory_graph.append(sample['x'], sample['y'])
+            for field, graph in signal_graphs:
+                graph.append(sample['time'], sample[field])
+        trajectory_graph.flush()
+        for _, graph in signal_graphs:
+            graph.flush()
+        # Only the newest car position and lookahead path are drawn
+        trajectory_fig.roll("car", samples[-1]['x'], samples[-1]['y'])
+        trajectory_fig.update("lookahead_path", samples[-1]['path_x'],
+                              samples[-1]['path_y'], new_colour=[0, 0.7, 0.7])
+
+        # Refresh the live plot based on the refresh rate
+        # set by the options
+        if enable_live_plot and time.time() - last_refresh >= refresh_period:
+            lp_traj.refresh()
+            lp_1d.refresh()
+            last_refresh = time.time()
+
+    ring.close()
+    if output_folder is not None:
+        if not os.path.exists(output_folder):
+            os.makedirs(output_folder)
+        for figure, file_name in ((trajectory_fig, 'trajectory.png'),
+                                  (forward_speed_fig, 'forward_speed.png'),
+                                  (throttle_fig, 'throttle_output.png'),
+                                  (brake_fig, 'brake_output.png'),
+                                  (steer_fig, 'steer_output.png')):
+            figure.fig.savefig(os.path.join(output_folder, file_name))
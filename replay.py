@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+"""
+Offline replay of recorded episodes through the control loop.
+
+A recording (a telemetry file or a measurement log written by the demo, or
+a text trajectory of "x, y, v, t" rows) is streamed frame by frame through
+the same localization, lookahead windowing and Controller2D pipeline as
+exec_waypoint_nav_demo (closed_loop.ControlPipeline), as fast as the CPU
+allows and without a simulator. The commands the controller would have
+sent are returned as telemetry records, so two controller versions can be
+diffed on the same recorded measurements, and the pipeline stages can be
+profiled on real data.
+
+The recorded poses are replayed as they were recorded: the commands do not
+feed back into the motion (use closed_loop.py for closed-loop runs).
+
+Usage:
+    python replay.py [recording] [-o commands.bin] [--diff reference.bin]
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+import closed_loop
+import measurement_log
+import stage_profile
+import telemetry
+import episode_history
+
+COMMAND_FIELDS    = ('throttle', 'steer', 'brake')
+DIFF_TOLERANCE    = 1e-9    # max command difference counted as equal
+
+def load_recording(file_name):
+    """Loads a recorded measurement log.
+
+    A telemetry file is memory-mapped, its start pose record (frame -1) is
+    dropped. The frames of a measurement log (measurement_log.py) after the
+    start delay of the demo are converted. A text trajectory has no yaw nor
+    frame number: the yaw is the heading of the motion to the next row and
+    the frame is the row number.
+
+    Returns: Structured array with the telemetry.TELEMETRY_DTYPE layout
+             (the frame, time, x, y, yaw and speed fields are replayed)
+    """
+    with open(file_name, 'rb') as recording_file:
+        magic = recording_file.read(len(telemetry.TELEMETRY_MAGIC))
+    if magic == telemetry.TELEMETRY_MAGIC:
+        records = telemetry.read_telemetry(file_name)
+        return records[records['frame'] >= 0]
+    if magic == measurement_log.MEASUREMENT_MAGIC:
+        return measurement_log.to_telemetry(
+                measurement_log.read_measurements(file_name),
+                closed_loop.WAIT_TIME_BEFORE_START)
+
+    trajectory = np.loadtxt(file_name, delimiter=',', ndmin=2)
+    records = np.zeros(trajectory.shape[0], dtype=telemetry.TELEMETRY_DTYPE)
+    records['frame'] = np.arange(trajectory.shape[0])
+    records['x']     = trajectory[:, 0]
+    records['y']     = trajectory[:, 1]
+    records['speed'] = trajectory[:, 2]
+    records['time']  = trajectory[:, 3]
+    records['yaw']   = np.arctan2(
+            np.diff(trajectory[:, 1], append=trajectory[-1, 1]),
+            np.diff(trajectory[:, 0], append=trajectory[-1, 0]))
+    return records
+
+class ReplayEngine(object):
+    """ Replay Engine
+
+    Runs recorded measurements through a closed_loop.ControlPipeline. Each
+    run() starts from a fresh pipeline, so an engine replays any number of
+    recordings with the same controller settings.
+    """
+    def __init__(self, waypoints_np, profiler=None, **pipeline_options):
+        """
+        Args:
+            waypoints_np: (N, 3) array of [x, y, v] waypoints (None with a
+                          route)
+            profiler: Optional stage_profile.StageProfiler over
+                      closed_loop.PIPELINE_STAGES
+            pipeline_options: gains, lookahead, spline, profile, mpc,
+                              kernel, paged and route options of the
+                              pipeline (see closed_loop.run_episode)
+        """
+        self.waypoints_np     = waypoints_np
+        self.profiler         = profiler
+        self.pipeline_options = pipeline_options
+
+    def run(self, records, stop_at_end=True):
+        """Replays the records.
+
+        Args:
+            records: Recorded measurements (see load_recording)
+            stop_at_end: Stop after the first frame close to the last
+                         waypoint, as the demo does
+
+        Returns: Structured array with the telemetry.TELEMETRY_DTYPE layout,
+                 the replayed measurements with the commands, desired speed
+                 and closest index computed by the pipeline
+        """
+        history = episode_history.HistoryBuffer(telemetry.TELEMETRY_DTYPE,
+                                                max(len(records), 1))
+        # Plain Python columns, a structured array row per frame is slow
+        columns = [records[name].tolist() for name in
+                   ('frame', 'time', 'x', 'y', 'yaw', 'speed')]
+        with closed_loop.ControlPipeline(self.waypoints_np,
+                                         profiler=self.profiler,
+                                         **self.pipeline_options) as pipeline:
+            profiler   = pipeline.profiler
+            controller = pipeline.controller
+            for frame, t, x, y, yaw, v in zip(*columns):
+                profiler.start_frame(frame)
+                throttle, steer, brake, closest_index = pipeline.step(
+                        x, y, yaw, v, t, frame)
+                profiler.end_frame()
+                history.append(frame, t, x, y, yaw, v, throttle, steer, brake,
+                               controller._desired_speed, closest_index)
+                if stop_at_end and pipeline.reached_the_end(x, y):
+                    break
+        return history.view()
+
+def diff_commands(records, reference, tolerance=DIFF_TOLERANCE):
+    """Compares the commands of two replays (or recordings) frame by frame.
+
+    Frames are matched by their time rounded to the millisecond (the game
+    timestamp resolution), which is the same in every recording format,
+    while the frame numbers are not. Frames missing from either side are
+    counted but not compared.
+
+    Returns: (num_compared, num_missing, num_different, max_difference)
+        num_compared: Number of frames present in both
+        num_missing: Number of frames present in only one of them
+        num_different: Number of compared frames with a command more than
+                       tolerance apart (or nan on one side only)
+        max_difference: Dict of the largest difference of every command
+    """
+    _, index, reference_index = np.intersect1d(
+            np.round(np.asarray(records['time']) * 1000.0).astype(np.int64),
+            np.round(np.asarray(reference['time']) * 1000.0).astype(np.int64),
+            return_indices=True)
+    num_compared = index.shape[0]
+    num_missing  = len(records) + len(reference) - 2 * num_compared
+    different    = np.zeros(num_compared, dtype=bool)
+    max_difference = {}
+    for name in COMMAND_FIELDS:
+        a = np.asarray(records[name])[index]
+        b = np.asarray(reference[name])[reference_index]
+        difference = np.abs(a - b)
+        mismatch = np.isnan(a) != np.isnan(b)
+        different |= mismatch | (difference > tolerance)
+        max_difference[name] = (float(np.nanmax(difference))
+                                if np.any(~np.isnan(difference)) else 0.0)
+        if np.any(mismatch):
+            max_difference[name] = np.inf
+    return num_compared, num_missing, int(np.sum(different)), max_difference
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument(
+        'recording',
+        nargs='?',
+        default=closed_loop.TRAJECTORY_FILE,
+        help='telemetry file, measurement log or text trajectory to replay '
+             '(default: controller_output/trajectory.txt)')
+    argparser.add_argument(
+        '--waypoints',
+        metavar='PATH',
+        default=closed_loop.WAYPOINTS_FILENAME,
+        help='waypoint file of the path (default: racetrack_waypoints.txt, '
+             'or the recorded trajectory if it is missing)')
+    argparser.add_argument(
+        '--kernel',
+        choices=['python', 'numba', 'auto'],
+        default=None,
+        help='kernel backend of the controller law (default: NumPy law)')
+    argparser.add_argument(
+        '--spline',
+        action='store_true',
+        help='sample the waypoint windows from the spline path')
+    argparser.add_argument(
+        '--speed-profile',
+        action='store_true',
+        help='track the curvature-aware speed profile of the path')
+    argparser.add_argument(
+        '--paged',
+        action='store_true',
+        help='localize and window through the paged route store')
+    argparser.add_argument(
+        '--repeat',
+        type=int,
+        default=1,
+        help='number of replays, the fastest is reported (default: 1)')
+    argparser.add_argument(
+        '-o', '--output',
+        metavar='PATH',
+        default=None,
+        help='telemetry file to write the replayed commands to')
+    argparser.add_argument(
+        '--diff',
+        metavar='REFERENCE',
+        default=None,
+        help='recording (e.g. an earlier --output) to compare the commands '
+             'with, exits with status 1 if they differ')
+    argparser.add_argument(
+        '--tolerance',
+        type=float,
+        default=DIFF_TOLERANCE,
+        help='max command difference of --diff (default: %(default)s)')
+    argparser.add_argument(
+        '--profile-stages',
+        action='store_true',
+        help='print the latency percentiles of the pipeline stages')
+    args = argparser.parse_args()
+
+    if not os.path.exists(args.recording):
+        argparser.error('%s does not exist' % args.recording)
+    records = load_recording(args.recording)
+    route   = None
+    if os.path.exists(args.waypoints) and args.paged:
+        # Only the pages of the route around the car are loaded
+        waypoints_np = None
+        route = closed_loop.route_store.RouteStore.open(
+                args.waypoints, closed_loop.INTERP_DISTANCE_RES,
+                lookahead_distance=closed_loop.INTERP_LOOKAHEAD_DISTANCE,
+                lookahead_time=closed_loop.INTERP_LOOKAHEAD_TIME)
+    elif os.path.exists(args.waypoints):
+        waypoints_np = closed_loop.path_interp.read_waypoints_file(
+                args.waypoints)
+    else:
+        waypoints_np = np.column_stack((records['x'], records['y'],
+                                        records['speed']))
+    profiler = stage_profile.StageProfiler(closed_loop.PIPELINE_STAGES,
+                                           enabled=args.profile_stages)
+    engine = ReplayEngine(waypoints_np, profiler, kernel=args.kernel,
+                          spline=args.spline, profile=args.speed_profile,
+                          paged=args.paged, route=route)
+
+    best_time = np.inf
+    for _ in range(max(args.repeat, 1)):
+        start  = time.perf_counter()
+        output = engine.run(records)
+        best_time = min(best_time, time.perf_counter() - start)
+    print('%d of %d recorded frames replayed in %.3f s (%.0f frames/s)' %
+          (len(output), len(records), best_time,
+           len(output) / best_time if best_time > 0 else np.inf))
+    if args.profile_stages:
+        print(profiler.report())
+    if route is not None:
+        route.close()
+
+    if args.output is not None:
+        with telemetry.TelemetryWriter(args.output) as writer:
+            for record in output.tolist():
+                writer.append(*record)
+        print('commands written to %s' % args.output)
+
+    if args.diff is not None:
+        reference = load_recording(args.diff)
+        num_compared, num_missing, num_different, max_difference = \
+                diff_commands(output, reference, args.tolerance)
+        print('%d frames compared, %d missing on one side, %d different' %
+              (num_compared, num_missing, num_different))
+        print('max difference: ' + ', '.join(
+                '%s %.3g' % (name, max_difference[name])
+                for name in COMMAND_FIELDS))
+        if num_different or num_missing:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
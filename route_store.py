@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+
+"""
+Paged access to very long waypoint routes.
+
+The route is read from the memory-mapped compiled path artifact
+(path_interp.load_compiled_table), and only pages of ROUTE_PAGE_SIZE
+waypoints around the car are made resident. A page holds a copy of its
+table rows, the lookahead window of each of its waypoints, the dense path
+points those windows cover (so a window is a view, as with
+InterpolatedPath.window_view) and a ProgressTracker over the page and half
+a page on each side. The pages ahead of the car are loaded on a background
+thread, so crossing into the next page normally costs nothing, and the
+least recently used pages are dropped. Resident memory does not depend on
+the route length, and neither does the startup time once the route is
+compiled (apart from the digest of the waypoint file that names the
+artifact).
+
+Windows, dense points and tracked indices equal those of the whole-route
+LookaheadTable, InterpolatedPath and ProgressTracker.
+
+Running this script reports the page loads and resident memory of a drive
+along a waypoint file.
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import math
+import time
+import numpy as np
+from concurrent import futures
+
+import path_interp
+import waypoint_nav
+
+ROUTE_PAGE_SIZE      = 4096     # waypoints per page
+ROUTE_RESIDENT_PAGES = 4        # pages kept behind the prefetched ones
+ROUTE_PREFETCH_PAGES = 2        # pages loaded ahead of the car
+RELOCALIZE_CHUNK     = 65536    # segments per step of a route search
+
+class RoutePage(object):
+    """ Route Page
+
+    The resident data of the waypoints [first, end) of a route. Built from
+    the memory-mapped route table, possibly on the prefetch thread.
+    """
+    def __init__(self, table, number, page_size, resolution,
+                 lookahead_distance, lookahead_time):
+        """
+        Args:
+            table: Route table with the path_interp.PATH_CACHE_DTYPE layout
+            number: Page number
+            page_size: Waypoints per page
+            resolution: Distance between interpolated points in meters
+            lookahead_distance: Lookahead distance at standstill in meters
+            lookahead_time: Extra lookahead in seconds at the waypoint speed
+        """
+        num_waypoints = table.shape[0]
+        self.number = number
+        self.first  = number * page_size
+        self.end    = min(self.first + page_size, num_waypoints)
+        indices     = np.arange(self.first, self.end)
+
+        # Lookahead windows, as in waypoint_nav.LookaheadTable. The search
+        # runs on the memory-mapped arc lengths (log N rows touched).
+        arc_length = table['arc_length']
+        distances  = waypoint_nav.lookahead_distances(
+                table['waypoint'][self.first:self.end], lookahead_distance,
+                lookahead_time)
+        last = np.searchsorted(arc_length,
+                               arc_length[self.first:self.end] + distances,
+                               side='left')
+        last = np.minimum(np.maximum(last, indices), num_waypoints - 1)
+        self._first = np.maximum(indices - 1, 0).tolist()
+        self._last  = last.tolist()
+
+        # Rows of the windows and of the tracked segments
+        margin = max(page_size // 2, 2)     # the edge segments of the
+                                            # tracker are in other pages
+        self.window_first  = max(self.first - 1, 0)
+        self.window_last   = int(last[-1])
+        self.tracker_first = max(self.first - margin, 0)
+        self.tracker_last  = min(self.end + margin, num_waypoints) - 1
+        self.row_first = min(self.window_first, self.tracker_first)
+        row_last       = max(self.window_last, self.tracker_last)
+        self.table = np.array(table[self.row_first:row_last + 1])
+
+        # Dense points of the windows, same values as the whole path
+        path = path_interp.InterpolatedPath.from_table(self.table, resolution)
+        self._hash   = self.table['hash']
+        self._offset = int(self._hash[self.window_first - self.row_first])
+        dense = path.points(np.arange(
+                self._offset,
+                int(self._hash[self.window_last - self.row_first]) + 1))
+        dense.flags.writeable = False
+        self.dense = dense
+
+        self.tracker = waypoint_nav.ProgressTracker(
+                self.table['waypoint'][self.tracker_first - self.row_first:
+                                       self.tracker_last - self.row_first + 1],
+                relocalize_distance=float('inf'))
+
+    @property
+    def nbytes(self):
+        """Approximate resident size of the page in bytes.
+        """
+        num_tracked = self.tracker_last - self.tracker_first + 1
+        return (self.table.nbytes + self.dense.nbytes +
+                len(self._first) * 2 * 32 + num_tracked * 10 * 24)
+
+    def window(self, closest_index):
+        i = closest_index - self.first
+        return self._first[i], self._last[i]
+
+    def window_view(self, first_index, last_index):
+        """Read-only view of the dense window, None if the page does not
+        hold it.
+        """
+        if first_index < self.window_first or last_index > self.window_last:
+            return None
+        start = int(self._hash[first_index - self.row_first]) - self._offset
+        stop  = int(self._hash[last_index - self.row_first]) - self._offset
+        return self.dense[start:stop + 1]
+
+class RouteStore(object):
+    """ Route Store
+
+    Pages of a route table, loaded on demand and kept in LRU order. Every
+    page() call schedules the loading of the prefetch_pages following
+    pages on a background thread and drops the least recently used pages
+    beyond resident_pages + prefetch_pages.
+
+    window() and window_view() stand in for waypoint_nav.LookaheadTable
+    and InterpolatedPath.window_view in the control loop.
+    """
+    def __init__(self, table, resolution,
+                 lookahead_distance=20.0, lookahead_time=0.0,
+                 page_size=ROUTE_PAGE_SIZE,
+                 resident_pages=ROUTE_RESIDENT_PAGES,
+                 prefetch_pages=ROUTE_PREFETCH_PAGES, prefetch=True):
+        """
+        Args:
+            table: Route table with the path_interp.PATH_CACHE_DTYPE layout,
+                   normally memory-mapped (see open)
+            resolution: Distance between interpolated points in meters
+            lookahead_distance: Lookahead distance at standstill in meters
+            lookahead_time: Extra lookahead in seconds at the waypoint speed
+            page_size: Waypoints per page
+            resident_pages: Pages kept besides the prefetched ones
+            prefetch_pages: Pages loaded ahead of the last page used
+            prefetch: Load the pages ahead on a background thread (False
+                      loads every page when it is first used)
+        """
+        self.table          = table
+        self.resolution     = float(resolution)
+        self.lookahead_distance = float(lookahead_distance)
+        self.lookahead_time = float(lookahead_time)
+        self.page_size      = max(int(page_size), 1)
+        self.resident_pages = max(int(resident_pages), 1)
+        self.prefetch_pages = max(int(prefetch_pages), 0)
+        self.num_waypoints  = table.shape[0]
+        self.num_pages      = max(-(-self.num_waypoints // self.page_size), 1)
+        self.waypoints      = table['waypoint']     # not resident
+        self._pages    = collections.OrderedDict()  # page number -> Future
+        self._current  = (None, None)   # last page number used and page
+        self._executor = None
+        if prefetch and self.prefetch_pages:
+            self._executor = futures.ThreadPoolExecutor(max_workers=1)
+
+        # Statistics
+        self.page_loads  = 0    # pages built (on demand or prefetched)
+        self.page_misses = 0    # pages built on demand
+        self.page_stalls = 0    # prefetched pages waited for
+        self.page_evictions = 0
+
+    @classmethod
+    def open(cls, waypoints_file, resolution, **options):
+        """Opens the route of a waypoint file from its memory-mapped
+        compiled path artifact (compiled first when missing).
+
+        Args:
+            waypoints_file: Path to the "x, y, v" waypoint file
+            resolution: Distance between interpolated points in meters
+            options: See __init__
+        """
+        return cls(path_interp.load_compiled_table(waypoints_file,
+                                                   resolution),
+                   resolution, **options)
+
+    def __len__(self):
+        return self.num_waypoints
+
+    def close(self):
+        """Stops the prefetch thread and drops the resident pages.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._pages.clear()
+        self._current = (None, None)
+
+    def page_of(self, index):
+        """Number of the page of a waypoint index.
+        """
+        return min(max(index, 0) // self.page_size, self.num_pages - 1)
+
+    def _load_page(self, number):
+        return RoutePage(self.table, number, self.page_size, self.resolution,
+                         self.lookahead_distance, self.lookahead_time)
+
+    def page(self, number):
+        """Returns a page, loading it if it is not resident.
+        """
+        if number == self._current[0]:
+            return self._current[1]
+        future = self._pages.get(number)
+        if future is None:
+            self.page_misses += 1
+            self.page_loads  += 1
+            future = futures.Future()
+            future.set_result(self._load_page(number))
+            self._pages[number] = future
+        else:
+            self._pages.move_to_end(number)
+            if not future.done():
+                self.page_stalls += 1
+        page = future.result()
+
+        if self._executor is not None:
+            for ahead in range(number + 1,
+                               min(number + self.prefetch_pages,
+                                   self.num_pages - 1) + 1):
+                if ahead not in self._pages:
+                    self.page_loads += 1
+                    self._pages[ahead] = self._executor.submit(
+                            self._load_page, ahead)
+        self._evict(number)
+        self._current = (number, page)
+        return page
+
+    def _evict(self, number):
+        # Drop the least recently used pages, never the current page or the
+        # pages prefetched ahead of it
+        excess = len(self._pages) - self.resident_pages - self.prefetch_pages
+        for old in list(self._pages):
+            if excess <= 0:
+                break
+            if number <= old <= number + self.prefetch_pages:
+                continue
+            future = self._pages.pop(old)
+            future.cancel()
+            self.page_evictions += 1
+            excess -= 1
+
+    def resident_nbytes(self):
+        """Approximate size of the loaded pages in bytes.
+        """
+        return sum(future.result().nbytes for future in self._pages.values()
+                   if future.done() and not future.cancelled())
+
+    def window(self, closest_index):
+        """Returns the waypoint index range to send to the controller (see
+        waypoint_nav.LookaheadTable.window).
+        """
+        return self.page(self.page_of(closest_index)).window(closest_index)
+
+    def window_view(self, first_index, last_index):
+        """Returns the dense path between two waypoints (see
+        path_interp.InterpolatedPath.window_view), a view into the page of
+        the window when it holds it, else computed from the route table.
+        """
+        points = self.page(self.page_of(first_index + 1)).window_view(
+                first_index, last_index)
+        if points is None:
+            rows = self.table[first_index:last_index + 1]
+            points = path_interp.InterpolatedPath.from_table(
+                    rows, self.resolution).points(np.arange(
+                            int(rows['hash'][0]), int(rows['hash'][-1]) + 1))
+        return points
+
+class PagedProgressTracker(object):
+    """ Paged Progress Tracker
+
+    waypoint_nav.ProgressTracker over a RouteStore. The car is tracked with
+    the ProgressTracker of the page of the tracked segment, handing over to
+    the neighbouring page when the walk reaches the end of the segments it
+    holds. Relocalization searches a widening arc length window around the
+    tracked segment as ProgressTracker does, and the first update the whole
+    route, projecting the route table in chunks of RELOCALIZE_CHUNK
+    segments.
+    """
+    def __init__(self, store, relocalize_distance=5.0,
+                 relocalize_window=waypoint_nav.RELOCALIZE_WINDOW):
+        """
+        Args:
+            store: RouteStore of the route
+            relocalize_distance: Distance to the tracked segment in meters
+                                 above which the route is searched
+            relocalize_window: Arc length in meters searched on either side
+                               of the tracked segment by a first
+                               relocalization
+        """
+        self.store = store
+        self.num_waypoints = store.num_waypoints
+        self.relocalize_distance = float(relocalize_distance)
+        self.relocalize_window   = float(relocalize_window)
+        self._search_window      = self.relocalize_window
+        self._widen_search       = True
+        self._num_segments = max(self.num_waypoints - 1, 1)
+
+        self.segment        = None  # index of the tracked segment
+        self.fraction       = 0.0   # position along the segment [0, 1]
+        self.lateral_error  = 0.0   # distance from the car to the path
+        self.relocalizations = 0
+
+    @property
+    def arc_length(self):
+        """Distance travelled along the path to the car's projection.
+        """
+        if self.segment is None:
+            return 0.0
+        row = self.store.table[self.segment]
+        return float(row['arc_length'] + self.fraction * row['distance'])
+
+    def reset(self):
+        self.segment = None
+
+    def update(self, x, y):
+        """Tracks the car position (see waypoint_nav.ProgressTracker.update).
+
+        Returns: (closest_index, closest_distance)
+        """
+        if self.segment is None:
+            self._relocalize(x, y, float('inf'), 0, self._num_segments)
+        else:
+            self._track(x, y)
+            if self.lateral_error > self.relocalize_distance:
+                self._relocalize_near(x, y)
+            else:
+                self._search_window = self.relocalize_window
+                self._widen_search  = True
+
+        closest_index = self.segment + (1 if self.fraction >= 0.5 else 0)
+        closest_index = min(closest_index, self.num_waypoints - 1)
+        waypoint = self.store.waypoints[closest_index]
+        return closest_index, math.hypot(float(waypoint[0]) - x,
+                                         float(waypoint[1]) - y)
+
+    def _track(self, x, y):
+        for _ in range(self.store.num_pages):
+            page    = self.store.page(self.store.page_of(self.segment))
+            tracker = page.tracker
+            tracker.segment = self.segment - page.tracker_first
+            tracker.update(x, y)
+            self.segment       = tracker.segment + page.tracker_first
+            self.fraction      = tracker.fraction
+            self.lateral_error = tracker.lateral_error
+            # Continue on the next (previous) page when the walk stopped at
+            # the last (first) segment held by the page
+            if self.segment == page.tracker_last - 1 and \
+               page.tracker_last < self.num_waypoints - 1:
+                continue
+            if self.segment == page.tracker_first and page.tracker_first > 0:
+                continue
+            break
+
+    def _relocalize_near(self, x, y):
+        first, stop = waypoint_nav.search_range(
+                self.store.table['arc_length'], self.arc_length,
+                self._search_window, self._num_segments)
+        self._relocalize(x, y, self.lateral_error, first, stop)
+        if first == 0 and stop == self._num_segments:
+            # As in ProgressTracker, the whole route is not searched again
+            # until the car has been back on it
+            self._widen_search  = False
+            self._search_window = self.relocalize_window
+        elif self._widen_search and \
+             self.lateral_error > self.relocalize_distance:
+            self._search_window *= 2.0
+
+    def _relocalize(self, x, y, tracked_error, first, stop):
+        # Same projection as waypoint_nav.ProgressTracker._relocalize, one
+        # chunk of the memory-mapped route at a time
+        self.relocalizations += 1
+        best_segment  = 0
+        best_fraction = 0.0
+        best_distance2 = float('inf')
+        for start in range(first, stop, RELOCALIZE_CHUNK):
+            end    = min(start + RELOCALIZE_CHUNK, stop)
+            points = np.array(self.store.waypoints[start:end + 1, :2])
+            if points.shape[0] < 2:
+                points = np.concatenate((points, points))[:2]
+            vector  = np.diff(points, axis=0)
+            length2 = np.sum(vector**2, axis=1)
+            dx = x - points[:-1, 0]
+            dy = y - points[:-1, 1]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                u = (dx*vector[:, 0] + dy*vector[:, 1]) / length2
+            u = np.clip(np.nan_to_num(u), 0.0, 1.0)
+            distance2 = (dx - u*vector[:, 0])**2 + (dy - u*vector[:, 1])**2
+            segment = int(np.argmin(distance2))
+            if distance2[segment] < best_distance2:
+                best_segment   = start + segment
+                best_fraction  = float(u[segment])
+                best_distance2 = float(distance2[segment])
+        error = math.sqrt(best_distance2)
+        if error < tracked_error:
+            self.segment       = best_segment
+            self.fraction      = best_fraction
+            self.lateral_error = error
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument(
+        'waypoints_file',
+        help='waypoint file with "x, y, v" rows')
+    argparser.add_argument(
+        '-r', '--resolution',
+        default=0.01,
+        type=float,
+        help='distance between interpolated points (default: 0.01)')
+    argparser.add_argument(
+        '--page-size',
+        default=ROUTE_PAGE_SIZE,
+        type=int,
+        help='waypoints per page (default: %(default)s)')
+    argparser.add_argument(
+        '--no-prefetch',
+        action='store_true',
+        help='load every page when it is first used')
+    args = argparser.parse_args()
+
+    start = time.perf_counter()
+    store = RouteStore.open(args.waypoints_file, args.resolution,
+                            page_size=args.page_size,
+                            prefetch=not args.no_prefetch)
+    tracker = PagedProgressTracker(store)
+    print('%d waypoints, %d pages, opened in %.3f s' % (
+            store.num_waypoints, store.num_pages,
+            time.perf_counter() - start))
+
+    # Drive along the waypoints, one window per waypoint
+    max_nbytes = 0
+    start = time.perf_counter()
+    for index in range(store.num_waypoints):
+        x, y = (float(value) for value in store.waypoints[index, :2])
+        closest_index, _ = tracker.update(x, y)
+        store.window_view(*store.window(closest_index))
+        if index % store.page_size == 0:
+            max_nbytes = max(max_nbytes, store.resident_nbytes())
+    elapsed = time.perf_counter() - start
+    print('%d frames in %.3f s (%.1f us per frame)' % (
+            store.num_waypoints, elapsed, elapsed / store.num_waypoints * 1e6))
+    print('page loads: %d, on demand: %d, waited for: %d, evicted: %d' % (
+            store.page_loads, store.page_misses, store.page_stalls,
+            store.page_evictions))
+    print('max resident pages: %.1f MB' % (max_nbytes / 1e6))
+    store.close()
+
+if __name__ == '__main__':
+    main()
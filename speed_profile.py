@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+"""
+Offline curvature-aware speed profile of a waypoint path.
+
+The reference speed of every point of the path is limited by the speed of
+the waypoints, by the lateral acceleration allowed at the curvature of the
+spline path (spline_path.py), and by the longitudinal acceleration and
+deceleration limits through a forward and a backward pass. The resulting
+reference speed and acceleration are stored per waypoint, so the
+controller reads both by index instead of deriving them every tick.
+"""
+import numpy as np
+
+import spline_path
+
+MAX_LATERAL_ACCEL = 4.0     # m/s^2, lateral acceleration allowed in curves
+MAX_ACCEL         = 2.5     # m/s^2, longitudinal acceleration limit
+MAX_DECEL         = 4.0     # m/s^2, longitudinal deceleration limit
+PROFILE_STEP      = 0.5     # m, arc length between profile samples
+KNOT_SPACING      = 1.0     # m, minimum spline knot spacing (filters the
+                            # position noise of recorded waypoints out of
+                            # the curvature)
+MIN_CURVATURE     = 1e-6    # 1/m, below this a sample counts as straight
+
+class SpeedProfile(object):
+    """ Speed Profile
+
+    Feasible reference speed over the arc length of a path. The speed
+    starts from the curvature and speed limits of every sample, then a
+    forward pass bounds the speed reachable from the previous sample with
+    max_accel and a backward pass bounds it by the speed from which the
+    next sample can still be reached with max_decel. The reference
+    acceleration is the constant acceleration between consecutive samples.
+    """
+    def __init__(self, arc_length, curvature, speed_limit,
+                 max_lateral_accel=MAX_LATERAL_ACCEL, max_accel=MAX_ACCEL,
+                 max_decel=MAX_DECEL, start_speed=None, end_speed=None):
+        """
+        Args:
+            arc_length: (N,) increasing arc lengths of the samples in meters
+            curvature: (N,) path curvature at the samples in 1/m
+            speed_limit: (N,) speed limit at the samples in m/s (or one
+                         value for the whole path)
+            max_lateral_accel: Lateral acceleration limit in m/s^2
+            max_accel: Longitudinal acceleration limit in m/s^2
+            max_decel: Longitudinal deceleration limit in m/s^2 (positive)
+            start_speed: Speed at the first sample (None: no constraint)
+            end_speed: Speed at the last sample (None: no constraint)
+        """
+        self.arc_length = np.asarray(arc_length, dtype=np.float64)
+        num_samples = self.arc_length.shape[0]
+        curvature = np.maximum(np.abs(np.asarray(curvature, np.float64)),
+                               MIN_CURVATURE)
+        speed = np.minimum(np.broadcast_to(speed_limit, (num_samples,)),
+                           np.sqrt(max_lateral_accel / curvature))
+        speed = np.maximum(speed, 0.0)
+        if start_speed is not None:
+            speed[0] = min(speed[0], start_speed)
+        if end_speed is not None:
+            speed[-1] = min(speed[-1], end_speed)
+
+        # v^2 changes by at most 2*a*ds between samples
+        ds = np.diff(self.arc_length).tolist()
+        speed2 = (speed**2).tolist()
+        for i in range(num_samples - 1):
+            reachable = speed2[i] + 2.0*max_accel*ds[i]
+            if speed2[i+1] > reachable:
+                speed2[i+1] = reachable
+        for i in range(num_samples - 2, -1, -1):
+            stoppable = speed2[i+1] + 2.0*max_decel*ds[i]
+            if speed2[i] > stoppable:
+                speed2[i] = stoppable
+        speed2 = np.array(speed2)
+
+        self.speed = np.sqrt(speed2)
+        self.acceleration = np.zeros(num_samples)
+        if num_samples > 1:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                acceleration = np.diff(speed2) / (2.0*np.diff(self.arc_length))
+            self.acceleration[:-1] = np.nan_to_num(acceleration)
+
+    @classmethod
+    def from_spline(cls, spline, speed_limit=None, step=PROFILE_STEP,
+                    **limits):
+        """Computes the profile of a spline path.
+
+        Args:
+            spline: spline_path.SplinePath
+            speed_limit: Speed limit in m/s, None to use the speed of the
+                         waypoints
+            step: Arc length between samples in meters
+            limits: Acceleration limits and start/end speeds (see __init__)
+        """
+        num_samples = max(int(np.ceil(spline.length / step)), 1) + 1
+        arc_length  = np.linspace(0.0, spline.length, num_samples)
+        if speed_limit is None:
+            speed_limit = spline.speed(arc_length)
+        return cls(arc_length, spline.curvature(arc_length), speed_limit,
+                   **limits)
+
+    def speed_at(self, arc_length):
+        """Reference speed at the given arc lengths.
+        """
+        return np.interp(arc_length, self.arc_length, self.speed)
+
+    def acceleration_at(self, arc_length):
+        """Reference acceleration at the given arc lengths.
+        """
+        index = np.searchsorted(self.arc_length, arc_length, side='right') - 1
+        return self.acceleration[np.clip(index, 0,
+                                         self.arc_length.shape[0] - 1)]
+
+def profile_waypoints(waypoints_np, speed_limit=None, step=PROFILE_STEP,
+                      knot_spacing=KNOT_SPACING, **limits):
+    """Computes the reference speed and acceleration of every waypoint.
+
+    Args:
+        waypoints_np: (N, 3) array of [x, y, v] waypoints
+        speed_limit: Speed limit in m/s, None to use the speed of the
+                     waypoints
+        step: Arc length between profile samples in meters
+        knot_spacing: Minimum distance between the spline knots in meters
+        limits: Acceleration limits and start/end speeds (see SpeedProfile)
+
+    Returns: (profiled_waypoints, acceleration)
+        profiled_waypoints: Copy of waypoints_np with the reference speed
+                            in the v column
+        acceleration: (N,) reference acceleration at each waypoint
+    """
+    spline  = spline_path.SplinePath(waypoints_np, min_spacing=knot_spacing)
+    profile = SpeedProfile.from_spline(spline, speed_limit, step, **limits)
+    arc_length = spline.waypoint_arc_length
+    profiled_waypoints = np.array(waypoints_np, dtype=np.float64)
+    profiled_waypoints[:, 2] = profile.speed_at(arc_length)
+    return profiled_waypoints, profile.acceleration_at(arc_length)
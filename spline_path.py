@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+"""
+Cubic spline path parameterized by arc length.
+
+The waypoints are fitted once with natural cubic splines x(s), y(s), where
+s is the distance travelled along the path. Position, heading and curvature
+come from the spline polynomials (no finite differences) and the reference
+speed is interpolated linearly between waypoints. Every query is
+vectorized over an array of arc lengths, so a window of the path can be
+sampled at any resolution without storing a dense copy of the path.
+"""
+import numpy as np
+
+import path_interp
+
+# 5 point Gauss-Legendre rule on [0, 1], used to measure segment lengths
+_GAUSS_NODES   = (np.array([-0.9061798459386640, -0.5384693101056831, 0.0,
+                            0.5384693101056831, 0.9061798459386640]) + 1) / 2
+_GAUSS_WEIGHTS = np.array([0.2369268850561891, 0.4786286704993665,
+                           0.5688888888888889, 0.4786286704993665,
+                           0.2369268850561891]) / 2
+
+def natural_spline_coefficients(knots, values):
+    """Fits natural cubic splines through values at the knots.
+
+    Args:
+        knots: (N,) strictly increasing parameter values
+        values: (N, D) values to interpolate (D independent splines)
+
+    Returns: (N-1, 4, D) array of the polynomial coefficients of every
+             segment, value = c0 + c1*t + c2*t**2 + c3*t**3 with t the
+             parameter offset from the start of the segment
+    """
+    knots  = np.asarray(knots, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64).reshape(knots.shape[0], -1)
+    num_knots = knots.shape[0]
+    h     = np.diff(knots)
+    slope = np.diff(values, axis=0) / h[:, None]
+
+    # Second derivatives: tridiagonal system with zero end conditions,
+    # solved with the Thomas algorithm
+    second = np.zeros_like(values)
+    if num_knots > 2:
+        lower = h[:-1].copy()
+        diag  = 2.0 * (h[:-1] + h[1:])
+        upper = h[1:].copy()
+        rhs   = 6.0 * (slope[1:] - slope[:-1])
+        for k in range(1, num_knots - 2):
+            factor  = lower[k] / diag[k-1]
+            diag[k] = diag[k] - factor * upper[k-1]
+            rhs[k]  = rhs[k] - factor * rhs[k-1]
+        inner = np.empty_like(rhs)
+        inner[-1] = rhs[-1] / diag[-1]
+        for k in range(num_knots - 4, -1, -1):
+            inner[k] = (rhs[k] - upper[k] * inner[k+1]) / diag[k]
+        second[1:-1] = inner
+
+    coefficients = np.empty((num_knots - 1, 4, values.shape[1]))
+    coefficients[:, 0] = values[:-1]
+    coefficients[:, 1] = slope - h[:, None] * (2.0*second[:-1] +
+                                               second[1:]) / 6.0
+    coefficients[:, 2] = second[:-1] / 2.0
+    coefficients[:, 3] = (second[1:] - second[:-1]) / (6.0 * h[:, None])
+    return coefficients
+
+class SplinePath(object):
+    """ Spline Path
+
+    Waypoints closer than min_spacing to the previous kept waypoint (such
+    as the repeated start position of a recorded run) are merged, because
+    spline knots must be distinct. The knots start at the chord lengths
+    between waypoints and are refined with the lengths of the fitted
+    segments, so that s is close to the true arc length of the curve.
+    """
+    def __init__(self, waypoints, min_spacing=1e-3, refinements=2):
+        """
+        Args:
+            waypoints: Waypoints as [[x0, y0, v0], ...] or an (N, 3) array
+            min_spacing: Minimum distance between kept waypoints in meters
+            refinements: Number of knot refinements by segment length
+        """
+        waypoints = np.asarray(waypoints, dtype=np.float64)
+        chords = np.hypot(np.diff(waypoints[:, 0]), np.diff(waypoints[:, 1]))
+
+        # Keep a waypoint when it is far enough from the last kept one
+        keep = [0]
+        travelled = 0.0
+        for i, chord in enumerate(chords.tolist()):
+            travelled += chord
+            if travelled >= min_spacing:
+                keep.append(i + 1)
+                travelled = 0.0
+        if len(keep) < 2:
+            raise ValueError('a spline path needs two distinct waypoints')
+        keep = np.array(keep)
+        self.waypoints = waypoints[keep]
+        # Index of the kept waypoint that stands for each input waypoint
+        self.waypoint_knot = np.searchsorted(keep, np.arange(
+                waypoints.shape[0]), side='right') - 1
+
+        points = self.waypoints[:, :2]
+        knots  = np.concatenate(([0.0], np.cumsum(np.hypot(
+                np.diff(points[:, 0]), np.diff(points[:, 1])))))
+        for _ in range(refinements + 1):
+            self.knots = knots
+            self._coefficients = natural_spline_coefficients(knots, points)
+            lengths = self._segment_lengths()
+            knots = np.concatenate(([0.0], np.cumsum(lengths)))
+        self.length = float(self.knots[-1])
+        self._waypoint_arc_length = None
+
+    @classmethod
+    def from_file(cls, waypoints_file, **kwargs):
+        """Builds the spline path of a "x, y, v" waypoint file.
+        """
+        return cls(path_interp.read_waypoints_file(waypoints_file), **kwargs)
+
+    def __len__(self):
+        return self.knots.shape[0]
+
+    @property
+    def waypoint_arc_length(self):
+        """Arc length of every input waypoint (merged ones share it).
+        """
+        if self._waypoint_arc_length is None:
+            self._waypoint_arc_length = self.knots[self.waypoint_knot]
+        return self._waypoint_arc_length
+
+    def _segment_lengths(self):
+        h = np.diff(self.knots)
+        t = (h[:, None] * _GAUSS_NODES[None, :])[..., None]
+        c = self._coefficients[:, None]         # (N-1, 1, 4, 2)
+        first = c[..., 1, :] + t*(2.0*c[..., 2, :] + 3.0*t*c[..., 3, :])
+        speed = np.hypot(first[..., 0], first[..., 1])
+        return h * np.dot(speed, _GAUSS_WEIGHTS)
+
+    def _locate(self, s):
+        s = np.clip(np.asarray(s, dtype=np.float64), 0.0, self.length)
+        segment = np.searchsorted(self.knots, s, side='right') - 1
+        segment = np.clip(segment, 0, self.knots.shape[0] - 2)
+        return s, segment, s - self.knots[segment]
+
+    def _derivatives(self, s, order):
+        s, segment, t = self._locate(s)
+        c = self._coefficients[segment]         # (..., 4, 2)
+        t = t[..., None]
+        value = c[..., 0, :] + t*(c[..., 1, :] + t*(c[..., 2, :] +
+                                                    t*c[..., 3, :]))
+        if order == 0:
+            return value
+        first = c[..., 1, :] + t*(2.0*c[..., 2, :] + 3.0*t*c[..., 3, :])
+        if order == 1:
+            return value, first
+        second = 2.0*c[..., 2, :] + 6.0*t*c[..., 3, :]
+        return value, first, second
+
+    def position(self, s):
+        """Returns the (..., 2) [x, y] positions at arc lengths s.
+        """
+        return self._derivatives(s, 0)
+
+    def heading(self, s):
+        """Returns the path heading (radians, arctan2(dy, dx)) at s.
+        """
+        _, first = self._derivatives(s, 1)
+        return np.arctan2(first[..., 1], first[..., 0])
+
+    def curvature(self, s):
+        """Returns the signed curvature (1/m, positive to the left) at s.
+        """
+        _, first, second = self._derivatives(s, 2)
+        cross = first[..., 0]*second[..., 1] - first[..., 1]*second[..., 0]
+        return cross / np.hypot(first[..., 0], first[..., 1])**3
+
+    def speed(self, s):
+        """Returns the reference speed at s, linear between waypoints.
+        """
+        return np.interp(s, self.knots, self.waypoints[:, 2])
+
+    def sample(self, s):
+        """Returns (len(s), 3) rows of [x, y, v] at the arc lengths s.
+        """
+        s = np.asarray(s, dtype=np.float64)
+        samples = np.empty(s.shape + (3,))
+        samples[..., :2] = self.position(s)
+        samples[..., 2]  = self.speed(s)
+        return samples
+
+    def window(self, s_start, s_end, resolution):
+        """Samples the path every resolution meters from s_start to s_end.
+
+        Args:
+            s_start: Arc length of the first sample in meters
+            s_end: Arc length of the last sample in meters (inclusive)
+            resolution: Distance between samples in meters
+
+        Returns: (rows, 3) array of [x, y, v], the same layout as the
+                 waypoint windows of the linear path (path_interp)
+        """
+        num_samples = int(np.floor((s_end - s_start) / resolution)) + 1
+        return self.sample(s_start + resolution*np.arange(max(num_samples,
+                                                               1)))
+
+    def waypoint_window(self, first_index, last_index, resolution):
+        """Samples the path between two input waypoints.
+
+        Drop-in for InterpolatedPath.window_view: the rows start at waypoint
+        first_index and end at (or just before) waypoint last_index.
+        """
+        arc_length = self.waypoint_arc_length
+        return self.window(arc_length[first_index], arc_length[last_index],
+                           resolution)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+"""
+Per-stage latency instrumentation of the control loop.
+
+A StageProfiler timestamps the stages of every frame with
+time.perf_counter_ns: each mark() charges the time elapsed since the
+previous mark (or the start of the frame) to one stage. Durations go to
+log-linear histograms (16 linear buckets per power of two, so percentiles
+are within about 3% of the true values) whose recording cost is a few
+integer operations, and optionally to a per-frame trace written as CSV at
+the end of the episode.
+"""
+from __future__ import print_function
+
+import time
+import numpy as np
+
+import episode_history
+
+_SUB_BUCKET_BITS = 4
+_SUB_BUCKETS     = 1 << _SUB_BUCKET_BITS
+_LINEAR_LIMIT    = _SUB_BUCKET_BITS + 1     # values below 2**5 are exact
+_NUM_BUCKETS     = 64 * _SUB_BUCKETS
+
+class LatencyHistogram(object):
+    """ Latency Histogram
+
+    Counts non negative integer durations (ns) in log-linear buckets. A
+    value v of bit length b > 5 falls in bucket
+    (b - 5) * 16 + (v >> (b - 5)), values below 32 have their own bucket.
+    """
+    def __init__(self):
+        self.counts = [0] * _NUM_BUCKETS
+        self.count  = 0
+        self.total  = 0
+        self.max    = 0
+
+    def record(self, value):
+        shift = value.bit_length() - _LINEAR_LIMIT
+        if shift > 0:
+            self.counts[(shift << _SUB_BUCKET_BITS) + (value >> shift)] += 1
+        else:
+            self.counts[value] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    @staticmethod
+    def bucket_bounds(index):
+        """Returns the [low, high) values counted in a bucket.
+        """
+        if index < 2 * _SUB_BUCKETS:
+            return index, index + 1
+        shift = (index >> _SUB_BUCKET_BITS) - 1
+        low   = ((index & (_SUB_BUCKETS - 1)) + _SUB_BUCKETS) << shift
+        return low, low + (1 << shift)
+
+    def percentile(self, q):
+        """Value at percentile q (0 to 100), the midpoint of its bucket
+        (never above the max recorded).
+        """
+        if not self.count:
+            return 0.0
+        rank = max(int(np.ceil(q / 100.0 * self.count)), 1)
+        index = int(np.searchsorted(np.cumsum(self.counts), rank))
+        low, high = self.bucket_bounds(index)
+        return min(0.5 * (low + high - 1), float(self.max))
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+class StageProfiler(object):
+    """ Stage Profiler
+
+    Usage, once per frame:
+        profiler.start_frame(frame)
+        ...                           (first stage)
+        profiler.mark(STAGE_A)
+        ...                           (second stage)
+        profiler.mark(STAGE_B)
+        profiler.end_frame()
+
+    Stages are indices into the stage names. A stage skipped in a frame is
+    not recorded (its trace column is 0 for that frame). A disabled
+    profiler keeps the same interface and records nothing.
+    """
+    def __init__(self, stage_names, enabled=True, trace_file=None):
+        """
+        Args:
+            stage_names: Names of the stages, in index order
+            enabled: Record the stages (False makes every call a no-op)
+            trace_file: Optional CSV file to write the per-frame stage
+                        durations (ns) to when the profiler is closed
+                        (requires enabled)
+        """
+        if trace_file is not None and not enabled:
+            raise ValueError('a stage trace needs an enabled profiler')
+        self.stage_names = list(stage_names)
+        self.enabled     = bool(enabled)
+        self.trace_file  = trace_file
+        self.histograms  = [LatencyHistogram() for _ in self.stage_names]
+        self.frame_histogram = LatencyHistogram()
+        self._frame       = 0
+        self._frame_start = 0
+        self._last_mark   = 0
+        self._durations   = None
+        self._trace       = None
+        if self.trace_file is not None:
+            self._trace = episode_history.HistoryBuffer(
+                    [('frame', np.int64)] +
+                    [(name, np.int64) for name in self.stage_names] +
+                    [('frame_total', np.int64)], 1024)
+
+    def start_frame(self, frame):
+        if not self.enabled:
+            return
+        self._frame = frame
+        if self._trace is not None:
+            self._durations = [0] * len(self.stage_names)
+        self._frame_start = self._last_mark = time.perf_counter_ns()
+
+    def mark(self, stage):
+        """Charges the time since the previous mark to a stage.
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter_ns()
+        duration = now - self._last_mark
+        self._last_mark = now
+        self.histograms[stage].record(duration)
+        if self._durations is not None:
+            self._durations[stage] += duration
+
+    def end_frame(self):
+        if not self.enabled:
+            return
+        total = time.perf_counter_ns() - self._frame_start
+        self.frame_histogram.record(total)
+        if self._trace is not None:
+            self._trace.append(self._frame, *(self._durations + [total]))
+
+    def report(self):
+        """Returns the p50/p99/max table of every stage in microseconds.
+        """
+        lines = ['%-22s %8s %10s %10s %10s %10s' % (
+                'stage', 'frames', 'mean (us)', 'p50 (us)', 'p99 (us)',
+                'max (us)')]
+        for name, histogram in zip(self.stage_names + ['frame'],
+                                   self.histograms + [self.frame_histogram]):
+            lines.append('%-22s %8d %10.1f %10.1f %10.1f %10.1f' % (
+                    name, histogram.count, histogram.mean() / 1e3,
+                    histogram.percentile(50) / 1e3,
+                    histogram.percentile(99) / 1e3, histogram.max / 1e3))
+        return '\n'.join(lines)
+
+    def close(self):
+        """Writes the trace file (if any).
+        """
+        if self._trace is None:
+            return
+        records = self._trace.view()
+        np.savetxt(self.trace_file,
+                   records.view(np.int64).reshape(len(records), -1),
+                   fmt='%d', delimiter=',',
+                   header=','.join(records.dtype.names), comments='')
+        self._trace = None
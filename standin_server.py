@@ -0,0 +1,694 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-in for the CARLA 0.8 server, for load-testing the client loop.
+
+Speaks the subset of the CARLA 0.8 client protocol used by the waypoint
+follower demo (load_settings, start_episode, read_data and send_control):
+protobuf messages framed by a 4 byte little endian length over three TCP
+connections, the world client on port, the measurement stream on port+1
+and the control client on port+2. The vehicle is simulated with the
+kinematic simulator (kinematic_sim.py), so a make_carla_client(host, port)
+session runs against it unchanged.
+
+The frame rate sets the game time of a frame. In synchronous mode
+(SynchronousMode=True in the CarlaSettings, as in module_7.py) the next
+frame is sent when the control of the previous one arrives. Otherwise the
+frames are paced at the frame rate and the latest control received is
+applied to every frame until a newer one arrives. Delays can be injected before every frame (fixed delay, random
+jitter and periodic stalls). Every episode reports the frame rate reached
+and the round-trip latency from a frame to its control.
+
+The protobuf wire format of the few messages involved is encoded by hand,
+so neither protobuf nor the carla package are needed.
+
+Usage:
+    python standin_server.py [-p PORT] [--fps FPS] [--delay MS] ...
+    python standin_server.py --load-test FRAMES   (server and test client)
+"""
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import configparser
+import logging
+import random
+import select
+import socket
+import struct
+import threading
+import time
+import numpy as np
+
+import closed_loop
+import kinematic_sim
+
+DEFAULT_PORT       = 2000
+DEFAULT_FPS        = 30.0
+NUM_START_SPOTS    = 2      # start spots reported (all at the track start,
+                            # module_7.py starts at index 1)
+ACCEPT_TIMEOUT     = 10.0   # seconds to wait for the stream/control clients
+REPORT_PERIOD      = 5.0    # seconds between progress reports
+
+_HEADER = struct.Struct('<L')
+
+#############################################
+# Protobuf wire format
+#############################################
+_VARINT  = 0
+_FIXED64 = 1
+_BYTES   = 2
+_FIXED32 = 5
+
+def _encode_varint(value):
+    out = bytearray()
+    value = int(value) & 0xFFFFFFFFFFFFFFFF
+    while True:
+        bits = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(bits | 0x80)
+        else:
+            out.append(bits)
+            return bytes(out)
+
+def _decode_varint(data, position):
+    result = 0
+    shift  = 0
+    while True:
+        byte = data[position]
+        position += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, position
+        shift += 7
+
+def _field(number, wire_type):
+    return _encode_varint(number << 3 | wire_type)
+
+def _float(number, value):
+    return _field(number, _FIXED32) + struct.pack('<f', value)
+
+def _uint(number, value):
+    return _field(number, _VARINT) + _encode_varint(value)
+
+def _bytes(number, value):
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return _field(number, _BYTES) + _encode_varint(len(value)) + value
+
+def decode_fields(data):
+    """Splits a protobuf message into its fields.
+
+    Returns: Dict of field number to the list of raw values (int for
+             varints, bytes for the other wire types)
+    """
+    fields   = {}
+    position = 0
+    while position < len(data):
+        key, position = _decode_varint(data, position)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == _VARINT:
+            value, position = _decode_varint(data, position)
+        elif wire_type == _FIXED32:
+            value = data[position:position + 4]
+            position += 4
+        elif wire_type == _FIXED64:
+            value = data[position:position + 8]
+            position += 8
+        elif wire_type == _BYTES:
+            length, position = _decode_varint(data, position)
+            value = data[position:position + length]
+            position += length
+        else:
+            raise ValueError('unsupported protobuf wire type %d' % wire_type)
+        fields.setdefault(number, []).append(value)
+    return fields
+
+def _last_float(fields, number):
+    return struct.unpack('<f', fields[number][-1])[0] if number in fields \
+           else 0.0
+
+def _last_int(fields, number):
+    return fields[number][-1] if number in fields else 0
+
+def _last_bytes(fields, number):
+    return fields[number][-1] if number in fields else b''
+
+#############################################
+# carla_server.proto messages
+#############################################
+def encode_vector(x, y, z):
+    """Vector3D and Rotation3D (pitch, yaw, roll) messages.
+    """
+    return _float(1, x) + _float(2, y) + _float(3, z)
+
+def encode_transform(transform):
+    location = transform.location
+    rotation = transform.rotation
+    return (_bytes(1, encode_vector(location.x, location.y, location.z)) +
+            _bytes(3, encode_vector(rotation.pitch, rotation.yaw,
+                                    rotation.roll)))
+
+def encode_control(control):
+    return (_float(1, control.steer) + _float(2, control.throttle) +
+            _float(3, control.brake) + _uint(4, control.hand_brake) +
+            _uint(5, control.reverse))
+
+def encode_scene_description(map_name, start_spots):
+    """SceneDescription (no sensors).
+    """
+    return b''.join([_bytes(1, encode_transform(spot))
+                     for spot in start_spots] + [_bytes(3, map_name)])
+
+def encode_measurements(measurements):
+    """Measurements of the player (no non-player agents).
+    """
+    player = measurements.player_measurements
+    acceleration = player.acceleration
+    player_message = (
+            _bytes(1, encode_transform(player.transform)) +
+            _bytes(3, encode_vector(acceleration.x, acceleration.y,
+                                    acceleration.z)) +
+            _float(4, player.forward_speed) +
+            _float(5, player.collision_vehicles) +
+            _float(6, player.collision_pedestrians) +
+            _float(7, player.collision_other) +
+            _float(8, player.intersection_otherlane) +
+            _float(9, player.intersection_offroad) +
+            _bytes(10, encode_control(player.autopilot_control)))
+    return (_uint(1, measurements.platform_timestamp & 0xFFFFFFFF) +
+            _uint(2, measurements.game_timestamp & 0xFFFFFFFF) +
+            _bytes(3, player_message) +
+            _uint(5, measurements.frame_number))
+
+def decode_request_new_episode(data):
+    """Returns the CarlaSettings ini text of a RequestNewEpisode.
+    """
+    return _last_bytes(decode_fields(data), 1).decode('utf-8')
+
+def decode_episode_start(data):
+    """Returns the player start index of an EpisodeStart.
+    """
+    return _last_int(decode_fields(data), 1)
+
+def decode_control(data):
+    fields = decode_fields(data)
+    return kinematic_sim.VehicleControl(
+            steer=_last_float(fields, 1),
+            throttle=_last_float(fields, 2),
+            brake=_last_float(fields, 3),
+            hand_brake=bool(_last_int(fields, 4)),
+            reverse=bool(_last_int(fields, 5)))
+
+def _decode_vector(data, cls, names):
+    fields = decode_fields(data)
+    return cls(**dict((name, _last_float(fields, number + 1))
+                      for number, name in enumerate(names)))
+
+def _decode_transform(data):
+    fields = decode_fields(data)
+    return kinematic_sim.Transform(
+            location=_decode_vector(_last_bytes(fields, 1),
+                                    kinematic_sim.Location, 'xyz'),
+            rotation=_decode_vector(_last_bytes(fields, 3),
+                                    kinematic_sim.Rotation,
+                                    ('pitch', 'yaw', 'roll')))
+
+def decode_scene_description(data):
+    fields = decode_fields(data)
+    return kinematic_sim._Message(
+            map_name=_last_bytes(fields, 3).decode('utf-8'),
+            player_start_spots=[_decode_transform(spot)
+                                for spot in fields.get(1, [])],
+            sensors=[])
+
+def decode_measurements(data):
+    fields = decode_fields(data)
+    player = decode_fields(_last_bytes(fields, 3))
+    player_measurements = kinematic_sim._Message(
+            transform=_decode_transform(_last_bytes(player, 1)),
+            acceleration=_decode_vector(_last_bytes(player, 3),
+                                        kinematic_sim.Location, 'xyz'),
+            forward_speed=_last_float(player, 4),
+            collision_vehicles=_last_float(player, 5),
+            collision_pedestrians=_last_float(player, 6),
+            collision_other=_last_float(player, 7),
+            intersection_otherlane=_last_float(player, 8),
+            intersection_offroad=_last_float(player, 9),
+            autopilot_control=decode_control(_last_bytes(player, 10)))
+    return kinematic_sim._Message(
+            frame_number=_last_int(fields, 5),
+            platform_timestamp=_last_int(fields, 1),
+            game_timestamp=_last_int(fields, 2),
+            player_measurements=player_measurements,
+            non_player_agents=[])
+
+#############################################
+# Framing
+#############################################
+def _read_exactly(connection, length):
+    chunks = []
+    while length:
+        chunk = connection.recv(length)
+        if not chunk:
+            raise ConnectionError('connection closed')
+        chunks.append(chunk)
+        length -= len(chunk)
+    return b''.join(chunks)
+
+def read_message(connection):
+    """Reads one length-prefixed message.
+    """
+    length = _HEADER.unpack(_read_exactly(connection, _HEADER.size))[0]
+    return _read_exactly(connection, length) if length else b''
+
+def write_message(connection, message):
+    """Writes one length-prefixed message (an empty one is a valid frame).
+    """
+    connection.sendall(_HEADER.pack(len(message)) + message)
+
+def _listen(host, port):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(1)
+    return server
+
+def _accept(server, timeout):
+    server.settimeout(timeout)
+    connection, _ = server.accept()
+    connection.settimeout(None)
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return connection
+
+def _connect(host, port, timeout):
+    connection = socket.create_connection((host, port), timeout)
+    connection.settimeout(None)
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return connection
+
+def is_synchronous(ini_text):
+    """Reads SynchronousMode from a CarlaSettings ini text.
+    """
+    config = configparser.ConfigParser(strict=False)
+    try:
+        config.read_string(ini_text)
+    except configparser.Error:
+        return False
+    for section in config.sections():
+        if config.has_option(section, 'SynchronousMode'):
+            return config.getboolean(section, 'SynchronousMode')
+    return False
+
+#############################################
+# Server
+#############################################
+def _next_request(world):
+    # The next RequestNewEpisode, or None if the client disconnected
+    try:
+        return read_message(world)
+    except (ConnectionError, OSError):
+        return None
+
+class EpisodeStats(object):
+    """ Episode Stats
+
+    Frame times and round-trip latencies (frame sent to control received)
+    of an episode.
+    """
+    def __init__(self):
+        self.start_time    = time.perf_counter()
+        self.last_frame    = self.start_time
+        self.num_frames    = 0
+        self.num_controls  = 0
+        self.round_trips   = []
+
+    def frame_rate(self):
+        elapsed = self.last_frame - self.start_time
+        return self.num_frames / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        text = 'frames: %d, controls: %d, %.1f frames/s' % (
+                self.num_frames, self.num_controls, self.frame_rate())
+        if self.round_trips:
+            latency = 1e3 * np.array(self.round_trips)
+            text += ', round trip p50 %.3f ms, p99 %.3f ms, max %.3f ms' % (
+                    np.percentile(latency, 50), np.percentile(latency, 99),
+                    latency.max())
+        return text
+
+class StandInServer(object):
+    """ Stand-in Server
+
+    Serves one client at a time, episode after episode, until close() is
+    called. The game time advances by 1 / frame_rate per frame.
+    """
+    def __init__(self, start_transform, host='localhost', port=DEFAULT_PORT,
+                 frame_rate=DEFAULT_FPS, delay=0.0, jitter=0.0,
+                 stall_every=0, stall=0.0, seed=0):
+        """
+        Args:
+            start_transform: Transform the vehicle spawns at
+            host: Address to listen on
+            port: World port (the stream and control ports follow it)
+            frame_rate: Frames per second of game time (and of wall time in
+                        asynchronous mode)
+            delay: Delay injected before every frame in seconds
+            jitter: Maximum random extra delay per frame in seconds
+            stall_every: Inject a stall every this many frames (0: never)
+            stall: Duration of a stall in seconds
+            seed: Seed of the jitter
+        """
+        self.start_transform = start_transform
+        self.host        = host
+        self.port        = int(port)
+        self.frame_rate  = float(frame_rate)
+        self.delay       = float(delay)
+        self.jitter      = float(jitter)
+        self.stall_every = int(stall_every)
+        self.stall       = float(stall)
+        self.episodes    = []      # EpisodeStats of the finished episodes
+        self._random     = random.Random(seed)
+        self._closed     = threading.Event()
+        self._world_server   = _listen(host, self.port)
+        self._stream_server  = _listen(host, self.port + 1)
+        self._control_server = _listen(host, self.port + 2)
+
+    def close(self):
+        self._closed.set()
+        for server in (self._world_server, self._stream_server,
+                       self._control_server):
+            server.close()
+
+    def serve_forever(self):
+        """Serves clients until close() is called.
+        """
+        while not self._closed.is_set():
+            try:
+                world = _accept(self._world_server, 0.5)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            logging.info('client connected')
+            try:
+                self._serve_client(world)
+            except (ConnectionError, OSError) as error:
+                logging.info('client disconnected (%s)', error)
+            finally:
+                world.close()
+
+    def _serve_client(self, world):
+        request = read_message(world)
+        while True:
+            synchronous = is_synchronous(decode_request_new_episode(request))
+            simulator = kinematic_sim.KinematicSimulator(
+                    self.start_transform, 1.0 / self.frame_rate,
+                    map_name='StandIn')
+            write_message(world, encode_scene_description(
+                    'StandIn', [self.start_transform] * NUM_START_SPOTS))
+            simulator.start_episode(decode_episode_start(read_message(world)))
+            write_message(world, _uint(1, True))     # EpisodeReady
+
+            stream  = _accept(self._stream_server, ACCEPT_TIMEOUT)
+            control = _accept(self._control_server, ACCEPT_TIMEOUT)
+            logging.info('episode started (%s mode)',
+                         'synchronous' if synchronous else 'asynchronous')
+            try:
+                request = self._run_episode(world, stream, control,
+                                            simulator, synchronous)
+            finally:
+                stream.close()
+                control.close()
+            logging.info('episode ended: %s', self.episodes[-1].summary())
+            if request is None:
+                return
+
+    def _inject_delay(self, frame):
+        delay = self.delay
+        if self.jitter:
+            delay += self._random.uniform(0.0, self.jitter)
+        if self.stall_every and frame and frame % self.stall_every == 0:
+            delay += self.stall
+        if delay > 0:
+            time.sleep(delay)
+
+    def _run_episode(self, world, stream, control, simulator, synchronous):
+        # Streams frames until the client requests a new episode (returns
+        # the request) or disconnects (returns None)
+        stats = EpisodeStats()
+        self.episodes.append(stats)
+        period      = 1.0 / self.frame_rate
+        next_frame  = time.perf_counter()
+        last_report = next_frame
+        latest      = None      # last control received, applied to every
+                                # frame until a newer one arrives
+        while not self._closed.is_set():
+            self._inject_delay(stats.num_frames)
+            if not synchronous:
+                next_frame += period
+                time.sleep(max(next_frame - time.perf_counter(), 0.0))
+            measurements, _ = simulator.read_data()
+            measurements.platform_timestamp = int(time.time() * 1000.0)
+            try:
+                write_message(stream, encode_measurements(measurements))
+                write_message(stream, b'')     # end of the sensor data
+            except OSError:
+                return _next_request(world)
+            sent = time.perf_counter()
+            stats.num_frames += 1
+            stats.last_frame  = sent
+
+            # Wait for the control of this frame (synchronous mode), or
+            # take the controls that already arrived
+            waiting = True
+            while waiting:
+                timeout = None if synchronous else 0.0
+                readable, _, _ = select.select([world, control], [], [],
+                                               timeout)
+                if world in readable:
+                    return _next_request(world)
+                if control in readable:
+                    try:
+                        latest = decode_control(read_message(control))
+                    except ConnectionError:
+                        # The client closes the episode connections
+                        # before it requests a new episode
+                        return _next_request(world)
+                    stats.num_controls += 1
+                    if synchronous:
+                        stats.round_trips.append(time.perf_counter() - sent)
+                        waiting = False
+                elif not synchronous:
+                    waiting = False
+            if latest is not None:
+                simulator.send_control(latest)
+            else:
+                simulator.send_control(kinematic_sim.VehicleControl())
+
+            if time.perf_counter() - last_report >= REPORT_PERIOD:
+                last_report = time.perf_counter()
+                logging.info('%s', stats.summary())
+        return None
+
+#############################################
+# Test client
+#############################################
+class StandInClient(object):
+    """ Stand-in Client
+
+    Minimal client of the same protocol with the CarlaClient methods used
+    by the demo, for load tests where the carla package is not installed.
+    Messages are returned as attribute containers with the field names of
+    the protobuf messages.
+    """
+    def __init__(self, host='localhost', port=DEFAULT_PORT, timeout=15.0):
+        self.host     = host
+        self.port     = int(port)
+        self.timeout  = timeout
+        self._world   = _connect(host, self.port, timeout)
+        self._stream  = None
+        self._control = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._disconnect_episode()
+        self._world.close()
+
+    def _disconnect_episode(self):
+        for connection in (self._stream, self._control):
+            if connection is not None:
+                connection.close()
+        self._stream  = None
+        self._control = None
+
+    def load_settings(self, carla_settings):
+        """Requests a new episode, carla_settings is an ini text or an
+        object whose str() is one (CarlaSettings).
+        """
+        self._disconnect_episode()
+        write_message(self._world, _bytes(1, str(carla_settings)))
+        return decode_scene_description(read_message(self._world))
+
+    def start_episode(self, player_start_index):
+        write_message(self._world, _uint(1, player_start_index))
+        ready = _last_int(decode_fields(read_message(self._world)), 1)
+        if not ready:
+            raise RuntimeError('cannot start the episode')
+        self._stream  = _connect(self.host, self.port + 1, self.timeout)
+        self._control = _connect(self.host, self.port + 2, self.timeout)
+
+    def read_data(self):
+        measurements = decode_measurements(read_message(self._stream))
+        sensor_data  = {}
+        while read_message(self._stream):
+            pass                # no sensors are simulated
+        return measurements, sensor_data
+
+    def send_control(self, *args, **kwargs):
+        if args:
+            control = args[0]
+        else:
+            control = kinematic_sim.VehicleControl(**kwargs)
+        write_message(self._control, encode_control(control))
+
+SYNCHRONOUS_SETTINGS = '[CARLA/Server]\nSynchronousMode=True\n'
+
+def load_test(server, num_frames):
+    """Runs a closed-loop client against a server for num_frames frames.
+
+    The client runs the localization, lookahead windowing and Controller2D
+    steps of the demo loop (as closed_loop.py) on the received
+    measurements.
+
+    Returns: (frame_rate, latencies)
+        frame_rate: Client frames per second
+        latencies: Per-frame seconds from read_data to send_control
+                   returning
+    """
+    import Controller
+    waypoints_np = closed_loop.load_track()
+    wp_interp    = closed_loop.path_interp.InterpolatedPath(
+            waypoints_np, closed_loop.INTERP_DISTANCE_RES)
+    wp_interp.dense()
+    lookahead    = closed_loop.waypoint_nav.LookaheadTable(
+            wp_interp.distance, closed_loop.INTERP_LOOKAHEAD_DISTANCE)
+    tracker      = closed_loop.waypoint_nav.ProgressTracker(waypoints_np)
+    controller   = Controller.Controller2D(waypoints_np)
+    latencies    = []
+    with StandInClient(server.host, server.port) as client:
+        client.load_settings(SYNCHRONOUS_SETTINGS)
+        client.start_episode(1)
+        start = time.perf_counter()
+        for frame in range(num_frames):
+            tick = time.perf_counter()
+            measurements, _ = client.read_data()
+            player    = measurements.player_measurements
+            x         = player.transform.location.x
+            y         = player.transform.location.y
+            closest_index, _ = tracker.update(x, y)
+            controller.update_waypoints(wp_interp.window_view(
+                    *lookahead.window(closest_index)))
+            controller.update_values(
+                    x, y, np.radians(player.transform.rotation.yaw),
+                    player.forward_speed,
+                    measurements.game_timestamp / 1000.0, frame)
+            controller.update_controls()
+            throttle, steer, brake = controller.get_commands()
+            client.send_control(steer=steer, throttle=throttle, brake=brake)
+            latencies.append(time.perf_counter() - tick)
+        frame_rate = num_frames / (time.perf_counter() - start)
+    return frame_rate, np.array(latencies)
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument(
+        '--host',
+        default='localhost',
+        help='IP of the host server (default: localhost)')
+    argparser.add_argument(
+        '-p', '--port',
+        default=DEFAULT_PORT,
+        type=int,
+        help='world port, stream and control use the next two '
+             '(default: %(default)s)')
+    argparser.add_argument(
+        '--fps',
+        default=DEFAULT_FPS,
+        type=float,
+        help='frames per second of game time (default: %(default)s)')
+    argparser.add_argument(
+        '--delay',
+        default=0.0,
+        type=float,
+        help='delay injected before every frame in ms')
+    argparser.add_argument(
+        '--jitter',
+        default=0.0,
+        type=float,
+        help='maximum random extra delay per frame in ms')
+    argparser.add_argument(
+        '--stall-every',
+        default=0,
+        type=int,
+        help='inject a stall every N frames')
+    argparser.add_argument(
+        '--stall',
+        default=0.0,
+        type=float,
+        help='duration of a stall in ms')
+    argparser.add_argument(
+        '--load-test',
+        metavar='FRAMES',
+        type=int,
+        help='run a synchronous test client for FRAMES frames against the '
+             'server, report and exit')
+    argparser.add_argument(
+        '-v', '--verbose',
+        action='store_true',
+        help='print debug information')
+    args = argparser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s: %(message)s',
+                        level=logging.DEBUG if args.verbose
+                        else logging.INFO)
+    server = StandInServer(
+            kinematic_sim.start_transform_from_waypoints(
+                    closed_loop.load_track()),
+            args.host, args.port, args.fps, args.delay / 1000.0,
+            args.jitter / 1000.0, args.stall_every, args.stall / 1000.0)
+    logging.info('listening on %s:%d-%d', args.host, args.port,
+                 args.port + 2)
+    if args.load_test is None:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+        return
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        frame_rate, latencies = load_test(server, args.load_test)
+    finally:
+        server.close()
+        thread.join(2.0)
+    latencies = 1e3 * latencies
+    print('client: %.1f frames/s, frame p50 %.3f ms, p99 %.3f ms, '
+          'max %.3f ms' % (frame_rate, np.percentile(latencies, 50),
+                           np.percentile(latencies, 99), latencies.max()))
+    for stats in server.episodes:
+        print('server: %s' % stats.summary())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+"""
+Streaming binary telemetry of the waypoint follower.
+
+Every controlled frame is stored as one fixed-size record
+(TELEMETRY_DTYPE). Records are buffered in a preallocated chunk and
+appended to the telemetry file whenever the chunk is full, so a crash loses
+at most one chunk and a long run never holds its whole log in memory.
+
+Running this script converts a telemetry file into the text trajectory
+format ("x, y, v, t" rows) written by the demo.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import struct
+import numpy as np
+
+TELEMETRY_VERSION = 1           # bump when the record layout changes
+TELEMETRY_MAGIC   = b'SDCTLM'
+TELEMETRY_HEADER  = struct.Struct('<6sHQ')  # magic, version, record size
+TELEMETRY_DTYPE   = np.dtype([
+    ('frame',         np.int64),
+    ('time',          np.float64),  # game seconds after the start delay
+    ('x',             np.float64),
+    ('y',             np.float64),
+    ('yaw',           np.float64),
+    ('speed',         np.float64),
+    ('throttle',      np.float64),
+    ('steer',         np.float64),
+    ('brake',         np.float64),
+    ('desired_speed', np.float64),
+    ('closest_index', np.int64),
+])
+DEFAULT_CHUNK_RECORDS = 256     # about 8 s of frames at 30 Hz
+
+class TelemetryWriter(object):
+    """ Telemetry Writer
+
+    Appends TELEMETRY_DTYPE records to a binary file in chunks of
+    chunk_records records. The file is a small header followed by the raw
+    records, and can be read while it is being written (read_telemetry).
+    """
+    def __init__(self, file_name, chunk_records=DEFAULT_CHUNK_RECORDS):
+        """
+        Args:
+            file_name: Telemetry file to create (overwritten if it exists)
+            chunk_records: Number of records buffered between writes
+        """
+        self.file_name   = file_name
+        self._chunk      = np.zeros(chunk_records, dtype=TELEMETRY_DTYPE)
+        self._num_buffered = 0
+        self.num_records = 0
+        self._file       = open(file_name, 'wb')
+        self._file.write(TELEMETRY_HEADER.pack(
+                TELEMETRY_MAGIC, TELEMETRY_VERSION, TELEMETRY_DTYPE.itemsize))
+        self._file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, frame, time, x, y, yaw, speed, throttle=0.0, steer=0.0,
+               brake=0.0, desired_speed=0.0, closest_index=0):
+        """Buffers one record, writing the chunk out when it is full.
+        """
+        self._chunk[self._num_buffered] = (frame, time, x, y, yaw, speed,
+                                           throttle, steer, brake,
+                                           desired_speed, closest_index)
+        self._num_buffered += 1
+        self.num_records   += 1
+        if self._num_buffered == self._chunk.shape[0]:
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered records to the file.
+        """
+        if self._num_buffered:
+            self._file.write(self._chunk[:self._num_buffered].tobytes())
+            self._num_buffered = 0
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+def read_telemetry(file_name, mmap=True):
+    """Reads the records of a telemetry file.
+
+    A partially written last record (e.g. after a crash) is ignored.
+
+    Args:
+        file_name: Telemetry file written by TelemetryWriter
+        mmap: Memory-map the records instead of reading them
+
+    Returns: Structured array with the TELEMETRY_DTYPE layout
+    """
+    with open(file_name, 'rb') as telemetry_file:
+        header = telemetry_file.read(TELEMETRY_HEADER.size)
+    if len(header) < TELEMETRY_HEADER.size:
+        raise ValueError('%s is not a telemetry file' % file_name)
+    magic, version, itemsize = TELEMETRY_HEADER.unpack(header)
+    if magic != TELEMETRY_MAGIC:
+        raise ValueError('%s is not a telemetry file' % file_name)
+    if version != TELEMETRY_VERSION or itemsize != TELEMETRY_DTYPE.itemsize:
+        raise ValueError('%s has telemetry version %d, expected %d' %
+                         (file_name, version, TELEMETRY_VERSION))
+
+    num_records = ((os.path.getsize(file_name) - TELEMETRY_HEADER.size) //
+                   TELEMETRY_DTYPE.itemsize)
+    if num_records == 0:
+        return np.zeros(0, dtype=TELEMETRY_DTYPE)
+    if mmap:
+        return np.memmap(file_name, dtype=TELEMETRY_DTYPE, mode='r',
+                         offset=TELEMETRY_HEADER.size, shape=(num_records,))
+    return np.fromfile(file_name, dtype=TELEMETRY_DTYPE, count=num_records,
+                       offset=TELEMETRY_HEADER.size)
+
+def write_trajectory_text(records, file_name):
+    """Writes records in the text trajectory format ("x, y, v, t" rows).
+    """
+    np.savetxt(file_name,
+               np.column_stack((records['x'], records['y'],
+                                records['speed'], records['time'])),
+               fmt='%3.3f, %3.3f, %2.3f, %6.3f')
+
+def main():
+    argparser = argparse.ArgumentParser(
+            description='Convert a telemetry file into a trajectory file.')
+    argparser.add_argument(
+        'telemetry_file',
+        help='telemetry file written by the demo')
+    argparser.add_argument(
+        '-o', '--output',
+        metavar='PATH',
+        default=None,
+        help='trajectory file to write (default: trajectory.txt next to '
+             'the telemetry file)')
+    args = argparser.parse_args()
+
+    output = args.output or os.path.join(
+            os.path.dirname(os.path.abspath(args.telemetry_file)),
+            'trajectory.txt')
+    records = read_telemetry(args.telemetry_file)
+    write_trajectory_text(records, output)
+    print('%d records written to %s' % (records.shape[0], output))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+"""
+Nearest waypoint lookups.
+
+The lookahead window tracked by the controller is replaced every frame, so
+it is searched with a vectorized scan (nearest_waypoint). A window holds
+about 2000 dense points, which the scan covers in about 10 us (see
+bench_waypoint_lookup.py), less than a query of a prebuilt uniform grid
+over the same points.
+"""
+import numpy as np
+
+def nearest_waypoint(waypoints, x, y):
+    """Returns the index of the waypoint closest to (x, y).
+
+    A single vectorized scan. Ties are resolved towards the lowest index,
+    as in the linear scan previously done in
+    Controller2D.update_desired_speed.
+
+    Args:
+        waypoints: (N, 3) or (N, 2) array of waypoints
+        x: X position in meters
+        y: Y position in meters
+
+    Returns: index
+        index: Index of the closest waypoint (-1 if there are none)
+    """
+    if len(waypoints) == 0:
+        return -1
+    dists = (waypoints[:, 0] - x)**2 + (waypoints[:, 1] - y)**2
+    return int(np.argmin(dists))
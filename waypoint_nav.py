@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+
+"""
+Waypoint localization and lookahead windowing used by the waypoint follower
+demo, kept free of simulator imports so benchmarks and offline tools can
+run the same code.
+"""
+import math
+import numpy as np
+
+RELOCALIZE_WINDOW = 50.0    # arc length in meters searched on either side of
+                            # the tracked segment by a first relocalization
+
+def search_range(arc_length, center, half_width, num_segments):
+    """Segments within half_width of arc length from center.
+
+    Args:
+        arc_length: Increasing arc length of the waypoints
+        center: Arc length in the middle of the range
+        half_width: Arc length searched on either side of center
+        num_segments: Number of path segments
+
+    Returns: (first_segment, stop_segment)
+        first_segment: First segment of the range
+        stop_segment: Segment after the last one of the range
+    """
+    first = int(np.searchsorted(arc_length, center - half_width)) - 1
+    stop  = int(np.searchsorted(arc_length, center + half_width,
+                                side='right'))
+    return max(first, 0), min(stop, num_segments)
+
+def find_closest_index(waypoints_np, x, y, closest_index):
+    """Finds the waypoint closest to the car, starting from a previous guess.
+
+    First increment the index from the previous index until the new distance
+    calculations are increasing. Apply the same rule decrementing the index.
+    The final index should be the closest point (it is assumed that the car
+    will always break out of instability points where there are two indices
+    with the same minimum distance, as in the center of a circle)
+
+    Args:
+        waypoints_np: (N, 3) array of [x, y, v] waypoints
+        x: Car X position in meters
+        y: Car Y position in meters
+        closest_index: Closest waypoint index of the previous frame
+
+    Returns: (closest_index, closest_distance)
+        closest_index: Index of the waypoint closest to the car
+        closest_distance: Distance from the car to that waypoint
+    """
+    closest_distance = np.linalg.norm(np.array([
+            waypoints_np[closest_index, 0] - x,
+            waypoints_np[closest_index, 1] - y]))
+    new_distance = closest_distance
+    new_index = closest_index
+    while new_distance <= closest_distance:
+        closest_distance = new_distance
+        closest_index = new_index
+        new_index += 1
+        if new_index >= waypoints_np.shape[0]:  # End of path
+            break
+        new_distance = np.linalg.norm(np.array([
+                waypoints_np[new_index, 0] - x,
+                waypoints_np[new_index, 1] - y]))
+    new_distance = closest_distance
+    new_index = closest_index
+    while new_distance <= closest_distance:
+        closest_distance = new_distance
+        closest_index = new_index
+        new_index -= 1
+        if new_index < 0:  # Beginning of path
+            break
+        new_distance = np.linalg.norm(np.array([
+                waypoints_np[new_index, 0] - x,
+                waypoints_np[new_index, 1] - y]))
+    return closest_index, closest_distance
+
+def find_lookahead_window(wp_distance, closest_index, lookahead_distance):
+    """Returns the waypoint index range to send to the controller.
+
+    The range has 1 waypoint behind the closest one and X waypoints ahead,
+    where X is the index that has a lookahead distance specified by
+    lookahead_distance.
+
+    Args:
+        wp_distance: Distance from each waypoint to the next one
+        closest_index: Index of the waypoint closest to the car
+        lookahead_distance: Distance to cover ahead of the car in meters
+
+    Returns: (first_index, last_index)
+        first_index: First waypoint index of the window
+        last_index: Last waypoint index of the window (inclusive)
+    """
+    num_waypoints = len(wp_distance)
+    waypoint_subset_first_index = closest_index - 1
+    if waypoint_subset_first_index < 0:
+        waypoint_subset_first_index = 0
+
+    waypoint_subset_last_index = closest_index
+    total_distance_ahead = 0
+    while total_distance_ahead < lookahead_distance:
+        total_distance_ahead += wp_distance[waypoint_subset_last_index]
+        waypoint_subset_last_index += 1
+        if waypoint_subset_last_index >= num_waypoints:
+            waypoint_subset_last_index = num_waypoints - 1
+            break
+    return waypoint_subset_first_index, waypoint_subset_last_index
+
+def lookahead_distances(waypoints_np, lookahead_distance, lookahead_time=0.0,
+                        max_lookahead_distance=None):
+    """Speed dependent lookahead distance of every waypoint.
+
+    Args:
+        waypoints_np: (N, 3) array of [x, y, v] waypoints
+        lookahead_distance: Lookahead distance at standstill in meters
+        lookahead_time: Extra lookahead in seconds at the waypoint speed
+        max_lookahead_distance: Upper bound of the lookahead in meters
+
+    Returns: (N,) array of lookahead distances
+    """
+    distances = lookahead_distance + \
+                lookahead_time * np.abs(np.asarray(waypoints_np)[:, 2])
+    if max_lookahead_distance is not None:
+        distances = np.minimum(distances, max_lookahead_distance)
+    return distances
+
+class LookaheadTable(object):
+    """ Lookahead Table
+
+    The find_lookahead_window result of every closest index, computed in one
+    vectorized pass: the last waypoint of a window is the first one whose
+    cumulative distance from the closest waypoint covers the lookahead
+    distance, found with np.searchsorted on the cumulative arc length. The
+    windows equal those of find_lookahead_window up to the rounding of the
+    summed distances.
+    """
+    def __init__(self, wp_distance, lookahead_distance):
+        """
+        Args:
+            wp_distance: Distance from each waypoint to the next one
+            lookahead_distance: Lookahead distance in meters, either one
+                                value or one per waypoint (see
+                                lookahead_distances)
+        """
+        wp_distance   = np.asarray(wp_distance, dtype=np.float64)
+        num_waypoints = wp_distance.shape[0]
+        indices       = np.arange(num_waypoints)
+        lookahead_distance = np.broadcast_to(
+                np.asarray(lookahead_distance, dtype=np.float64),
+                (num_waypoints,))
+
+        arc_length = np.concatenate(([0.0], np.cumsum(wp_distance)))
+        last = np.searchsorted(arc_length,
+                               arc_length[:-1] + lookahead_distance,
+                               side='left')
+        last = np.maximum(last, indices)    # no lookahead at all
+        self.first = np.maximum(indices - 1, 0)
+        self.last  = np.minimum(last, num_waypoints - 1)
+        # Python lists make the per-tick lookup cheaper
+        self._first = self.first.tolist()
+        self._last  = self.last.tolist()
+
+    def __len__(self):
+        return len(self._first)
+
+    def window(self, closest_index):
+        """Returns the waypoint index range to send to the controller.
+
+        Returns: (first_index, last_index)
+            first_index: First waypoint index of the window
+            last_index: Last waypoint index of the window (inclusive)
+        """
+        return self._first[closest_index], self._last[closest_index]
+
+class ProgressTracker(object):
+    """ Progress Tracker
+
+    Tracks the car along the path by projecting it onto the path segments.
+    Segment vectors, squared lengths and cumulative arc lengths are computed
+    once. Every update walks from the previously tracked segment to the
+    neighbouring segment with the closest projection, which costs a few
+    scalar projections per tick at normal driving speeds, and never jumps
+    to a distant part of the path that comes back close to the car.
+
+    When the distance to the tracked segment exceeds relocalize_distance
+    (teleport, missed frames), the segments within relocalize_window meters
+    of arc length of the tracked one are projected in one vectorized pass
+    and the closest one is used if it is closer. The window doubles on
+    every tick the car stays off the path, up to the whole path. Once the
+    whole path was searched, only the first window is searched until the
+    car is back on the path, so a car driving off the path does not cost a
+    whole-path search per tick. The first update searches the whole path.
+    """
+    def __init__(self, waypoints_np, relocalize_distance=5.0,
+                 relocalize_window=RELOCALIZE_WINDOW):
+        """
+        Args:
+            waypoints_np: (N, 3) array of [x, y, v] waypoints
+            relocalize_distance: Distance to the tracked segment in meters
+                                 above which the path is searched
+            relocalize_window: Arc length in meters searched on either side
+                               of the tracked segment by a first
+                               relocalization
+        """
+        points = np.asarray(waypoints_np, dtype=np.float64)[:, :2]
+        if points.shape[0] < 2:
+            points = np.concatenate((points, points))[:2]
+        self.num_waypoints = np.asarray(waypoints_np).shape[0]
+        self.relocalize_distance = float(relocalize_distance)
+        self.relocalize_window   = float(relocalize_window)
+        self._search_window      = self.relocalize_window
+        self._widen_search       = True
+
+        self._start   = points[:-1]
+        self._vector  = np.diff(points, axis=0)
+        self._length2 = np.sum(self._vector**2, axis=1)
+        self._length  = np.sqrt(self._length2)
+        self._arc_length = np.concatenate(([0.0], np.cumsum(self._length)))
+        # Python lists make the per-tick scalar projections cheaper
+        self._points_x = points[:, 0].tolist()
+        self._points_y = points[:, 1].tolist()
+        self._start_x = self._start[:, 0].tolist()
+        self._start_y = self._start[:, 1].tolist()
+        self._vector_x = self._vector[:, 0].tolist()
+        self._vector_y = self._vector[:, 1].tolist()
+        self._length2_list = self._length2.tolist()
+        self._num_segments = len(self._length2_list)
+
+        self.segment        = None  # index of the tracked segment
+        self.fraction       = 0.0   # position along the segment [0, 1]
+        self.lateral_error  = 0.0   # distance from the car to the path
+        self.relocalizations = 0
+
+    @property
+    def arc_length(self):
+        """Distance travelled along the path to the car's projection.
+        """
+        if self.segment is None:
+            return 0.0
+        return float(self._arc_length[self.segment] +
+                     self.fraction * self._length[self.segment])
+
+    def reset(self):
+        self.segment = None
+
+    def update(self, x, y):
+        """Tracks the car position.
+
+        Args:
+            x: Car X position in meters
+            y: Car Y position in meters
+
+        Returns: (closest_index, closest_distance)
+            closest_index: Index of the segment end closest to the
+                           projection of the car
+            closest_distance: Distance from the car to that waypoint
+        """
+        if self.segment is None:
+            self._relocalize(x, y, float('inf'), 0, self._num_segments)
+        else:
+            self._track(x, y)
+            if self.lateral_error > self.relocalize_distance:
+                self._relocalize_near(x, y)
+            else:
+                self._search_window = self.relocalize_window
+                self._widen_search  = True
+
+        closest_index = self.segment + (1 if self.fraction >= 0.5 else 0)
+        closest_index = min(closest_index, self.num_waypoints - 1)
+        return closest_index, math.hypot(self._points_x[closest_index] - x,
+                                         self._points_y[closest_index] - y)
+
+    def _project(self, segment, x, y):
+        dx = x - self._start_x[segment]
+        dy = y - self._start_y[segment]
+        length2 = self._length2_list[segment]
+        if length2 > 0.0:
+            u = (dx*self._vector_x[segment] + dy*self._vector_y[segment]) / \
+                length2
+            u = min(max(u, 0.0), 1.0)
+        else:
+            u = 0.0
+        ex = dx - u*self._vector_x[segment]
+        ey = dy - u*self._vector_y[segment]
+        return u, ex*ex + ey*ey
+
+    def _track(self, x, y):
+        segment = self.segment
+        u, best = self._project(segment, x, y)
+        # Walk forward while the next segment is at least as close, then
+        # backward if the car did not move forward
+        moved = False
+        while segment + 1 < self._num_segments:
+            next_u, distance2 = self._project(segment + 1, x, y)
+            if distance2 > best:
+                break
+            segment, u, best, moved = segment + 1, next_u, distance2, True
+        while not moved and segment > 0:
+            prev_u, distance2 = self._project(segment - 1, x, y)
+            if distance2 >= best:
+                break
+            segment, u, best = segment - 1, prev_u, distance2
+        self.segment       = segment
+        self.fraction      = u
+        self.lateral_error = math.sqrt(best)
+
+    def _relocalize_near(self, x, y):
+        first, stop = search_range(self._arc_length, self.arc_length,
+                                   self._search_window, self._num_segments)
+        self._relocalize(x, y, self.lateral_error, first, stop)
+        if first == 0 and stop == self._num_segments:
+            # Searching the whole path again will not help while the car
+            # is off it, keep to its neighbourhood until it is back
+            self._widen_search  = False
+            self._search_window = self.relocalize_window
+        elif self._widen_search and \
+             self.lateral_error > self.relocalize_distance:
+            self._search_window *= 2.0
+
+    def _relocalize(self, x, y, tracked_error, first, stop):
+        # Moves to the closest of segments [first, stop) if it is closer
+        # than tracked_error
+        self.relocalizations += 1
+        start  = self._start[first:stop]
+        vector = self._vector[first:stop]
+        dx = x - start[:, 0]
+        dy = y - start[:, 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            u = (dx*vector[:, 0] + dy*vector[:, 1]) / \
+                self._length2[first:stop]
+        u = np.clip(np.nan_to_num(u), 0.0, 1.0)
+        distance2 = (dx - u*vector[:, 0])**2 + (dy - u*vector[:, 1])**2
+        segment = int(np.argmin(distance2))
+        error = math.sqrt(distance2[segment])
+        if error < tracked_error:
+            self.segment       = first + segment
+            self.fraction      = float(u[segment])
+            self.lateral_error = error